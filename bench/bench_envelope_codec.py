@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+"""Micro-benchmark: envelopes/second for Envelope.to_json/from_json vs ai_envelope_codec.
+
+    python bench/bench_envelope_codec.py [--count 20000] [--recipients 5]
+"""
+from __future__ import annotations
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "script"))
+
+import ai_envelope_codec as codec  # noqa: E402
+from ai_message_envelope import Envelope, ThreadContext  # noqa: E402
+
+
+def make_envelopes(count: int, recipients: int):
+    return [
+        Envelope(
+            sender=f"https://node{i % 50}.example/@agent{i}",
+            recipients=[f"https://node{(i + r) % 50}.example/@agent{r}" for r in range(recipients)],
+            payload={"type": "Note", "content": f"message {i}", "tags": ["a", "b", "c"], "n": i},
+            thread=ThreadContext(context=f"urn:uuid:thread-{i % 100}"),
+        )
+        for i in range(count)
+    ]
+
+
+def rate(label: str, count: int, fn) -> None:
+    start = time.perf_counter()
+    fn()
+    elapsed = time.perf_counter() - start
+    print(f"{label:<44} {count / elapsed:>12,.0f} envelopes/s")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--count", type=int, default=20000)
+    parser.add_argument("--recipients", type=int, default=5)
+    args = parser.parse_args()
+
+    envelopes = make_envelopes(args.count, args.recipients)
+    n = len(envelopes)
+    print(f"{n} envelopes, {args.recipients} recipients each, JSON backend: {codec.JSON_BACKEND}")
+
+    lines = [e.to_json() for e in envelopes]
+    buffer = codec.encode_many(envelopes)
+
+    rate("encode  Envelope.to_json", n, lambda: [e.to_json() for e in envelopes])
+    rate("encode  codec.encode_many", n, lambda: codec.encode_many(envelopes))
+    rate("decode  Envelope.from_json", n, lambda: [Envelope.from_json(line) for line in lines])
+    rate("decode  codec.decode_many (payload untouched)", n, lambda: codec.decode_many(buffer))
+    rate("decode  codec.decode_many + read payload", n,
+         lambda: [e.payload for e in codec.decode_many(buffer)])
+    rate("decode  codec.decode_many(validate=False)", n, lambda: codec.decode_many(buffer, validate=False))
+    decoded = codec.decode_many(buffer)
+    rate("re-encode decoded (raw payload copied)", n, lambda: codec.encode_many(decoded))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,373 @@
+#!/usr/bin/env python3
+"""End-to-end LMTP ingestion benchmark: load generator -> activitypub_lmtp_server.py
+-> activitypub-lmtp.py -> storage, with a stub sink in place of Dovecot.
+
+Everything runs on one machine in a throw-away data directory:
+
+- ``lmtp_stub_sink.py`` listens on a Unix socket and receives the Accepts that
+  the queue worker (``activitypub-send.py --worker``) sends for each Follow;
+- ``activitypub_lmtp_server.py`` listens on ``--port`` with the real handler;
+- N client threads each keep one LMTP session open and send a mix of Follow,
+  Create and Envelope messages.
+
+Results (throughput, p50/p95/p99 latency, storage growth, sink counters) are
+printed and written as JSON; ``--compare`` prints the change against an
+earlier result file::
+
+    python bench/bench_lmtp_ingest.py --sessions 8 --messages 2000 \\
+        --mix follow=1,create=3,envelope=1 --size 1024 --output before.json
+    python bench/bench_lmtp_ingest.py ... --output after.json --compare before.json
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+import uuid
+from email.message import EmailMessage
+from email.utils import formatdate
+from typing import Dict, List, Optional
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SCRIPT_DIR = os.path.join(BENCH_DIR, "..", "script")
+sys.path.insert(0, SCRIPT_DIR)
+
+from activitypub_lmtp_client import LMTPClient  # noqa: E402
+from ai_message_envelope import Envelope, ThreadContext  # noqa: E402
+
+KINDS = ("follow", "create", "envelope")
+
+
+def parse_mix(spec: str) -> Dict[str, float]:
+    """"follow=1,create=3,envelope=1" -> normalised weights."""
+    weights = {}
+    for item in filter(None, (x.strip() for x in spec.split(","))):
+        name, _, weight = item.partition("=")
+        if name not in KINDS:
+            raise argparse.ArgumentTypeError(f"unknown message kind: {name} (expected one of {KINDS})")
+        weights[name] = float(weight or 1)
+    total = sum(weights.values())
+    if total <= 0:
+        raise argparse.ArgumentTypeError("mix weights must add up to more than 0")
+    return {name: w / total for name, w in weights.items()}
+
+
+def make_payload(kind: str, i: int, size: int, recipients: int):
+    padding = "x" * max(0, size)
+    if kind == "follow":
+        return {
+            "@context": "https://www.w3.org/ns/activitystreams",
+            "id": f"https://bench.example/activities/{uuid.uuid4().hex}",
+            "type": "Follow",
+            "actor": f"https://bench.example/users/u{i}",
+            "object": "https://ipcnode.local/users/alice",
+        }
+    if kind == "create":
+        note_id = f"https://bench.example/notes/{uuid.uuid4().hex}"
+        return {
+            "@context": "https://www.w3.org/ns/activitystreams",
+            "id": f"{note_id}/activity",
+            "type": "Create",
+            "actor": f"https://bench.example/users/u{i}",
+            "object": {"id": note_id, "type": "Note", "content": padding,
+                       "context": f"https://bench.example/contexts/{i % 100}"},
+        }
+    return Envelope(
+        sender=f"https://bench.example/@agent{i}",
+        recipients=[f"https://node{r % 10}.example/@agent{r}" for r in range(max(1, recipients))],
+        payload={"type": "Note", "content": padding},
+        thread=ThreadContext(context=f"urn:uuid:bench-thread-{i % 100}"),
+    ).to_dict()
+
+
+def make_message(kind: str, i: int, size: int, recipients: int) -> bytes:
+    msg = EmailMessage()
+    msg["From"] = f"u{i}@bench.example"
+    msg["To"] = "alice@ipcnode.local"
+    msg["Subject"] = f"bench {kind} {i}"
+    msg["Date"] = formatdate(localtime=True)
+    msg["Message-Id"] = f"<{uuid.uuid4().hex}@bench.example>"
+    msg.set_content(json.dumps(make_payload(kind, i, size, recipients)), charset="utf-8")
+    msg.replace_header("Content-Type", "application/activity+json; charset=utf-8")
+    return msg.as_bytes()
+
+
+def percentile(sorted_values: List[float], pct: float) -> Optional[float]:
+    if not sorted_values:
+        return None
+    k = (len(sorted_values) - 1) * pct / 100
+    lo = int(k)
+    hi = min(lo + 1, len(sorted_values) - 1)
+    return sorted_values[lo] + (sorted_values[hi] - sorted_values[lo]) * (k - lo)
+
+
+def dir_sizes(root: str) -> Dict[str, int]:
+    """Bytes per top-level entry of the data directory."""
+    sizes: Dict[str, int] = {}
+    for entry in sorted(os.listdir(root)):
+        path = os.path.join(root, entry)
+        if os.path.isdir(path):
+            total = 0
+            for dirpath, _, files in os.walk(path):
+                for name in files:
+                    try:
+                        total += os.path.getsize(os.path.join(dirpath, name))
+                    except OSError:
+                        pass
+        else:
+            try:
+                total = os.path.getsize(path)
+            except OSError:
+                continue
+        sizes[entry] = total
+    return sizes
+
+
+def wait_for_port(host: str, port: int, timeout: float = 15.0) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection((host, port), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"LMTP server did not come up on {host}:{port}")
+
+
+def count_pending(queue_dir: str) -> int:
+    return sum(len(os.listdir(os.path.join(queue_dir, d)))
+               for d in ("new", "cur") if os.path.isdir(os.path.join(queue_dir, d)))
+
+
+def scrape_stages(host: str, port: int) -> Dict[str, Dict[str, float]]:
+    """Mean time and count per pipeline stage from the server's /metrics side port."""
+    try:
+        with urllib.request.urlopen(f"http://{host}:{port}/metrics", timeout=5) as resp:
+            text = resp.read().decode()
+    except OSError:
+        return {}
+    stages: Dict[str, Dict[str, float]] = {}
+    for line in text.splitlines():
+        for suffix in ("_sum", "_count"):
+            prefix = f"activitypub_stage_seconds{suffix}{{stage=\""
+            if line.startswith(prefix):
+                name = line[len(prefix):line.index('"', len(prefix))]
+                stages.setdefault(name, {})[suffix[1:]] = float(line.rsplit(" ", 1)[1])
+    return {name: {"count": int(v.get("count", 0)),
+                   "mean_ms": round(v["sum"] / v["count"] * 1000, 3) if v.get("count") else None}
+            for name, v in sorted(stages.items())}
+
+
+def run_load(args, messages: List[bytes]) -> Dict:
+    latencies: List[float] = []
+    errors: List[str] = []
+    lock = threading.Lock()
+    cursor = iter(range(len(messages)))
+    cursor_lock = threading.Lock()
+
+    def session() -> None:
+        client = LMTPClient(host=args.host, port=args.port, data_timeout=120)
+        local: List[float] = []
+        try:
+            while True:
+                with cursor_lock:
+                    i = next(cursor, None)
+                if i is None:
+                    break
+                start = time.perf_counter()
+                try:
+                    client.send(messages[i], "bench@bench.example", "alice@ipcnode.local")
+                    local.append(time.perf_counter() - start)
+                except Exception as e:
+                    with lock:
+                        errors.append(str(e))
+        finally:
+            client.quit()
+            with lock:
+                latencies.extend(local)
+
+    threads = [threading.Thread(target=session, name=f"session-{n}") for n in range(args.sessions)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {"elapsed": elapsed, "latencies": latencies, "errors": errors}
+
+
+def summarise(args, mix, load, before, after, sink, accepts_drained, stages) -> Dict:
+    lat = load["latencies"]
+    ms = lambda v: None if v is None else round(v * 1000, 3)  # noqa: E731
+    ok = len(lat)
+    return {
+        "config": {
+            "sessions": args.sessions, "messages": args.messages, "mix": mix, "size": args.size,
+            "recipients": args.recipients, "handler_mode": args.handler_mode,
+            "handler_concurrency": args.handler_concurrency, "worker": not args.no_worker,
+        },
+        "environment": {"python": platform.python_version(), "platform": platform.platform(),
+                        "cpus": os.cpu_count()},
+        "at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "delivered": ok,
+        "errors": len(load["errors"]),
+        "error_samples": load["errors"][:5],
+        "duration_s": round(load["elapsed"], 3),
+        "throughput_msgs_per_s": round(ok / load["elapsed"], 1) if load["elapsed"] else None,
+        "latency_ms": {
+            "p50": ms(percentile(lat, 50)), "p95": ms(percentile(lat, 95)), "p99": ms(percentile(lat, 99)),
+            "max": ms(lat[-1] if lat else None), "mean": ms(sum(lat) / ok if ok else None),
+        },
+        "storage": {
+            "before_bytes": sum(before.values()),
+            "after_bytes": sum(after.values()),
+            "growth_bytes": sum(after.values()) - sum(before.values()),
+            "growth_bytes_per_msg": round((sum(after.values()) - sum(before.values())) / ok, 1) if ok else None,
+            "by_path": {k: after.get(k, 0) - before.get(k, 0) for k in sorted(set(before) | set(after))},
+        },
+        "sink": dict(sink, accepts_drained=accepts_drained),
+        "stages": stages,
+    }
+
+
+def print_result(result: Dict) -> None:
+    lat = result["latency_ms"]
+    print(f"delivered {result['delivered']} messages ({result['errors']} errors) "
+          f"in {result['duration_s']} s -> {result['throughput_msgs_per_s']} msg/s")
+    print(f"latency ms: p50={lat['p50']} p95={lat['p95']} p99={lat['p99']} max={lat['max']}")
+    st = result["storage"]
+    print(f"storage: +{st['growth_bytes']} bytes ({st['growth_bytes_per_msg']} bytes/msg)")
+    for path, growth in st["by_path"].items():
+        if growth:
+            print(f"    {path:<28} +{growth}")
+    print(f"sink: {result['sink']}")
+    for name, st in result["stages"].items():
+        print(f"    stage {name:<20} n={st['count']:<8} mean={st['mean_ms']} ms")
+
+
+def compare(result: Dict, baseline_path: str) -> None:
+    with open(baseline_path) as f:
+        base = json.load(f)
+    rows = [("throughput_msgs_per_s", result["throughput_msgs_per_s"], base.get("throughput_msgs_per_s"))]
+    for key in ("p50", "p95", "p99"):
+        rows.append((f"latency_ms.{key}", result["latency_ms"][key], base.get("latency_ms", {}).get(key)))
+    rows.append(("storage.growth_bytes_per_msg", result["storage"]["growth_bytes_per_msg"],
+                 base.get("storage", {}).get("growth_bytes_per_msg")))
+    print(f"\ncompared with {baseline_path}:")
+    for name, now, then in rows:
+        change = f"{(now - then) / then * 100:+.1f}%" if now is not None and then else "n/a"
+        print(f"    {name:<30} {then!s:>12} -> {now!s:>12}  {change}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="End-to-end LMTP ingestion benchmark")
+    parser.add_argument("--sessions", type=int, default=8, help="concurrent LMTP sessions")
+    parser.add_argument("--messages", type=int, default=2000, help="messages to send in total")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix("follow=1,create=3,envelope=1"),
+                        help="weights per message kind, e.g. follow=1,create=3,envelope=1")
+    parser.add_argument("--size", type=int, default=512, help="padding bytes in Create / Envelope content")
+    parser.add_argument("--recipients", type=int, default=5, help="recipients per Envelope payload")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=2626, help="port for the LMTP server under test")
+    parser.add_argument("--metrics-port", type=int, default=9627, help="server metrics side port")
+    parser.add_argument("--handler-mode", choices=["inprocess", "subprocess"], default="inprocess")
+    parser.add_argument("--handler-concurrency", type=int, default=4)
+    parser.add_argument("--no-worker", action="store_true", help="do not run the queue worker (Accepts stay queued)")
+    parser.add_argument("--data-dir", default=None, help="data directory (default: a temporary one, removed afterwards)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", default=None, help="write the result JSON here")
+    parser.add_argument("--compare", default=None, help="earlier result JSON to compare with")
+    args = parser.parse_args()
+
+    workdir = args.data_dir or tempfile.mkdtemp(prefix="bench-lmtp-")
+    data_dir = os.path.join(workdir, "data")
+    log_dir = os.path.join(workdir, "log")
+    os.makedirs(data_dir, exist_ok=True)
+    os.makedirs(log_dir, exist_ok=True)
+    sink_socket = os.path.join(workdir, "sink.sock")
+    env = dict(
+        os.environ,
+        PYTHONPATH=os.pathsep.join(filter(None, [os.path.abspath(SCRIPT_DIR), os.environ.get("PYTHONPATH")])),
+        ACTIVITYPUB_DATA_DIR=data_dir,
+        ACTIVITYPUB_LOG_DIR=log_dir,
+        ACTIVITYPUB_LMTP_SOCKET=sink_socket,
+        ACTIVITYPUB_LMTP_HOST=args.host,
+        ACTIVITYPUB_LMTP_PORT=str(args.port),
+        ACTIVITYPUB_METRICS_PORT=str(args.metrics_port),
+        ACTIVITYPUB_HANDLER_PATH=os.path.abspath(os.path.join(SCRIPT_DIR, "activitypub-lmtp.py")),
+        ACTIVITYPUB_HANDLER_MODE=args.handler_mode,
+        ACTIVITYPUB_HANDLER_CONCURRENCY=str(args.handler_concurrency),
+        ACTIVITYPUB_COMMIT_MODE="direct",
+    )
+
+    random.seed(args.seed)
+    kinds = random.choices(list(args.mix), weights=list(args.mix.values()), k=args.messages)
+    messages = [make_message(kind, i, args.size, args.recipients) for i, kind in enumerate(kinds)]
+
+    procs: List[subprocess.Popen] = []
+    sink = subprocess.Popen([sys.executable, os.path.join(BENCH_DIR, "lmtp_stub_sink.py"), "--socket", sink_socket],
+                            env=env, stdout=subprocess.PIPE, text=True)
+    procs.append(sink)
+    try:
+        sink.stdout.readline()   # {"ready": true}
+        server = subprocess.Popen([sys.executable, os.path.join(SCRIPT_DIR, "activitypub_lmtp_server.py")],
+                                  env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        procs.append(server)
+        if not args.no_worker:
+            procs.append(subprocess.Popen(
+                [sys.executable, os.path.join(SCRIPT_DIR, "activitypub-send.py"), "--worker", "--parallel", "4"],
+                env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+        wait_for_port(args.host, args.port)
+
+        before = dir_sizes(data_dir)
+        print(f"sending {len(messages)} messages over {args.sessions} sessions "
+              f"(mix {', '.join(f'{k}={v:.2f}' for k, v in args.mix.items())}, size {args.size})")
+        load = run_load(args, messages)
+
+        # Accepts for the Follows are queued by the handler and sent to the sink by the worker
+        accepts_drained = None
+        if not args.no_worker and "follow" in args.mix:
+            queue_dir = os.path.join(data_dir, "queue")
+            deadline = time.monotonic() + 30
+            time.sleep(0.5)
+            while count_pending(queue_dir) and time.monotonic() < deadline:
+                time.sleep(0.2)
+            accepts_drained = count_pending(queue_dir) == 0
+        after = dir_sizes(data_dir)
+        stages = scrape_stages(args.host, args.metrics_port)
+    finally:
+        for proc in reversed(procs[1:]):
+            proc.terminate()
+        for proc in reversed(procs[1:]):
+            proc.wait(timeout=10)
+        sink.terminate()
+        out, _ = sink.communicate(timeout=10)
+        if not args.data_dir:
+            shutil.rmtree(workdir, ignore_errors=True)
+    lines = [line for line in out.splitlines() if line.strip()]
+    sink_stats = json.loads(lines[-1]) if lines else {}
+    sink_stats.pop("ready", None)
+
+    result = summarise(args, args.mix, load, before, after, sink_stats, accepts_drained, stages)
+    print_result(result)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+        print(f"wrote {args.output}")
+    if args.compare:
+        compare(result, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""Stub LMTP sink that stands in for Dovecot during benchmarks.
+
+Accepts every recipient, discards the message and counts what it received.
+On SIGTERM / SIGINT it prints its counters as one JSON line on stdout::
+
+    python bench/lmtp_stub_sink.py --socket /tmp/bench/lmtp.sock
+    python bench/lmtp_stub_sink.py --host 127.0.0.1 --port 2424
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import signal
+import threading
+import time
+
+from aiosmtpd.controller import Controller, UnixSocketController
+from aiosmtpd.lmtp import LMTP
+
+
+class StubSink:
+    """LMTP handler that discards messages and only counts them."""
+
+    def __init__(self):
+        self.messages = 0
+        self.recipients = 0
+        self.bytes = 0
+        self.first = None
+        self.last = None
+
+    async def handle_DATA(self, server, session, envelope):
+        now = time.time()
+        self.first = self.first or now
+        self.last = now
+        self.messages += 1
+        self.recipients += len(envelope.rcpt_tos)
+        self.bytes += len(envelope.original_content or envelope.content or b"")
+        return "\r\n".join(["250 OK"] * max(1, len(envelope.rcpt_tos)))
+
+    def stats(self):
+        return {"messages": self.messages, "recipients": self.recipients, "bytes": self.bytes,
+                "first": self.first, "last": self.last}
+
+
+def _factory(self):
+    return LMTP(self.handler, decode_data=False, ident="stub-sink")
+
+
+class TCPSinkController(Controller):
+    factory = _factory
+
+
+class UnixSinkController(UnixSocketController):
+    factory = _factory
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Stub LMTP sink (counts and discards messages)")
+    parser.add_argument("--socket", default=None, help="Unix socket to listen on")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=2424)
+    args = parser.parse_args()
+
+    sink = StubSink()
+    if args.socket:
+        if os.path.exists(args.socket):
+            os.unlink(args.socket)
+        controller = UnixSinkController(sink, unix_socket=args.socket)
+    else:
+        controller = TCPSinkController(sink, hostname=args.host, port=args.port)
+    controller.start()
+
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stop.set())
+    signal.signal(signal.SIGINT, lambda *_: stop.set())
+    print(json.dumps({"ready": True}), flush=True)
+    while not stop.wait(0.5):
+        pass
+    controller.stop()
+    print(json.dumps(sink.stats()), flush=True)
+
+
+if __name__ == "__main__":
+    main()
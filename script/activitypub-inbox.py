@@ -1,31 +1,24 @@
 #!/usr/bin/env python3
 from flask import Flask, request, jsonify
-from datetime import datetime
 import os
-import json
 
-LOG_FILE = "/var/log/activitypub-inbox.log"
-DB_FILE = "/var/www/activitypub/inbox.json"
+import activitypub_commit
+from activitypub_log import get_logger, log_path
+from activitypub_store import DATA_DIR, open_store
+
+LOG_FILE = log_path("activitypub-inbox.log")
+DB_FILE = os.path.join(DATA_DIR, "inbox.json")
 
 app = Flask(__name__)
 os.makedirs(os.path.dirname(DB_FILE), exist_ok=True)
 
+logger = get_logger("activitypub-inbox", LOG_FILE)
+
 def log(msg):
-    with open(LOG_FILE, "a") as f:
-        f.write(f"[{datetime.now()}] {msg}\n")
+    logger.info(msg)
 
 def save_to_db(data):
-    if os.path.exists(DB_FILE):
-        with open(DB_FILE, "r") as f:
-            try:
-                db = json.load(f)
-            except:
-                db = []
-    else:
-        db = []
-    db.append(data)
-    with open(DB_FILE, "w") as f:
-        json.dump(db, f, indent=2, ensure_ascii=False)
+    activitypub_commit.append(DB_FILE, data)
 
 @app.route("/inbox", methods=["POST"])
 def inbox():
@@ -40,14 +33,7 @@ def inbox():
 
 @app.route("/inbox", methods=["GET"])
 def list_inbox():
-    if not os.path.exists(DB_FILE):
-        return jsonify([])
-    with open(DB_FILE, "r") as f:
-        try:
-            db = json.load(f)
-        except:
-            db = []
-    return jsonify(db)
+    return jsonify(open_store(DB_FILE).load_all())
 
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=5000)
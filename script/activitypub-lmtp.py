@@ -2,183 +2,276 @@
 import sys
 import os
 import json
-import email
+import uuid
 from email import policy
+from email.parser import BytesFeedParser
 from datetime import datetime
-import subprocess
 
-LOG_FILE = "/var/log/activitypub-lmtp.log"
-INBOX_FILE = "/var/www/activitypub/inbox.json"
-OUTBOX_FILE = "/var/www/activitypub/outbox.json"
-MESSAGES_FILE = "/var/www/activitypub/messages.json"
+import activitypub_commit
+from activitypub_dedup import activity_key, message_keys, open_dedup
+from activitypub_log import get_logger, log_path
+from activitypub_metrics import stage
+from activitypub_profile import PROFILER
+from activitypub_store import DATA_DIR, open_store
+from activitypub_queue import BatchSubmitter
 
-def save_message(activity):
-    """受信したActivityPubメッセージをmessages.jsonに保存"""
-    try:
-        if not os.path.exists(MESSAGES_FILE):
-            with open(MESSAGES_FILE, "w") as f:
-                json.dump([], f, indent=2)
+LOG_FILE = log_path("activitypub-lmtp.log")
+INBOX_FILE = os.path.join(DATA_DIR, "inbox.json")
+OUTBOX_FILE = os.path.join(DATA_DIR, "outbox.json")
+MESSAGES_FILE = os.path.join(DATA_DIR, "messages.json")
+ACCEPT_FROM = "follow@ipcnode.local"
+# 同じメッセージ・activity を別の配送が処理中のときの応答（MTA は後で再送する）
+BUSY_REPLY = "451 4.3.0 Message is being processed, try again later"
+
+# 書き込みはバックグラウンドのリスナーが行う（activitypub_log）。in-process モードではサーバと同じファイルを共有する
+logger = get_logger("activitypub-lmtp-handler", LOG_FILE)
 
-        with open(MESSAGES_FILE, "r") as f:
-            messages = json.load(f)
+READ_CHUNK = 64 * 1024
+# メッセージ全体 / activity JSON 部分の上限（バイト）。超えたものは解析せずに拒否する
+MAX_MESSAGE_BYTES = int(os.environ.get("ACTIVITYPUB_MAX_MESSAGE_BYTES", str(10 * 1024 * 1024)))
+MAX_PAYLOAD_BYTES = int(os.environ.get("ACTIVITYPUB_MAX_PAYLOAD_BYTES", str(1024 * 1024)))
+# ログに残す本文の先頭バイト数と、本文を記録する頻度（N 通に 1 通。0 なら記録しない）
+LOG_BODY_BYTES = int(os.environ.get("ACTIVITYPUB_LOG_BODY_BYTES", "2048"))
+LOG_BODY_SAMPLE = int(os.environ.get("ACTIVITYPUB_LOG_BODY_SAMPLE", "1"))
 
-        messages.append({
-            "timestamp": datetime.utcnow().isoformat() + "Z",
+def save_message(activity):
+    """受信したActivityPubメッセージをmessages.jsonに保存（追記のみ）"""
+    save_messages([activity])
+
+def save_messages(activities):
+    """複数のメッセージを 1 回の追記で messages.json に保存"""
+    now = datetime.utcnow().isoformat() + "Z"
+    try:
+        activitypub_commit.append_many(MESSAGES_FILE, [{
+            "timestamp": now,
             "type": activity.get("type"),
             "actor": activity.get("actor"),
             "object": activity.get("object"),
-        })
-
-        with open(MESSAGES_FILE, "w") as f:
-            json.dump(messages, f, indent=2)
-
+        } for activity in activities])
     except Exception as e:
-        print(f"[ERROR] Could not save message: {e}")
+        logger.error(f"Could not save message: {e}")
 
 def log(msg: str):
-    with open(LOG_FILE, "a") as f:
-        f.write(f"[{datetime.now().isoformat()}] {msg}\n")
+    logger.info(msg)
+
+def log_many(msgs):
+    for msg in msgs:
+        logger.info(msg)
+
+def _accepts_queued(seqs):
+    log(f"Queued {len(seqs)} Accept(s) (outbox seq={seqs[0]}..{seqs[-1]})")
+
+def _accepts_failed(e, count):
+    log(f"Exception while queueing {count} Accept(s): {e}")
+
+# Follow への Accept は短い時間窓でまとめ、outbox への 1 回の追記・1 通のメールにする。
+# 送信は配送キューのワーカーに任せる（LMTP 応答を下流の LMTP サーバの速度に依存させない）。
+# 返信先は Dovecot LMTP ソケットを優先（自己ハンドラ再入によるタイムアウト回避）。無ければ 127.0.0.1:2626
+accept_batcher = BatchSubmitter(OUTBOX_FILE, on_flush=_accepts_queued, on_error=_accepts_failed)
+
+def flush_pending():
+    """時間窓の途中にある Accept を書き込む（プロセス終了前に呼ぶ）"""
+    return accept_batcher.flush()
 
 def load_json(path):
-    if os.path.exists(path):
-        try:
-            with open(path, "r") as f:
-                return json.load(f)
-        except json.JSONDecodeError:
-            return []
-    return []
+    try:
+        return open_store(path).load_all()
+    except (OSError, ValueError):
+        return []
 
 def save_json(path, data):
-    with open(path, "w") as f:
-        json.dump(data, f, indent=2, ensure_ascii=False)
+    # 全件置き換え（O(n)）。1 件追加なら append_json を使う
+    open_store(path).rewrite(data)
+
+def append_json(path, record):
+    # コミットサービスが動いていればまとめて fsync され、永続化してから戻る
+    return activitypub_commit.append(path, record)
 
 def load_inbox():
-    if os.path.exists(INBOX_FILE):
-        with open(INBOX_FILE, "r") as f:
-            try:
-                return json.load(f)
-            except json.JSONDecodeError:
-                return []
-    return []
+    return load_json(INBOX_FILE)
 
 def save_inbox(messages):
-    with open(INBOX_FILE, "w") as f:
-        json.dump(messages, f, indent=2, ensure_ascii=False)
+    save_json(INBOX_FILE, messages)
 
 def load_outbox():
-    if os.path.exists(OUTBOX_FILE):
-        try:
-            with open(OUTBOX_FILE, 'r') as f:
-                data = json.load(f)
-                # ファイルがリストならそのまま返す
-                if isinstance(data, list):
-                    return data
-                # 辞書だったらリスト化
-                elif isinstance(data, dict):
-                    return [data]
-        except Exception as e:
-            log(f"Failed to load outbox: {e}")
+    try:
+        return open_store(OUTBOX_FILE).load_all()
+    except Exception as e:
+        log(f"Failed to load outbox: {e}")
     return []
 
 def save_outbox(activities):
-    with open(OUTBOX_FILE, "w") as f:
-        json.dump(activities, f, indent=2, ensure_ascii=False)
+    save_json(OUTBOX_FILE, activities)
 
-def main():
-    # --- メールを読み取る ---
-    raw_data = sys.stdin.read()
-    log(f"stdin bytes={len(raw_data)}")
+class MessageTooLarge(ValueError):
+    pass
 
-    msg = email.message_from_string(raw_data, policy=policy.default)
+def parse_stream(chunks):
+    """bytes のチャンク列を BytesFeedParser に流し込んで Message を返す。
+
+    MAX_MESSAGE_BYTES を超えた時点で読み込みをやめて MessageTooLarge を送出する。
+    """
+    parser = BytesFeedParser(policy=policy.default)
+    total = 0
+    for chunk in chunks:
+        total += len(chunk)
+        if total > MAX_MESSAGE_BYTES:
+            raise MessageTooLarge(f"message exceeds {MAX_MESSAGE_BYTES} bytes")
+        parser.feed(chunk)
+    return parser.close(), total
+
+def find_payload(msg):
+    """最初の application/activity+json パートの本文を bytes で返す（なければ最初の text/plain）"""
+    fallback = None
+    for part in msg.walk():
+        if part.is_multipart():
+            continue
+        ctype = part.get_content_type()
+        if ctype == "application/activity+json":
+            return part.get_payload(decode=True) or b""
+        if fallback is None and (ctype == "text/plain" or not msg.is_multipart()):
+            fallback = part
+    if fallback is None:
+        return b""
+    return fallback.get_payload(decode=True) or b""
+
+_body_counter = 0
+
+def log_body(body: bytes):
+    """本文は先頭 LOG_BODY_BYTES バイトだけ、LOG_BODY_SAMPLE 通に 1 通だけ記録する"""
+    global _body_counter
+    _body_counter += 1
+    if LOG_BODY_SAMPLE <= 0 or _body_counter % LOG_BODY_SAMPLE:
+        return
+    head = body[:LOG_BODY_BYTES].decode("utf-8", errors="replace")
+    if len(body) > LOG_BODY_BYTES:
+        head += f"\n... (truncated, {len(body)} bytes)"
+    log(f"Body:\n{head}\n")
+
+def handle_message(raw_data) -> str:
+    """RFC822 メッセージを処理して LMTP 応答文字列を返す。
+
+    raw_data は bytes か、bytes のチャンクを返すイテラブル（stdin からの逐次読み込み）。
+    activitypub_lmtp_server.py の in-process モードからはこの関数が直接呼ばれる。
+    ACTIVITYPUB_PROFILE_SAMPLE が設定されていれば N 通に 1 通をプロファイルする（activitypub_profile）。
+    """
+    with PROFILER.sample("handle_message"):
+        return _handle_message(raw_data)
+
+def _handle_message(raw_data) -> str:
+    chunks = [raw_data] if isinstance(raw_data, (bytes, bytearray)) else raw_data
+    try:
+        with stage("mime_parse"):
+            msg, size = parse_stream(chunks)
+    except MessageTooLarge as e:
+        log(f"Rejected: {e}")
+        return "552 5.3.4 Message too big"
+    log(f"stdin bytes={size}")
+
+    # 同じメッセージの再配送（MTA のタイムアウト後の再送など）は保存も再処理もせずに受理する
+    dedup = open_dedup()
+    claimed = []
+    if dedup is not None:
+        keys = message_keys(msg.get("Message-Id"))
+        state = dedup.claim(keys)[0] if keys else True
+        if state is False:
+            log(f"Duplicate message {msg.get('Message-Id')}, acknowledged without storing")
+            return "250 OK Duplicate message ignored"
+        if state is None:
+            log(f"Message {msg.get('Message-Id')} is still being processed, asking for a retry")
+            return BUSY_REPLY
+        claimed += keys
+    try:
+        status = _process(msg, dedup, claimed)
+    except Exception:
+        if dedup is not None:
+            dedup.release(claimed)
+        raise
+    if dedup is not None:
+        # 保存が終わってから確定する（それまでは仮の記録なので、途中で落ちても再送は処理される）
+        if status.startswith("2"):
+            dedup.confirm(claimed)
+        else:
+            dedup.release(claimed)
+    return status
+
+def _process(msg, dedup, claimed) -> str:
+    """handle_message の本体。claimed には新たに記録した重複判定キーを足していく"""
     from_addr = msg.get("From")
     to_addr = msg.get_all("To", [])
     subject = msg.get("Subject")
 
-    # --- 本文を抽出 ---
-    body = ""
-    if msg.is_multipart():
-        for part in msg.walk():
-            if part.get_content_type() == "application/activity+json":
-                body = part.get_content()
-                break
-            elif part.get_content_type() == "text/plain" and not body:
-                body = part.get_content()
-    else:
-        body = msg.get_content()
-
-    log(f"From: {from_addr} To: {to_addr}")
-    log(f"Subject: {subject}")
-    log(f"Body:\n{body}\n")
+    # --- 本文を抽出（デコード済みの bytes のまま。str への変換はしない） ---
+    body = find_payload(msg)
+
+    log_many([f"From: {from_addr} To: {to_addr}", f"Subject: {subject}"])
+    log_body(body)
+
+    if len(body) > MAX_PAYLOAD_BYTES:
+        log(f"Rejected: activity payload {len(body)} bytes exceeds {MAX_PAYLOAD_BYTES}")
+        return "552 5.3.4 Activity payload too big"
 
     # --- ActivityPub JSON として解析 ---
     try:
-        activity = json.loads(body)
+        # bytes から直接デコード（UTF-8/16/32 は json が判別する）
+        with stage("json_decode"):
+            activity = json.loads(body)
         log("Detected ActivityPub JSON payload")
 
-        inbox = load_json(INBOX_FILE)
-        inbox.append({
+        activities = activity if isinstance(activity, list) else [activity]
+        if dedup is not None:
+            # 別のメッセージで届いた同じ activity（送信側の再送で Message-Id が変わった場合）を除く
+            keys = [activity_key(act) for act in activities]
+            fresh = iter(dedup.claim([k for k in keys if k]))
+            keep = [True if k is None else next(fresh) for k in keys]
+            claimed += [k for k, kept in zip(keys, keep) if k and kept]
+            if None in keep:
+                # 同じ activity を別のメッセージが処理中。結果が出るまで MTA に待ってもらう
+                log(f"Activity {[k for k, kept in zip(keys, keep) if kept is None]} is still being processed")
+                return BUSY_REPLY
+            if not any(keep):
+                log(f"Duplicate activity {keys[0] if len(keys) == 1 else keys}, acknowledged without storing")
+                return "250 OK Duplicate activity ignored"
+            if not all(keep):
+                activities = [act for act, kept in zip(activities, keep) if kept]
+                activity = activities if isinstance(activity, list) else activities[0]
+
+        append_json(INBOX_FILE, {
             "timestamp": datetime.now().isoformat(),
             "from": from_addr,
             "to": to_addr,
             "subject": subject,
             "activity": activity
         })
-        save_json(INBOX_FILE, inbox)
 
-        activities = activity if isinstance(activity, list) else [activity]
-        for act in activities:
-            # Follow を受信したら自動で Accept を返信
-            if isinstance(act, dict) and act.get("type") == "Follow":
-                follower_actor = act.get("actor")
-                object_actor = act.get("object")
-                log(f"Follow detected from {follower_actor} → {object_actor}")
-                save_message(act)
-
-                accept_activity = {
+        # Follow を受信したら自動で Accept を返信（メッセージ内の Follow はまとめて処理）
+        follows = [act for act in activities if isinstance(act, dict) and act.get("type") == "Follow"]
+        if follows:
+            log_many(f"Follow detected from {act.get('actor')} → {act.get('object')}" for act in follows)
+            save_messages(follows)
+
+            with stage("accept_generation"):
+                now = datetime.utcnow().isoformat()
+                accepts = [{
                     "@context": "https://www.w3.org/ns/activitystreams",
-                    "id": f"https://ipcnode.local/activities/{datetime.utcnow().timestamp()}",
+                    "id": f"https://ipcnode.local/activities/{uuid.uuid4().hex}",
                     "type": "Accept",
-                    "actor": object_actor,
+                    "actor": act.get("object"),
                     "object": act,
-                    "timestamp": datetime.utcnow().isoformat()
-                }
-
-                outbox = load_outbox()
-                outbox.append(accept_activity)
-                save_outbox(outbox)
-
-                # 返信は Dovecot LMTP ソケットを優先（自己ハンドラ再入によるタイムアウト回避）。無ければ 127.0.0.1:2626
-                socket_path = "/var/run/dovecot/lmtp"
-                base_cmd = [
-                    "/usr/local/bin/activitypub-send.py",
-                    "--from", "follow@ipcnode.local",
-                    "--to", from_addr,
-                    "--outbox", OUTBOX_FILE,
-                ]
-                if os.path.exists(socket_path):
-                    cmd = base_cmd + ["--socket", socket_path]
-                else:
-                    cmd = base_cmd + ["--host", "127.0.0.1", "--port", "2626"]
-                try:
-                    result = subprocess.run(cmd, check=False, capture_output=True, text=True)
-                    log(f"auto-accept send returncode={result.returncode}")
-                    if result.stdout:
-                        for line in result.stdout.splitlines():
-                            log(f"send stdout: {line}")
-                    if result.stderr:
-                        for line in result.stderr.splitlines():
-                            log(f"send stderr: {line}")
-                    if result.returncode == 0:
-                        log(f"Sent Accept for Follow from {follower_actor}")
-                    else:
-                        log("Failed to send Accept")
-                except Exception as e:
-                    log(f"Exception while sending Accept: {e}")
-
-    except json.JSONDecodeError:
+                    "timestamp": now
+                } for act in follows]
+                accept_batcher.add((accept, ACCEPT_FROM, from_addr) for accept in accepts)
+
+    except ValueError:
+        # JSONDecodeError / 不正な UTF-8 の UnicodeDecodeError
         log("No valid JSON found in body, skipping ActivityPub parse.")
 
-    print("250 OK Message received")
+    return "250 OK Message received"
+
+def main():
+    # --- メールを読み取る ---
+    print(handle_message(iter(lambda: sys.stdin.buffer.read(READ_CHUNK), b"")))
+    flush_pending()
 
 if __name__ == "__main__":
     main()
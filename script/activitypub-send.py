@@ -1,113 +1,219 @@
 #!/usr/bin/env python3
 import json
-import socket
 import sys
 import argparse
+import logging
+import os
 from email.message import EmailMessage
 from email.utils import formatdate, make_msgid
 from datetime import datetime
 
-LMTP_SOCKET = "/var/run/dovecot/lmtp"
-OUTBOX_PATH = "/var/www/activitypub/outbox.json"
+from activitypub_store import DATA_DIR
+from activitypub_lmtp_client import LMTP_SOCKET, LMTPClient, LMTPError, get_pool
+from activitypub_metrics import serve as serve_metrics, watch_queue
+from activitypub_outbox import ARCHIVED_UNSENT, FAILED, PENDING, QUEUED, SENT, open_outbox
+from activitypub_queue import QUEUE_DIR, QueueWorker, default_transport, job_seqs, open_queue, submit
 
-def _read_reply(s_file, expected_code):
-    """サーバ応答を読み切って期待コードを検証する（マルチライン対応）。
-    例: 250-... が続き、最後が 250 ... で終わる。
-    """
-    lines = []
-    first = s_file.readline().decode(errors="replace").strip()
-    if not first:
-        raise RuntimeError("LMTP: empty reply")
-    print(first)
-    lines.append(first)
-    # 先頭3桁をコードとして扱う
-    try:
-        code = int(first[:3])
-    except Exception:
-        raise RuntimeError(f"LMTP: invalid reply: {first}")
-
-    # マルチライン: ハイフン継続（例: 250-）
-    cont = first[3:4] == "-"
-    while cont:
-        line = s_file.readline().decode(errors="replace").strip()
-        if not line:
-            raise RuntimeError("LMTP: unexpected EOF in multiline reply")
-        print(line)
-        lines.append(line)
-        # 継続条件は同じコード+ハイフン。終了は同じコード+スペース
-        cont = (line.startswith(f"{code}-"))
-
-    if expected_code is not None and code != expected_code:
-        raise RuntimeError(f"LMTP: unexpected code {code}, expected {expected_code}. First line: {first}")
-    return code, lines
+OUTBOX_PATH = os.path.join(DATA_DIR, "outbox.json")
+
+# send_activity() の送り方
+TRANSPORT_QUEUE = "queue"   # 配送キューに積んで即座に戻る（送信は --worker）
+TRANSPORT_LMTP = "lmtp"     # 共有の LMTP 接続プールでその場で送る
 
 def send_via_lmtp(message_bytes, mail_from, rcpt_to, socket_path=None, host=None, port=None):
-    """LMTPに接続してメッセージ送信（UnixソケットまたはTCP）。"""
-    # 接続方式の決定
-    if host:
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.settimeout(3.0)
-        s.connect((host, port or 24))  # LMTP over TCP の標準ポートは環境依存。明示指定推奨。
+    """LMTPに接続してメッセージ送信（UnixソケットまたはTCP）。1 通だけ送って QUIT する。
+
+    rcpt_to は 1 件でもリストでもよく、宛先ごとの (応答コード, 応答行) を返す。
+    複数通を送る場合は activitypub_lmtp_client.LMTPClient / get_pool() で接続を使い回す。
+    """
+    with LMTPClient(socket_path=socket_path, host=host, port=port, echo=True) as client:
+        return client.send(message_bytes, mail_from, rcpt_to)
+
+def build_message(activity, mail_from, rcpts):
+    """activity を application/activity+json のメールにする。リストなら本文は activity の配列"""
+    msg = EmailMessage()
+    msg["From"] = mail_from
+    msg["To"] = ", ".join(rcpts)
+    if isinstance(activity, list):
+        msg["Subject"] = f"ActivityPub {len(activity)} activities"
     else:
-        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-        s.settimeout(3.0)
-        s.connect(socket_path or LMTP_SOCKET)
-
-    with s:
-        s_file = s.makefile("rwb")
-
-        # 一部の環境では 220 バナーが遅延/省略されることがある。
-        # まずは短時間バナーを待ち、来なければ LHLO を先行送信して応答を解釈する。
-        banner_read = False
-        code = None
-        try:
-            code, _ = _read_reply(s_file, None)
-            banner_read = (code == 220)
-        except Exception as e:
-            # empty reply / timeout 相当は LHLO 先行で再試行
-            banner_read = False
-            code = None
-
-        if not banner_read:
-            # バナー未受信: LHLO を先に送る
-            s_file.write(b"LHLO localhost\r\n"); s_file.flush()
-            code, _ = _read_reply(s_file, None)
-            if code == 220:
-                # ここでサーバがバナーを返してきた場合、改めて LHLO を送る
-                s_file.write(b"LHLO localhost\r\n"); s_file.flush()
-                _read_reply(s_file, 250)
-            elif code == 250:
-                # すでに LHLO に対する 250
-                pass
-            else:
-                raise RuntimeError(f"LMTP: unexpected code after LHLO: {code}")
+        msg["Subject"] = f"ActivityPub {activity.get('type', 'Activity')}"
+    msg["Date"] = formatdate(localtime=True)
+    msg["Message-Id"] = make_msgid()
+
+    payload = json.dumps(activity, ensure_ascii=False, indent=2)
+    # 一旦 text として設定し、その後 Content-Type を上書き
+    msg.set_content(payload, charset="utf-8")
+    msg.replace_header("Content-Type", "application/activity+json; charset=utf-8")
+    return msg.as_bytes()
+
+def rejected(results):
+    """宛先ごとの (応答コード, 応答行) から、一時的な失敗（4xx）と恒久的な失敗（5xx など）の宛先を分ける"""
+    temporary = {r: line for r, (code, line) in results.items() if 400 <= code < 500}
+    permanent = {r: line for r, (code, line) in results.items()
+                 if not 200 <= code < 300 and r not in temporary}
+    return temporary, permanent
+
+def deliver(client, delivery, seq, activity, mail_from, rcpts):
+    """1 件送って配送状態を記録する。全宛先に届いたら True。
+
+    一時的に失敗した宛先（4xx）があれば、その宛先だけを残して pending に戻す（次の --flush で再送）。
+    恒久的に拒否された宛先（5xx）があれば failed にする。
+    """
+    try:
+        results = client.send(build_message(activity, mail_from, rcpts), mail_from, rcpts)
+    except Exception as e:
+        delivery.mark(seq, FAILED, error=str(e))
+        print(f"Error: seq={seq}: {e}")
+        return False
+    temporary, permanent = rejected(results)
+    for rcpt, line in {**temporary, **permanent}.items():
+        print(f"Failed: seq={seq} {rcpt}: {line}")
+    # 前回までに届いた宛先の結果も残す
+    codes = {**((delivery.state(seq) or {}).get("results") or {}),
+             **{r: code for r, (code, _) in results.items()}}
+    if temporary:
+        delivery.mark(seq, PENDING, error="; ".join(temporary.values()), results=codes,
+                      rcpt_to=list(temporary))
+        return False
+    # 恒久的な拒否は前回までの分も含めて判定する
+    failed = {r: code for r, code in codes.items() if not 200 <= code < 300}
+    if failed:
+        delivery.mark(seq, FAILED, error="; ".join(f"{r}: {code}" for r, code in failed.items()),
+                      results=codes)
+        return False
+    delivery.mark(seq, SENT, results=codes)
+    return True
+
+def flush(client, delivery, default_from, default_rcpts):
+    """pending の activity をすべて 1 セッションで送る。送れた件数と失敗件数を返す"""
+    sent = failed = 0
+    archived = delivery.archived_unsent()
+    if archived:
+        # 送る前にアーカイブへ移されたものは送れないので failed にして報告する
+        delivery.mark_many(archived, FAILED, error=ARCHIVED_UNSENT, attempt=False)
+        for seq in archived:
+            print(f"Failed: seq={seq}: {ARCHIVED_UNSENT}")
+        failed += len(archived)
+    for seq, state, activity in delivery.pending():
+        mail_from = state.get("mail_from") or default_from
+        rcpts = state.get("rcpt_to") or default_rcpts
+        if deliver(client, delivery, seq, activity, mail_from, rcpts):
+            sent += 1
         else:
-            # バナー受信済み: 通常の LHLO フロー
-            s_file.write(b"LHLO localhost\r\n"); s_file.flush()
-            _read_reply(s_file, 250)
+            failed += 1
+    return sent, failed
+
+def pool_for(endpoint):
+    """{"socket": ...} または {"host": ..., "port": ...} に対応する共有の接続プール"""
+    endpoint = endpoint or {}
+    return get_pool(socket_path=endpoint.get("socket"), host=endpoint.get("host"), port=endpoint.get("port"))
+
+def send_activity(activity, mail_from, rcpt_to, transport=TRANSPORT_QUEUE, endpoint=None, outbox=OUTBOX_PATH):
+    """activity を outbox に追記して送る（web/app.py などから呼ぶライブラリ API）。
+
+    transport="queue" なら配送キューに積むだけで戻り、"lmtp" なら共有の接続プールで
+    その場で送って配送状態を記録する。endpoint を省略すると Dovecot のソケット、
+    無ければ 127.0.0.1:2626。{"seq": ..., "state": ..., ...}（配送状態）を返す。
+    """
+    delivery = open_outbox(outbox)
+    endpoint = endpoint or default_transport()
+    if transport == TRANSPORT_QUEUE:
+        seq = submit(delivery, open_queue(), activity, mail_from, rcpt_to, endpoint)
+    elif transport == TRANSPORT_LMTP:
+        rcpts = [rcpt_to] if isinstance(rcpt_to, str) else list(rcpt_to)
+        seq = delivery.enqueue(activity, mail_from, rcpts)
+        # 送信中の entry を別プロセスの --flush が拾わないよう、先に queued にしておく
+        delivery.mark(seq, QUEUED, attempt=False)
+        deliver(pool_for(endpoint), delivery, seq, activity, mail_from, rcpts)
+    else:
+        raise ValueError(f"unknown transport: {transport}")
+    return {"seq": seq, **(delivery.state(seq) or {})}
+
+def send_job(job):
+    """配送キューのジョブ 1 件を共有プール経由で送る（失敗は例外）。
+
+    バッチ（seqs）は activity の配列を本文にした 1 通として 1 トランザクションで送る。
+    """
+    delivery = open_outbox(job["outbox"])
+    # 状態の確認は --flush と同じ送信ロックの中で行う。submit_many() がジョブを書いた直後に
+    # 落ちると entry は pending のまま残るので、ここで queued にして --flush に拾わせない
+    with delivery.send_lock():
+        # --flush 等で送信済みのものは除く
+        seqs = [seq for seq in job_seqs(job) if (delivery.state(seq) or {}).get("state") != SENT]
+        stray = [seq for seq in seqs if (delivery.state(seq) or {}).get("state") == PENDING]
+        if stray:
+            delivery.mark_many(stray, QUEUED, attempt=False)
+    first = delivery.outbox.first_seq()
+    archived = [seq for seq in seqs if seq < first]
+    if archived:
+        # 送る前にアーカイブへ移されたものは除いて報告する（on_sent もこれらは sent にしない）
+        delivery.mark_many(archived, FAILED, error=ARCHIVED_UNSENT, attempt=False)
+        logging.getLogger("activitypub-send").error(f"seq {archived} {ARCHIVED_UNSENT}")
+        seqs = [seq for seq in seqs if seq >= first]
+    if not seqs:
+        return {}
+    activities = [delivery.outbox.get(seq) for seq in seqs]
+    activity = activities[0] if "seqs" not in job else activities
+    message = build_message(activity, job["mail_from"], job["rcpt_to"])
+    results = pool_for(job.get("transport")).send(message, job["mail_from"], job["rcpt_to"])
+    codes = {**job.get("results", {}), **{r: code for r, (code, _) in results.items()}}
+    temporary, _ = rejected(results)
+    if temporary:
+        # 再試行は一時的に失敗した宛先だけに送る（QueueWorker は同じ job を再スプールする）
+        job["rcpt_to"] = list(temporary)
+        job["results"] = codes
+        raise LMTPError(f"LMTP: delivery deferred for {', '.join(temporary)}: {'; '.join(temporary.values())}")
+    return codes
+
+def send_seq(client, delivery, seq, mail_from=None, rcpts=None, default_from=None, default_rcpts=None):
+    """outbox の seq 番（None なら最新）を送る。送信済み・送信成功なら True"""
+    count = len(delivery.outbox)
+    if not count:
+        print("No activities in outbox.")
+        return True
+    explicit = seq is not None
+    seq = count - 1 if seq is None else seq
+    try:
+        activity = delivery.outbox.get(seq)
+    except IndexError:
+        print(f"No outbox entry with seq={seq}")
+        return False
+    state = delivery.state(seq) or {}
+    if explicit and state.get("state") == SENT:
+        print(f"seq={seq} already sent.")
+        return True
+    # 宛先は引数 > enqueue 時の記録 > 既定値
+    mail_from = mail_from or state.get("mail_from") or default_from
+    rcpts = rcpts or state.get("rcpt_to") or default_rcpts
+    return deliver(client, delivery, seq, activity, mail_from, rcpts)
 
-        # MAIL FROM 250
-        s_file.write(f"MAIL FROM:<{mail_from}>\r\n".encode()); s_file.flush()
-        _read_reply(s_file, 250)
+def run_worker(queue, parallelism, metrics_port=0):
+    """配送キューを parallelism 並列で処理し続ける。metrics_port を指定すると /metrics を公開する"""
+    logging.basicConfig(level=logging.INFO, format="[%(asctime)s] %(name)s %(levelname)s %(message)s")
+    if metrics_port:
+        watch_queue(queue.directory)
+        serve_metrics(metrics_port)
 
-        # RCPT TO 250
-        s_file.write(f"RCPT TO:<{rcpt_to}>\r\n".encode()); s_file.flush()
-        _read_reply(s_file, 250)
+    def on_sent(job, results):
+        # 恒久的に拒否された宛先（5xx）があれば failed
+        failed = {r: code for r, code in results.items() if not 200 <= code < 300}
+        error = "; ".join(f"{r}: {code}" for r, code in failed.items()) or None
+        delivery = open_outbox(job["outbox"])
+        # アーカイブ済みで送らなかった seq（send_job が failed にした）は除く
+        first = delivery.outbox.first_seq()
+        seqs = [seq for seq in job_seqs(job) if seq >= first]
+        delivery.mark_many(seqs, FAILED if failed else SENT, error=error, results=results)
 
-        # DATA 354
-        s_file.write(b"DATA\r\n"); s_file.flush()
-        _read_reply(s_file, 354)
+    def on_retry(job, error):
+        open_outbox(job["outbox"]).mark_many(job_seqs(job), QUEUED, error=error)
 
-        # Message body -> 250
-        s_file.write(message_bytes + b"\r\n.\r\n"); s_file.flush()
-        _read_reply(s_file, 250)
+    def on_dead(job, error):
+        open_outbox(job["outbox"]).mark_many(job_seqs(job), FAILED, error=error)
 
-        # QUIT 221（サーバによっては即切断する場合があるのでエラーは握りつぶす）
-        try:
-            s_file.write(b"QUIT\r\n"); s_file.flush()
-            _read_reply(s_file, 221)
-        except Exception:
-            pass
+    print(f"[{datetime.now().isoformat()}] queue worker started: {queue.directory} parallelism={parallelism}")
+    QueueWorker(queue, send_job, parallelism=parallelism,
+                on_sent=on_sent, on_retry=on_retry, on_dead=on_dead).run()
 
 def main():
     parser = argparse.ArgumentParser(description="Send ActivityPub activity via LMTP")
@@ -115,59 +221,64 @@ def main():
     parser.add_argument("--socket", default=LMTP_SOCKET, help="LMTP UNIX socket path")
     parser.add_argument("--host", default=None, help="LMTP host (use TCP instead of UNIX socket)")
     parser.add_argument("--port", type=int, default=None, help="LMTP TCP port")
-    parser.add_argument("--from", dest="mail_from", default="follow@ipcnode.local", help="MAIL FROM address")
-    parser.add_argument("--to", dest="rcpt_to", default="alice@ipcnode.local", help="RCPT TO address")
+    parser.add_argument("--from", dest="mail_from", default=None,
+                        help="MAIL FROM address (default: recorded for the entry, else follow@ipcnode.local)")
+    parser.add_argument("--to", dest="rcpt_to", action="append", default=None,
+                        help="RCPT TO address (repeatable: one transaction, one reply per recipient; "
+                             "default: recorded for the entry, else alice@ipcnode.local)")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument("--seq", type=int, default=None, help="send the outbox entry with this sequence number")
+    mode.add_argument("--flush", action="store_true",
+                      help="send every pending outbox entry over one LMTP session")
+    mode.add_argument("--worker", action="store_true",
+                      help="drain the delivery queue with retry/backoff until interrupted")
+    mode.add_argument("--requeue-dead", action="store_true",
+                      help="move dead-lettered jobs back to the delivery queue")
+    mode.add_argument("--activity", default=None,
+                      help="append this activity (JSON, or '-' for stdin) to the outbox and send it")
+    parser.add_argument("--via", choices=[TRANSPORT_QUEUE, TRANSPORT_LMTP], default=TRANSPORT_LMTP,
+                        help="how --activity is sent: now over LMTP (default) or via the delivery queue")
+    parser.add_argument("--parallel", type=int, default=4, help="worker threads for --worker")
+    parser.add_argument("--queue-dir", default=QUEUE_DIR, help="delivery queue spool directory")
+    parser.add_argument("--metrics-port", type=int, default=0,
+                        help="serve Prometheus /metrics on this port in --worker mode (0: off)")
     args = parser.parse_args()
 
-    try:
-        with open(args.outbox, "r") as f:
-            activities = json.load(f)
-    except FileNotFoundError:
-        print(f"outbox not found: {args.outbox}")
-        sys.exit(1)
-
-    if isinstance(activities, list):
-        items = activities
-    elif isinstance(activities, dict):
-        if isinstance(activities.get("orderedItems"), list):
-            items = activities["orderedItems"]
-        elif isinstance(activities.get("items"), list):
-            items = activities["items"]
-        else:
-            items = [activities]
-    else:
-        items = []
-
-    if not items:
-        print("No activities in outbox.")
+    if args.worker:
+        run_worker(open_queue(args.queue_dir), args.parallel, args.metrics_port)
         return
+    if args.requeue_dead:
+        print(f"Requeued: {open_queue(args.queue_dir).requeue_dead()}")
+        return
+    default_from = "follow@ipcnode.local"
+    default_rcpts = ["alice@ipcnode.local"]
 
-    latest = items[-1]
-    msg = EmailMessage()
-    msg["From"] = args.mail_from
-    msg["To"] = args.rcpt_to
-    msg["Subject"] = f"ActivityPub {latest.get('type', 'Activity')}"
-    msg["Date"] = formatdate(localtime=True)
-    msg["Message-Id"] = make_msgid()
-
-    payload = json.dumps(latest, ensure_ascii=False, indent=2)
-    # 一旦 text として設定し、その後 Content-Type を上書き
-    msg.set_content(payload, charset="utf-8")
-    msg.replace_header("Content-Type", "application/activity+json; charset=utf-8")
+    if args.activity is not None:
+        activity = json.load(sys.stdin) if args.activity == "-" else json.loads(args.activity)
+        endpoint = {"host": args.host, "port": args.port} if args.host else {"socket": args.socket}
+        result = send_activity(activity, args.mail_from or default_from, args.rcpt_to or default_rcpts,
+                               transport=args.via, endpoint=endpoint, outbox=args.outbox)
+        print(json.dumps(result, ensure_ascii=False))
+        if result.get("state") == FAILED:
+            sys.exit(1)
+        return
 
+    delivery = open_outbox(args.outbox)
+    client = LMTPClient(socket_path=args.socket, host=args.host, port=args.port, echo=True)
     print(f"[{datetime.now().isoformat()}] Sending via LMTP...")
-    try:
-        send_via_lmtp(
-            msg.as_bytes(),
-            mail_from=args.mail_from,
-            rcpt_to=args.rcpt_to,
-            socket_path=args.socket,
-            host=args.host,
-            port=args.port,
-        )
-    except Exception as e:
-        print(f"Error: {e}")
-        sys.exit(1)
+
+    with delivery.send_lock(), client:
+        if args.flush:
+            sent, failed = flush(client, delivery, args.mail_from or default_from,
+                                 args.rcpt_to or default_rcpts)
+            print(f"Flushed: sent={sent} failed={failed}")
+            if failed:
+                sys.exit(1)
+            return
+        # --seq 指定がなければ末尾（最新）の 1 件。outbox 全体は読み込まない
+        if not send_seq(client, delivery, args.seq, args.mail_from, args.rcpt_to,
+                        default_from, default_rcpts):
+            sys.exit(1)
     print("Done.")
 
 if __name__ == "__main__":
@@ -0,0 +1,376 @@
+#!/usr/bin/env python3
+"""Retention for the activity stores: rotation, compressed archives and queries.
+
+The live store keeps a hot window (the last ``ACTIVITYPUB_RETENTION_DAYS`` days,
+optionally capped at ``ACTIVITYPUB_RETENTION_MAX_BYTES``). Older chunks (sealed
+JSONL segments, or ranges of rows with the SQLite backend) are moved into a
+compressed archive next to the store::
+
+    inbox.archive/
+        manifest.json                        one entry per archive file (seq range,
+                                             timestamps, sizes, codec)
+        000000000000-000000004710.jsonl.gz   the original JSONL lines, gzip or lzma
+        ...
+
+An archive file is written and listed in the manifest before the chunk is
+removed from the live store, so an interrupted run is finished by the next one.
+Sequence numbers do not change; readers of the live store (the web app, the
+thread index) simply see it start at ``first_seq()``. History is read through
+:class:`Archive` (``/api/inbox?history=1`` or this module's CLI)::
+
+    python activitypub_archive.py archive --keep-days 30 --codec lzma
+    python activitypub_archive.py archive --every 3600          # keep running
+    python activitypub_archive.py list
+    python activitypub_archive.py compact --target-bytes 268435456
+    python activitypub_archive.py query --store inbox --type Follow --since 2024-01-01
+"""
+from __future__ import annotations
+
+import gzip
+import json
+import logging
+import lzma
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from activitypub_outbox import open_outbox
+from activitypub_store import DATA_DIR, _encode, _matches, open_store, record_fields
+
+RETENTION_DAYS = float(os.environ.get("ACTIVITYPUB_RETENTION_DAYS", "30"))
+RETENTION_MAX_BYTES = int(os.environ.get("ACTIVITYPUB_RETENTION_MAX_BYTES", "0"))   # 0 なら容量では切らない
+SEGMENT_MAX_AGE = float(os.environ.get("ACTIVITYPUB_SEGMENT_MAX_AGE", "86400"))     # 秒。古くなったセグメントを閉じる
+ARCHIVE_CODEC = os.environ.get("ACTIVITYPUB_ARCHIVE_CODEC", "gzip")                 # "gzip" または "lzma"
+COMPACT_TARGET_BYTES = 256 * 1024 * 1024
+STORES = ("inbox", "outbox", "messages")   # 配送状態ログ（outbox-delivery）は対象外
+
+CODECS = {
+    "gzip": (".jsonl.gz", lambda path, mode: gzip.open(path, mode, compresslevel=6)),
+    "lzma": (".jsonl.xz", lambda path, mode: lzma.open(path, mode, preset=6 if "w" in mode else None)),
+}
+MANIFEST = "manifest.json"
+
+logger = logging.getLogger("activitypub-archive")
+
+
+def _iso_prefix(value: Optional[str]) -> str:
+    # "2024-05-01T12:00:00.123Z" と "2024-05-01T12:00:00.123456" を比べられるよう秒までにそろえる
+    return (value or "")[:19]
+
+
+def _record_ts(record: Any) -> str:
+    return _iso_prefix(record_fields(record)["timestamp"])
+
+
+class Archive:
+    """1 つのストアのアーカイブ（manifest.json と圧縮済み JSONL ファイル）"""
+
+    def __init__(self, store_path: str):
+        self.store_path = str(store_path)
+        base = self.store_path[:-5] if self.store_path.endswith(".json") else self.store_path
+        self.directory = base + ".archive"
+        self.manifest_path = os.path.join(self.directory, MANIFEST)
+        self._lock = threading.Lock()
+
+    # --- manifest -----------------------------------------------------------
+
+    def entries(self) -> List[Dict[str, Any]]:
+        try:
+            with open(self.manifest_path) as f:
+                return json.load(f).get("archives", [])
+        except (OSError, ValueError):
+            return []
+
+    def _save(self, entries: List[Dict[str, Any]]) -> None:
+        entries = sorted(entries, key=lambda e: e["first_seq"])
+        tmp = self.manifest_path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({"version": 1, "archives": entries}, f, ensure_ascii=False, indent=1)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.manifest_path)
+
+    def version(self) -> str:
+        try:
+            return f"{os.stat(self.manifest_path).st_mtime_ns:x}"
+        except FileNotFoundError:
+            return "0"
+
+    def end_seq(self) -> int:
+        """アーカイブ済みの最後の seq + 1"""
+        entries = self.entries()
+        return max((e["first_seq"] + e["count"] for e in entries), default=0)
+
+    # --- writing ------------------------------------------------------------
+
+    def _write(self, rows: List[Tuple[int, Any]], codec: str) -> Dict[str, Any]:
+        """rows（seq 連続）を 1 つの圧縮ファイルにし、manifest 用のエントリを返す"""
+        suffix, opener = CODECS[codec]
+        first, last = rows[0][0], rows[-1][0]
+        name = f"{first:012d}-{last:012d}{suffix}"
+        path = os.path.join(self.directory, name)
+        tmp = path + ".tmp"
+        raw = 0
+        timestamps = []
+        with opener(tmp, "wb") as f:
+            for _, record in rows:
+                line = _encode(record)
+                raw += len(line)
+                f.write(line)
+                ts = _record_ts(record)
+                if ts:
+                    timestamps.append(ts)
+        with open(tmp, "rb") as f:
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+        return {
+            "file": name, "codec": codec, "first_seq": first, "count": last - first + 1,
+            "first_ts": min(timestamps, default=None), "last_ts": max(timestamps, default=None),
+            "bytes": raw, "stored_bytes": os.path.getsize(path),
+            "created": datetime.utcnow().isoformat() + "Z",
+        }
+
+    def add(self, rows: List[Tuple[int, Any]], codec: str = ARCHIVE_CODEC) -> Dict[str, Any]:
+        os.makedirs(self.directory, exist_ok=True)
+        with self._lock:
+            entry = self._write(rows, codec)
+            entries = [e for e in self.entries() if e["file"] != entry["file"]]
+            self._save(entries + [entry])
+        return entry
+
+    def compact(self, target_bytes: int = COMPACT_TARGET_BYTES, codec: Optional[str] = None) -> int:
+        """連続する小さなアーカイブを target_bytes（非圧縮）程度の 1 ファイルにまとめる。まとめた数を返す"""
+        with self._lock:
+            entries = sorted(self.entries(), key=lambda e: e["first_seq"])
+            groups: List[List[Dict[str, Any]]] = []
+            for entry in entries:
+                group = groups[-1] if groups else None
+                if (group and sum(e["bytes"] for e in group) + entry["bytes"] <= target_bytes
+                        and group[-1]["first_seq"] + group[-1]["count"] == entry["first_seq"]):
+                    group.append(entry)
+                else:
+                    groups.append([entry])
+            merged = 0
+            result: List[Dict[str, Any]] = []
+            obsolete: List[str] = []
+            for group in groups:
+                new_codec = codec or group[0]["codec"]
+                if len(group) == 1 and group[0]["codec"] == new_codec:
+                    result.append(group[0])
+                    continue
+                new = self._write([row for entry in group for row in self._rows(entry)], new_codec)
+                result.append(new)
+                merged += len(group)
+                obsolete.extend(e["file"] for e in group if e["file"] != new["file"])
+            # 新しいファイルを manifest に載せてから古いファイルを消す
+            self._save(result)
+            for name in obsolete:
+                try:
+                    os.unlink(os.path.join(self.directory, name))
+                except FileNotFoundError:
+                    pass
+            return merged
+
+    # --- reading ------------------------------------------------------------
+
+    def _rows(self, entry: Dict[str, Any]) -> Iterator[Tuple[int, Any]]:
+        _, opener = CODECS[entry["codec"]]
+        with opener(os.path.join(self.directory, entry["file"]), "rb") as f:
+            for seq, line in enumerate(f, start=entry["first_seq"]):
+                yield seq, json.loads(line)
+
+    def iter_from(self, start: int = 0, stop: Optional[int] = None) -> Iterator[Tuple[int, Any]]:
+        for entry in sorted(self.entries(), key=lambda e: e["first_seq"]):
+            lo, hi = entry["first_seq"], entry["first_seq"] + entry["count"]
+            if hi <= start or (stop is not None and lo >= stop):
+                continue
+            for seq, record in self._rows(entry):
+                if seq >= start and (stop is None or seq < stop):
+                    yield seq, record
+
+    def query(self, type: Optional[str] = None, actor: Optional[str] = None,
+              since: Optional[str] = None, until: Optional[str] = None,
+              newest_first: bool = False, limit: Optional[int] = None,
+              after: Optional[int] = None, before: Optional[int] = None,
+              match: Optional[Callable[[Any], bool]] = None) -> List[Tuple[int, Any]]:
+        """JsonlStore.query と同じ条件で絞り込む。manifest の seq / 時刻の範囲で対象ファイルを減らす。
+
+        match を渡すとそれが真を返すレコードだけにする（索引のない条件の絞り込み用）。
+        """
+        entries = sorted(self.entries(), key=lambda e: e["first_seq"], reverse=newest_first)
+        rows: List[Tuple[int, Any]] = []
+        for entry in entries:
+            lo, hi = entry["first_seq"], entry["first_seq"] + entry["count"]
+            if (after is not None and hi <= after + 1) or (before is not None and lo >= before):
+                continue
+            if since and entry.get("last_ts") and entry["last_ts"] < _iso_prefix(since):
+                continue
+            if until and entry.get("first_ts") and entry["first_ts"] >= _iso_prefix(until):
+                continue
+            matched = [(seq, r) for seq, r in self._rows(entry)
+                       if (after is None or seq > after) and (before is None or seq < before)
+                       and _matches(r, type, actor, since, until) and (match is None or match(r))]
+            if newest_first:
+                matched.reverse()
+            rows.extend(matched)
+            if limit is not None and len(rows) >= limit:
+                break
+        return rows[:limit] if limit is not None else rows
+
+
+_ARCHIVES: Dict[str, Archive] = {}
+_ARCHIVES_LOCK = threading.Lock()
+
+
+def open_archive(store_path) -> Archive:
+    key = os.path.abspath(str(store_path))
+    with _ARCHIVES_LOCK:
+        archive = _ARCHIVES.get(key)
+        if archive is None:
+            archive = _ARCHIVES[key] = Archive(key)
+        return archive
+
+
+def _first_ts(store, start: int) -> str:
+    try:
+        return _record_ts(store.get(start))
+    except IndexError:
+        return ""
+
+
+def _unsent_from(path) -> Optional[int]:
+    """outbox なら、まだ送り終えていない最も古い seq（それ以降はアーカイブしない）"""
+    base = str(path)[:-5] if str(path).endswith(".json") else str(path)
+    if os.path.basename(base) != "outbox":
+        return None
+    return open_outbox(path).oldest_unsent()
+
+
+def archive_store(path, keep_days: float = RETENTION_DAYS, max_bytes: int = RETENTION_MAX_BYTES,
+                  codec: str = ARCHIVE_CODEC, segment_max_age: float = SEGMENT_MAX_AGE,
+                  now: Optional[datetime] = None) -> Dict[str, Any]:
+    """ホットウィンドウより古いチャンクをアーカイブへ移し、結果（件数など）を返す"""
+    store = open_store(path)
+    archive = open_archive(path)
+    now = now or datetime.now()
+    cutoff = _iso_prefix((now - timedelta(days=keep_days)).isoformat())
+
+    # 前回の実行がアーカイブ後・削除前に中断していたら、その分をライブストアから消す
+    done = archive.end_seq()
+    if done > store.first_seq():
+        store.discard_before(done)
+
+    # 古くなった追記中セグメントを閉じる（次回以降アーカイブの対象になる）
+    rotated = False
+    if segment_max_age > 0 and len(store) > store.first_seq():
+        chunks = store.chunks()
+        active = chunks[-1][1] if chunks else store.first_seq()
+        born = _first_ts(store, active) if active < len(store) else ""
+        age_cutoff = _iso_prefix((now - timedelta(seconds=segment_max_age)).isoformat())
+        if born and born < age_cutoff:
+            rotated = store.rotate()
+
+    live = store.live_bytes()
+    archived = files = 0
+    unsent = _unsent_from(path)
+    for start, end in store.chunks():
+        if end <= start:
+            continue
+        if unsent is not None and end > unsent:
+            break   # pending / queued の entry を含むチャンクは送り終えるまでライブストアに残す
+        last_ts = _first_ts(store, end - 1)
+        too_old = bool(last_ts) and last_ts < cutoff
+        too_big = max_bytes > 0 and live > max_bytes
+        if not (too_old or too_big):
+            break   # 古い順に連続して移す
+        size = store.chunk_bytes(start)
+        rows = list(store.iter_from(start, end))
+        if rows:
+            entry = archive.add(rows, codec)
+            logger.info(f"archived {path} seq {start}..{end - 1} -> {entry['file']} "
+                        f"({entry['bytes']} -> {entry['stored_bytes']} bytes)")
+        store.discard_before(end)
+        archived += end - start
+        files += 1
+        live -= size
+    return {"store": str(path), "archived": archived, "files": files, "rotated": rotated,
+            "first_live_seq": store.first_seq(), "live_bytes": store.live_bytes()}
+
+
+def store_path(name: str) -> str:
+    return name if name.endswith(".json") or os.sep in name else os.path.join(DATA_DIR, f"{name}.json")
+
+
+def main() -> None:
+    import argparse
+    parser = argparse.ArgumentParser(description="Retention and archives for the ActivityPub stores")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("archive", help="move chunks older than the hot window into compressed archives")
+    p.add_argument("--store", action="append", default=None, help=f"store name or path (default: {', '.join(STORES)})")
+    p.add_argument("--keep-days", type=float, default=RETENTION_DAYS, help="hot window in days")
+    p.add_argument("--max-bytes", type=int, default=RETENTION_MAX_BYTES,
+                   help="also archive the oldest chunks while the live JSONL store is larger than this")
+    p.add_argument("--codec", choices=sorted(CODECS), default=ARCHIVE_CODEC)
+    p.add_argument("--segment-max-age", type=float, default=SEGMENT_MAX_AGE,
+                   help="seal the active segment once its first record is this many seconds old")
+    p.add_argument("--every", type=float, default=0, help="repeat every N seconds (0: run once)")
+
+    p = sub.add_parser("list", help="show the archive manifests")
+    p.add_argument("--store", action="append", default=None)
+
+    p = sub.add_parser("compact", help="merge small adjacent archives (optionally re-compressing)")
+    p.add_argument("--store", action="append", default=None)
+    p.add_argument("--target-bytes", type=int, default=COMPACT_TARGET_BYTES, help="uncompressed size per file")
+    p.add_argument("--codec", choices=sorted(CODECS), default=None)
+
+    p = sub.add_parser("query", help="print matching archived (and optionally live) records as JSONL")
+    p.add_argument("--store", default="inbox")
+    p.add_argument("--type", default=None)
+    p.add_argument("--actor", default=None)
+    p.add_argument("--since", default=None, help="ISO timestamp (inclusive)")
+    p.add_argument("--until", default=None, help="ISO timestamp (exclusive)")
+    p.add_argument("--limit", type=int, default=None)
+    p.add_argument("--newest-first", action="store_true")
+    p.add_argument("--include-live", action="store_true", help="also search the live store")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="[%(asctime)s] %(name)s %(levelname)s %(message)s")
+    names = getattr(args, "store", None)
+    paths = [store_path(n) for n in ([names] if isinstance(names, str) else names or STORES)]
+
+    if args.command == "archive":
+        while True:
+            for path in paths:
+                print(json.dumps(archive_store(path, args.keep_days, args.max_bytes, args.codec,
+                                               args.segment_max_age), ensure_ascii=False), flush=True)
+            if not args.every:
+                break
+            time.sleep(args.every)
+    elif args.command == "list":
+        for path in paths:
+            entries = open_archive(path).entries()
+            print(f"{path}: {len(entries)} archive(s), {sum(e['count'] for e in entries)} records, "
+                  f"{sum(e['bytes'] for e in entries)} -> {sum(e['stored_bytes'] for e in entries)} bytes")
+            for e in entries:
+                print(f"    {e['file']:<44} {e['count']:>8} records  {e['first_ts']} .. {e['last_ts']}  "
+                      f"{e['stored_bytes']} bytes ({e['codec']})")
+    elif args.command == "compact":
+        for path in paths:
+            print(f"{path}: merged {open_archive(path).compact(args.target_bytes, args.codec)} archive(s)")
+    elif args.command == "query":
+        path = paths[0]
+        filters = {"type": args.type, "actor": args.actor, "since": args.since, "until": args.until}
+        rows = open_archive(path).query(**filters, newest_first=args.newest_first)
+        if args.include_live:
+            live = open_store(path).query(**filters, newest_first=args.newest_first)
+            rows = live + rows if args.newest_first else rows + live
+        for seq, record in rows[:args.limit] if args.limit is not None else rows:
+            print(json.dumps({"_seq": seq, **record} if isinstance(record, dict) else {"_seq": seq, "value": record},
+                             ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+"""Single-writer group-commit service for the activity stores.
+
+The LMTP handler, the web app and activitypub-inbox.py all append to the same
+stores. Instead of each writer taking the store lock and paying for its own
+``fsync``, writers can hand their records to one commit process over a Unix
+socket. The commit thread collects requests for up to ``COMMIT_MAX_LATENCY``
+seconds (or ``COMMIT_BATCH_SIZE`` records), appends each store's share with a
+single ``append_many`` and one ``fsync`` per file, and only then acknowledges
+every request in the batch::
+
+    client -> {"path": "/var/www/activitypub/inbox.json", "records": [...]}\\n
+    server <- {"seqs": [41, 42]}\\n          (or {"error": "..."})
+
+Writers call :func:`append` / :func:`append_many`. With the default
+``ACTIVITYPUB_COMMIT_MODE=auto`` they use the service when its socket exists and
+fall back to a direct (locked, non-fsync'd) append otherwise, so the scripts
+keep working without it.
+
+Run the service with ``python activitypub_commit.py``.
+"""
+from __future__ import annotations
+
+import json
+import logging
+import os
+import queue
+import select
+import socket
+import socketserver
+import threading
+import time
+from typing import Any, Dict, Iterable, List, Optional
+
+from activitypub_log import get_logger
+from activitypub_metrics import count, stage
+from activitypub_store import DATA_DIR, open_store
+
+COMMIT_SOCKET = os.environ.get("ACTIVITYPUB_COMMIT_SOCKET", os.path.join(DATA_DIR, "commit.sock"))
+# "auto": ソケットがあればサービス経由、なければ直接追記 / "service": 必ずサービス経由 / "direct": 使わない
+COMMIT_MODE = os.environ.get("ACTIVITYPUB_COMMIT_MODE", "auto")
+COMMIT_BATCH_SIZE = int(os.environ.get("ACTIVITYPUB_COMMIT_BATCH_SIZE", "512"))          # 1 回の fsync でまとめる最大レコード数
+COMMIT_MAX_LATENCY = float(os.environ.get("ACTIVITYPUB_COMMIT_MAX_LATENCY", "0.005"))    # 最初の要求からコミットまで待つ最大秒数
+COMMIT_TIMEOUT = 30.0
+
+logger = logging.getLogger("activitypub-commit")
+
+
+class CommitError(RuntimeError):
+    pass
+
+
+class _Request:
+    __slots__ = ("path", "records", "seqs", "error", "done")
+
+    def __init__(self, path: str, records: List[Any]):
+        self.path = path
+        self.records = records
+        self.seqs: Optional[List[int]] = None
+        self.error: Optional[str] = None
+        self.done = threading.Event()
+
+
+class GroupCommitter:
+    """要求をまとめて追記し、ストアごとに 1 回だけ fsync してから全員に応答する。"""
+
+    def __init__(self, batch_size: int = COMMIT_BATCH_SIZE, max_latency: float = COMMIT_MAX_LATENCY):
+        self.batch_size = max(1, batch_size)
+        self.max_latency = max_latency
+        self.requests: "queue.Queue[_Request]" = queue.Queue()
+        self.batches = 0
+        self.records = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="group-commit", daemon=True)
+
+    def start(self) -> "GroupCommitter":
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._thread.join(timeout=5)
+
+    def submit(self, path: str, records: List[Any]) -> List[int]:
+        """コミット（fsync）が終わるまで待って seq を返す"""
+        request = _Request(os.path.abspath(path), records)
+        self.requests.put(request)
+        if not request.done.wait(COMMIT_TIMEOUT):
+            raise CommitError("commit timed out")
+        if request.error:
+            raise CommitError(request.error)
+        return request.seqs or []
+
+    def _collect(self, first: _Request) -> List[_Request]:
+        batch = [first]
+        count = len(first.records)
+        deadline = time.monotonic() + self.max_latency
+        while count < self.batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                request = self.requests.get(timeout=remaining) if remaining > 0 else self.requests.get_nowait()
+            except queue.Empty:
+                break
+            batch.append(request)
+            count += len(request.records)
+        return batch
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            try:
+                first = self.requests.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            self.commit(self._collect(first))
+
+    def commit(self, batch: List[_Request]) -> None:
+        by_path: Dict[str, List[_Request]] = {}
+        for request in batch:
+            by_path.setdefault(request.path, []).append(request)
+        for path, requests in by_path.items():
+            records = [r for request in requests for r in request.records]
+            try:
+                seqs = open_store(path).append_many(records, fsync=True)
+            except Exception as e:
+                logger.exception(f"commit failed for {path}: {e}")
+                for request in requests:
+                    request.error = str(e) or e.__class__.__name__
+                continue
+            pos = 0
+            for request in requests:
+                request.seqs = seqs[pos:pos + len(request.records)]
+                pos += len(request.records)
+        self.batches += 1
+        self.records += sum(len(r.records) for r in batch)
+        for request in batch:
+            request.done.set()
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self) -> None:
+        committer: GroupCommitter = self.server.committer  # type: ignore[attr-defined]
+        for line in self.rfile:
+            try:
+                message = json.loads(line)
+                seqs = committer.submit(message["path"], list(message["records"]))
+                reply: Dict[str, Any] = {"seqs": seqs}
+            except Exception as e:
+                reply = {"error": str(e) or e.__class__.__name__}
+            self.wfile.write(json.dumps(reply).encode() + b"\n")
+            self.wfile.flush()
+
+
+class CommitServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+    request_queue_size = 128   # LMTP ワーカー・Web ワーカーが一斉に接続してくる
+
+    def __init__(self, socket_path: str = COMMIT_SOCKET, committer: Optional[GroupCommitter] = None):
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)  # 前回のプロセスが残したソケット
+        self.committer = committer or GroupCommitter()
+        super().__init__(socket_path, _Handler)
+        os.chmod(socket_path, 0o666)
+
+    def server_close(self) -> None:
+        super().server_close()
+        try:
+            os.unlink(self.server_address)
+        except OSError:
+            pass
+
+
+class CommitClient:
+    """コミットサービスへの接続（スレッドごとに 1 本）"""
+
+    def __init__(self, socket_path: str = COMMIT_SOCKET, timeout: float = COMMIT_TIMEOUT):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _file(self):
+        f = getattr(self._local, "file", None)
+        if f is not None and select.select([self._local.sock], [], [], 0)[0]:
+            # サーバは要求なしに何も送らないので、読めるなら切断済み（サービスの再起動など）
+            self._reset()
+            f = None
+        if f is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            try:
+                sock.connect(self.socket_path)
+            except OSError:
+                sock.close()
+                raise
+            f = self._local.file = sock.makefile("rwb")
+            self._local.sock = sock
+        return f
+
+    def _reset(self) -> None:
+        for name in ("file", "sock"):
+            obj = getattr(self._local, name, None)
+            if obj is not None:
+                try:
+                    obj.close()
+                except OSError:
+                    pass
+                setattr(self._local, name, None)
+
+    def append_many(self, path: str, records: List[Any]) -> List[int]:
+        """永続化されるまで待って seq を返す"""
+        f = self._file()
+        try:
+            f.write(json.dumps({"path": os.path.abspath(str(path)), "records": records},
+                               ensure_ascii=False).encode() + b"\n")
+            f.flush()
+            line = f.readline()
+        except OSError as e:
+            # 送信後の失敗は書き込まれたかどうか分からないので再送も直接書き込みもしない
+            self._reset()
+            raise CommitError(f"commit service connection lost: {e}") from e
+        if not line:
+            self._reset()
+            raise CommitError("commit service closed the connection")
+        reply = json.loads(line)
+        if "error" in reply:
+            raise CommitError(reply["error"])
+        return reply["seqs"]
+
+
+_CLIENT: Optional[CommitClient] = None
+
+
+def _client() -> Optional[CommitClient]:
+    global _CLIENT
+    if COMMIT_MODE == "direct" or (COMMIT_MODE == "auto" and not os.path.exists(COMMIT_SOCKET)):
+        return None
+    if _CLIENT is None:
+        _CLIENT = CommitClient()
+    return _CLIENT
+
+
+def append_many(path, records: Iterable[Any]) -> List[int]:
+    """path のストアに追記して seq を返す。サービス経由なら fsync 済みで戻る"""
+    records = list(records)
+    if not records:
+        return []
+    count("store_commit", len(records))
+    with stage("store_commit"):
+        client = _client()
+        if client is not None:
+            try:
+                return client.append_many(str(path), records)
+            except (ConnectionError, FileNotFoundError) as e:
+                # サービスに接続できないときだけ直接書く（送信後の失敗は CommitError）
+                if COMMIT_MODE == "service":
+                    raise
+                logger.warning(f"commit service unavailable ({e}); appending directly")
+        return open_store(path).append_many(records)
+
+
+def append(path, record: Any) -> int:
+    return append_many(path, [record])[0]
+
+
+def main() -> None:
+    import argparse
+    parser = argparse.ArgumentParser(description="Group-commit writer for the ActivityPub stores")
+    parser.add_argument("--socket", default=COMMIT_SOCKET, help="Unix socket to listen on")
+    parser.add_argument("--batch-size", type=int, default=COMMIT_BATCH_SIZE,
+                        help="max records per commit (one fsync per store per commit)")
+    parser.add_argument("--max-latency", type=float, default=COMMIT_MAX_LATENCY,
+                        help="max seconds to wait for more writes after the first one")
+    args = parser.parse_args()
+
+    get_logger("activitypub-commit", "activitypub-commit.log", console=True)
+    committer = GroupCommitter(args.batch_size, args.max_latency).start()
+    server = CommitServer(args.socket, committer)
+    logger.info(f"commit service listening on {args.socket} "
+                f"(batch_size={committer.batch_size}, max_latency={committer.max_latency}s)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logger.info("commit service stopping")
+    finally:
+        server.server_close()
+        committer.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,219 @@
+"""Ingest-time deduplication of redelivered messages and activities.
+
+MTAs redeliver a message when the LMTP reply does not arrive in time, and the
+queue worker rebuilds the mail (with a new ``Message-Id``) when it retries an
+activity. Without a guard every redelivery is appended to the inbox again and
+may trigger another Accept.
+
+:class:`DedupIndex` remembers the keys of everything ingested for
+``DEDUP_TTL`` seconds::
+
+    msgid:<Message-Id header>
+    id:<activity id / Envelope envelope_id>
+
+The exact record lives in a small SQLite database (``dedup.sqlite3``, WAL
+mode) shared by all handler processes. An in-memory Bloom filter in front of it
+answers "definitely new" for the common case, so only keys that *may* have been
+seen cost a lookup. A key is claimed with a single upsert, which is atomic
+across processes. A fresh claim is only a lease (``DEDUP_LEASE`` seconds): it is
+confirmed for the full TTL once the message has been stored, and released if
+processing fails. If the handler dies in between, the lease simply runs out, so
+the MTA's retry is processed instead of being mistaken for a duplicate.
+"""
+from __future__ import annotations
+
+import hashlib
+import math
+import os
+import sqlite3
+import threading
+import time
+from typing import Iterable, List, Optional
+
+from activitypub_store import DATA_DIR
+
+DEDUP_ENABLED = os.environ.get("ACTIVITYPUB_DEDUP", "1") not in ("0", "false", "no")
+DEDUP_DB = os.environ.get("ACTIVITYPUB_DEDUP_DB", os.path.join(DATA_DIR, "dedup.sqlite3"))
+DEDUP_TTL = float(os.environ.get("ACTIVITYPUB_DEDUP_TTL", str(7 * 24 * 3600)))     # 秒
+DEDUP_LEASE = float(os.environ.get("ACTIVITYPUB_DEDUP_LEASE", "300"))             # 秒。処理中の仮の記録の有効期限
+DEDUP_CAPACITY = int(os.environ.get("ACTIVITYPUB_DEDUP_CAPACITY", "1000000"))     # Bloom フィルタの想定キー数
+DEDUP_ERROR_RATE = 0.001
+PURGE_INTERVAL = 3600.0   # 期限切れの行を消す間隔（秒）
+
+
+class BloomFilter:
+    """誤検出率 error_rate で capacity 件を保持する Bloom フィルタ（偽陰性なし）"""
+
+    def __init__(self, capacity: int = DEDUP_CAPACITY, error_rate: float = DEDUP_ERROR_RATE):
+        capacity = max(1, capacity)
+        self.capacity = capacity
+        self.size = max(8, int(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key: str) -> List[int]:
+        # ダブルハッシュ法: h1 + i * h2
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, key: str) -> None:
+        for pos in self._positions(key):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, key: str) -> bool:
+        bits = self.bits
+        return all(bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(key))
+
+
+def message_keys(message_id: Optional[str]) -> List[str]:
+    return [f"msgid:{message_id.strip()}"] if message_id and message_id.strip() else []
+
+
+def activity_key(activity) -> Optional[str]:
+    """activity（または Envelope の dict）の重複判定キー。id がなければ None"""
+    activity_id = activity.get("id") if isinstance(activity, dict) else None
+    return f"id:{activity_id}" if isinstance(activity_id, str) and activity_id else None
+
+
+class DedupIndex:
+    """取り込み済みキーの索引（メモリ上の Bloom フィルタ + SQLite の正確な記録）。"""
+
+    def __init__(self, path: str = DEDUP_DB, ttl: float = DEDUP_TTL,
+                 capacity: int = DEDUP_CAPACITY, error_rate: float = DEDUP_ERROR_RATE,
+                 lease: float = DEDUP_LEASE):
+        self.path = path
+        self.ttl = ttl
+        self.lease = lease
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._last_purge = 0.0
+        self.duplicates = 0
+        conn = self._conn()
+        conn.execute("CREATE TABLE IF NOT EXISTS seen (key TEXT PRIMARY KEY, expires REAL NOT NULL, "
+                     "confirmed INTEGER NOT NULL DEFAULT 1) WITHOUT ROWID")
+        if "confirmed" not in [row[1] for row in conn.execute("PRAGMA table_info(seen)")]:
+            # 仮の記録を導入する前の DB（既存の行はすべて確定済み）
+            conn.execute("ALTER TABLE seen ADD COLUMN confirmed INTEGER NOT NULL DEFAULT 1")
+        self._rebuild_filter()
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA busy_timeout=30000")
+            self._local.conn = conn
+        return conn
+
+    def _rebuild_filter(self) -> None:
+        """期限内のキーで Bloom フィルタを作り直す（起動時と、想定件数を超えたとき）"""
+        rows = self._conn().execute("SELECT key FROM seen WHERE expires > ?", (time.time(),)).fetchall()
+        bloom = BloomFilter(max(self.capacity, 2 * len(rows)), self.error_rate)
+        for (key,) in rows:
+            bloom.add(key)
+        self.bloom = bloom
+
+    def _state(self, key: str, now: float) -> Optional[bool]:
+        """期限内の記録があれば False（確定済み）/ None（処理中）、なければ True（新規）"""
+        if key not in self.bloom:
+            return True
+        row = self._conn().execute("SELECT expires, confirmed FROM seen WHERE key = ?", (key,)).fetchone()
+        if row is None or row[0] <= now:
+            return True
+        return False if row[1] else None
+
+    def seen(self, key: str) -> bool:
+        """key が期限内に取り込み済み（または処理中）か（書き込みはしない）"""
+        return self._state(key, time.time()) is not True
+
+    def claim(self, keys: Iterable[str]) -> List[Optional[bool]]:
+        """キーを処理中として仮に記録する。キーごとに新規なら True、取り込み済みなら False、
+        別のプロセスが処理中なら None。
+
+        仮の記録は lease 秒で切れるので、保存に成功したら confirm()、失敗したら release() を呼ぶ。
+        Bloom フィルタが「未登録」と答えたキーは照会せずに記録する。記録は upsert
+        （期限切れの行だけ上書き）なので、同時に届いた同じメッセージは一方だけが True になる。
+        """
+        keys = list(keys)
+        now = time.time()
+        result: List[Optional[bool]] = []
+        first = set()
+        for key in keys:
+            # 同じ呼び出しの中で 2 回目以降に出てきたキーは重複
+            result.append(self._state(key, now) if key not in first else False)
+            first.add(key)
+        candidates = [i for i, state in enumerate(result) if state is True]
+        if candidates:
+            conn = self._conn()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                for i in candidates:
+                    cur = conn.execute(
+                        "INSERT INTO seen (key, expires, confirmed) VALUES (?, ?, 0) "
+                        "ON CONFLICT(key) DO UPDATE SET expires = excluded.expires, confirmed = 0 "
+                        "WHERE seen.expires <= ?",
+                        (keys[i], now + self.lease, now))
+                    if cur.rowcount <= 0:
+                        # 照会から upsert までの間に他のプロセスが記録した
+                        row = conn.execute("SELECT confirmed FROM seen WHERE key = ?", (keys[i],)).fetchone()
+                        result[i] = False if row and row[0] else None
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        with self._lock:
+            for key in keys:
+                if key not in self.bloom:
+                    self.bloom.add(key)
+            if self.bloom.count > self.bloom.capacity:
+                self._rebuild_filter()
+        self.duplicates += result.count(False)
+        self._maybe_purge(now)
+        return result
+
+    def confirm(self, keys: Iterable[str]) -> None:
+        """保存が終わったメッセージのキーを TTL の間、取り込み済みとして確定する"""
+        keys = list(keys)
+        if keys:
+            expires = time.time() + self.ttl
+            self._conn().executemany("UPDATE seen SET expires = ?, confirmed = 1 WHERE key = ?",
+                                     [(expires, key) for key in keys])
+
+    def release(self, keys: Iterable[str]) -> None:
+        """処理に失敗したメッセージのキーを消す（MTA の再送を重複扱いしないため）"""
+        keys = list(keys)
+        if keys:
+            self._conn().executemany("DELETE FROM seen WHERE key = ?", [(key,) for key in keys])
+
+    def purge(self) -> int:
+        """期限切れの行を消して件数を返す"""
+        cur = self._conn().execute("DELETE FROM seen WHERE expires <= ?", (time.time(),))
+        return cur.rowcount
+
+    def _maybe_purge(self, now: float) -> None:
+        if now - self._last_purge >= PURGE_INTERVAL:
+            self._last_purge = now
+            self.purge()
+
+
+_INDEX: Optional[DedupIndex] = None
+_INDEX_LOCK = threading.Lock()
+
+
+def open_dedup() -> Optional[DedupIndex]:
+    """プロセス内で共有する索引。ACTIVITYPUB_DEDUP=0 なら None"""
+    global _INDEX
+    if not DEDUP_ENABLED:
+        return None
+    with _INDEX_LOCK:
+        if _INDEX is None:
+            _INDEX = DedupIndex()
+        return _INDEX
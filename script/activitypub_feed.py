@@ -0,0 +1,110 @@
+"""In-process change feed over an activity store.
+
+One background thread per store watches for newly committed records (the LMTP
+handler may be another process, so it simply checks ``len(store)``, which is a
+stat of the offset index) and fans each batch out to every subscriber. Many
+Server-Sent Events clients therefore cost one store reader, not one each.
+"""
+from __future__ import annotations
+
+import queue
+import threading
+from typing import Any, List, Optional, Tuple
+
+POLL_INTERVAL = 0.5
+SUBSCRIBER_QUEUE_SIZE = 256
+MAX_BACKLOG = 500
+
+Batch = List[Tuple[int, Any]]
+
+
+class Subscription:
+    """1 クライアント分の受信キュー。溢れた（遅すぎる）購読者は closed になる。"""
+
+    def __init__(self, maxsize: int = SUBSCRIBER_QUEUE_SIZE):
+        self.queue: "queue.Queue[Batch]" = queue.Queue(maxsize=maxsize)
+        self.closed = False
+
+    def put(self, batch: Batch) -> None:
+        try:
+            self.queue.put_nowait(batch)
+        except queue.Full:
+            # 取りこぼしを黙って続けるより切断して Last-Event-ID から再開させる
+            self.closed = True
+
+    def get(self, timeout: Optional[float] = None) -> Optional[Batch]:
+        """次のバッチを返す。timeout までに何もなければ None"""
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class ChangeFeed:
+    """ストアへの追記を購読者へ配る fan-out ハブ。"""
+
+    def __init__(self, store, interval: float = POLL_INTERVAL):
+        self.store = store
+        self.interval = interval
+        self.position = len(store)
+        self._subscribers: List[Subscription] = []
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+
+    def _ensure_started(self) -> None:
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="change-feed", daemon=True)
+            self._thread.start()
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            try:
+                self.poll()
+            except Exception:
+                # ストアの一時的な読み込み失敗では止めない（次の周期で再試行）
+                pass
+
+    def poll(self) -> Batch:
+        """新しいレコードを読み、全購読者へ配る（スレッドからも直接呼べる）"""
+        end = len(self.store)
+        with self._lock:
+            if end < self.position:
+                # rewrite 等で縮んだ場合は位置だけ合わせる
+                self.position = end
+                return []
+            if end == self.position:
+                return []
+            batch = list(self.store.iter_from(self.position, end))
+            self.position = end
+            for sub in self._subscribers:
+                sub.put(batch)
+            self._subscribers = [s for s in self._subscribers if not s.closed]
+        return batch
+
+    def subscribe(self, after: Optional[int] = None) -> Subscription:
+        """購読を開始する。after（seq）を渡すとそれより後の取りこぼし分から配る"""
+        sub = Subscription()
+        with self._lock:
+            if after is not None and after + 1 < self.position:
+                start = max(after + 1, self.position - MAX_BACKLOG)
+                backlog = list(self.store.iter_from(start, self.position))
+                if backlog:
+                    sub.put(backlog)
+            self._subscribers.append(sub)
+        self._ensure_started()
+        return sub
+
+    def unsubscribe(self, sub: Subscription) -> None:
+        with self._lock:
+            if sub in self._subscribers:
+                self._subscribers.remove(sub)
+            sub.closed = True
+
+    @property
+    def subscriber_count(self) -> int:
+        return len(self._subscribers)
+
+    def stop(self) -> None:
+        self._stop.set()
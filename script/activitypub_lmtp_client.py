@@ -0,0 +1,354 @@
+"""Reusable LMTP client sessions and a small connection pool.
+
+``activitypub-send.py`` used to open a socket, run the banner / LHLO handshake,
+send one message and QUIT for every activity. :class:`LMTPClient` keeps the
+session open instead: later transactions start with ``RSET`` on the same
+connection, the LHLO capabilities are remembered per connection, and a broken
+or idle-expired connection is transparently re-established. A transaction may
+carry many recipients; when the server advertises PIPELINING the MAIL / RCPT /
+DATA commands go out in a single write, and the per-recipient LMTP replies
+after DATA are returned as a status map.
+
+:class:`LMTPPool` hands out a bounded number of such clients so that callers
+(web/app.py, the auto-accept path, workers) can share a few long-lived sessions.
+"""
+from __future__ import annotations
+
+import os
+import queue
+import re
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterable, List, Optional, Set, Tuple, Union
+
+from activitypub_metrics import count, stage
+
+LMTP_SOCKET = os.environ.get("ACTIVITYPUB_LMTP_SOCKET", "/var/run/dovecot/lmtp")
+CONNECT_TIMEOUT = 3.0
+DATA_TIMEOUT = 60.0   # 受信側ハンドラの処理時間（最大 60 秒）を待つ
+IDLE_TIMEOUT = 30.0   # これ以上使われていない接続はサーバ側で切られている前提で張り直す
+POOL_SIZE = 4
+
+
+class LMTPError(RuntimeError):
+    """LMTP サーバが想定外の応答を返した"""
+
+    def __init__(self, message: str, code: Optional[int] = None):
+        super().__init__(message)
+        self.code = code
+
+
+def read_reply(s_file, expected_code: Optional[int], echo: bool = False) -> Tuple[int, List[str]]:
+    """サーバ応答を読み切って期待コードを検証する（マルチライン対応）。
+    例: 250-... が続き、最後が 250 ... で終わる。
+    """
+    lines = []
+    first = s_file.readline().decode(errors="replace").strip()
+    if not first:
+        raise LMTPError("LMTP: empty reply")
+    if echo:
+        print(first)
+    lines.append(first)
+    # 先頭3桁をコードとして扱う
+    try:
+        code = int(first[:3])
+    except Exception:
+        raise LMTPError(f"LMTP: invalid reply: {first}")
+
+    # マルチライン: ハイフン継続（例: 250-）
+    cont = first[3:4] == "-"
+    while cont:
+        line = s_file.readline().decode(errors="replace").strip()
+        if not line:
+            raise LMTPError("LMTP: unexpected EOF in multiline reply")
+        if echo:
+            print(line)
+        lines.append(line)
+        # 継続条件は同じコード+ハイフン。終了は同じコード+スペース
+        cont = (line.startswith(f"{code}-"))
+
+    if expected_code is not None and code != expected_code:
+        raise LMTPError(f"LMTP: unexpected code {code}, expected {expected_code}. First line: {first}", code)
+    return code, lines
+
+
+def data_bytes(message_bytes: bytes) -> bytes:
+    """DATA で送る形にする。改行を CRLF に揃え、行頭の "." を二重にする（RFC 5321 4.5.2）。
+
+    email パッケージの as_bytes() は LF 改行なので、そのまま送ると受信側には
+    メッセージ全体が 1 行に見え、長いメッセージは "Line too long" で拒否される。
+    """
+    data = re.sub(rb"\r?\n", b"\r\n", message_bytes)
+    data = re.sub(rb"(?m)^\.", b"..", data)
+    if not data.endswith(b"\r\n"):
+        data += b"\r\n"
+    return data + b".\r\n"
+
+
+class LMTPClient:
+    """1 本の LMTP セッション（Unix ソケットまたは TCP）。
+
+    send() を繰り返し呼ぶと同じ接続の上でトランザクションを続ける。
+    """
+
+    def __init__(self, socket_path: Optional[str] = None, host: Optional[str] = None,
+                 port: Optional[int] = None, timeout: float = CONNECT_TIMEOUT,
+                 data_timeout: float = DATA_TIMEOUT, idle_timeout: float = IDLE_TIMEOUT,
+                 lhlo_name: str = "localhost", echo: bool = False):
+        self.socket_path = socket_path
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.data_timeout = data_timeout
+        self.idle_timeout = idle_timeout
+        self.lhlo_name = lhlo_name
+        self.echo = echo
+        self.sock: Optional[socket.socket] = None
+        self.s_file = None
+        self.capabilities: Set[str] = set()
+        self.last_used = 0.0
+        self._dirty = False      # 直前のトランザクション後に RSET が必要か
+        self._body_sent = False  # 本文を送った後の失敗は二重配送になりうるので再送しない
+
+    # --- connection -------------------------------------------------------
+
+    @property
+    def connected(self) -> bool:
+        return self.sock is not None
+
+    def _command(self, line: bytes, expected: Optional[int]) -> Tuple[int, List[str]]:
+        self.s_file.write(line); self.s_file.flush()
+        return read_reply(self.s_file, expected, self.echo)
+
+    def _lhlo(self, expected: Optional[int]) -> Tuple[int, List[str]]:
+        code, lines = self._command(f"LHLO {self.lhlo_name}\r\n".encode(), expected)
+        if code == 250:
+            # 先頭行はホスト名。以降が拡張（PIPELINING, 8BITMIME など）
+            self.capabilities = {l[4:].split(" ")[0].upper() for l in lines[1:]}
+        return code, lines
+
+    def connect(self) -> None:
+        """接続してバナー / LHLO を済ませる"""
+        self.close()
+        # 接続方式の決定
+        if self.host:
+            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            s.settimeout(self.timeout)
+            s.connect((self.host, self.port or 24))  # LMTP over TCP の標準ポートは環境依存。明示指定推奨。
+        else:
+            s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            s.settimeout(self.timeout)
+            s.connect(self.socket_path or LMTP_SOCKET)
+        self.sock = s
+        self.s_file = s.makefile("rwb")
+
+        try:
+            # 一部の環境では 220 バナーが遅延/省略されることがある。
+            # まずは短時間バナーを待ち、来なければ LHLO を先行送信して応答を解釈する。
+            try:
+                code, _ = read_reply(self.s_file, None, self.echo)
+                banner_read = (code == 220)
+            except Exception:
+                # empty reply / timeout 相当は LHLO 先行で再試行
+                banner_read = False
+
+            if not banner_read:
+                # バナー未受信: LHLO を先に送る
+                code, _ = self._lhlo(None)
+                if code == 220:
+                    # ここでサーバがバナーを返してきた場合、改めて LHLO を送る
+                    self._lhlo(250)
+                elif code != 250:
+                    raise LMTPError(f"LMTP: unexpected code after LHLO: {code}", code)
+            else:
+                # バナー受信済み: 通常の LHLO フロー
+                self._lhlo(250)
+        except BaseException:
+            self.close()
+            raise
+        self._dirty = False
+        self.last_used = time.monotonic()
+
+    def close(self) -> None:
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+        self.sock = None
+        self.s_file = None
+        self.capabilities = set()
+
+    def quit(self) -> None:
+        """QUIT 221（サーバによっては即切断する場合があるのでエラーは握りつぶす）"""
+        if self.sock is not None:
+            try:
+                self._command(b"QUIT\r\n", 221)
+            except Exception:
+                pass
+        self.close()
+
+    def _ensure_session(self) -> None:
+        """使える接続を用意する。アイドル超過・切断済みなら張り直し、再利用時は RSET で状態を戻す"""
+        if self.sock is not None and time.monotonic() - self.last_used > self.idle_timeout:
+            self.quit()
+        if self.sock is None:
+            self.connect()
+            return
+        if self._dirty:
+            try:
+                self._command(b"RSET\r\n", 250)
+                self._dirty = False
+            except (OSError, LMTPError):
+                self.connect()
+
+    # --- transactions -----------------------------------------------------
+
+    def _transaction(self, message_bytes: bytes, mail_from: str,
+                     rcpts: List[str]) -> Dict[str, Tuple[int, str]]:
+        self._dirty = True
+        self._body_sent = False
+        commands = [f"MAIL FROM:<{mail_from}>\r\n".encode()]
+        commands += [f"RCPT TO:<{r}>\r\n".encode() for r in rcpts]
+        commands.append(b"DATA\r\n")
+        pipelining = "PIPELINING" in self.capabilities
+        if pipelining:
+            # PIPELINING: MAIL / RCPT... / DATA を 1 回の書き込みで送り、応答をまとめて読む
+            self.s_file.write(b"".join(commands)); self.s_file.flush()
+
+        def reply(i: int) -> Tuple[int, List[str]]:
+            if not pipelining:
+                self.s_file.write(commands[i]); self.s_file.flush()
+            return read_reply(self.s_file, None, self.echo)
+
+        # MAIL FROM 250
+        code, lines = reply(0)
+        mail_failed = code != 250
+        # RCPT TO 250（宛先ごとに受理/拒否が分かれる）
+        results: Dict[str, Tuple[int, str]] = {}
+        accepted = []
+        for i, rcpt in enumerate(rcpts, start=1):
+            if mail_failed and not pipelining:
+                break
+            rcode, rlines = reply(i)
+            results[rcpt] = (rcode, rlines[-1])
+            if rcode == 250 and not mail_failed:
+                accepted.append(rcpt)
+        if mail_failed:
+            if pipelining:
+                reply(len(commands) - 1)  # 送ってしまった DATA への応答を読み捨てる
+            raise LMTPError(f"LMTP: unexpected code {code}, expected 250. First line: {lines[0]}", code)
+        if not accepted:
+            if pipelining:
+                reply(len(commands) - 1)
+            return results
+        # DATA 354
+        code, lines = reply(len(commands) - 1)
+        if code != 354:
+            raise LMTPError(f"LMTP: unexpected code {code}, expected 354. First line: {lines[0]}", code)
+        # Message body -> 受理された宛先ごとに 1 応答（LMTP）。受信側の処理を待つので長めのタイムアウト
+        self.sock.settimeout(self.data_timeout)
+        try:
+            self._body_sent = True
+            self.s_file.write(data_bytes(message_bytes)); self.s_file.flush()
+            for rcpt in accepted:
+                rcode, rlines = read_reply(self.s_file, None, self.echo)
+                results[rcpt] = (rcode, rlines[-1])
+        finally:
+            self.sock.settimeout(self.timeout)
+        self.last_used = time.monotonic()
+        return results
+
+    def send(self, message_bytes: bytes, mail_from: str,
+             rcpt_to: Union[str, Iterable[str]]) -> Dict[str, Tuple[int, str]]:
+        """1 トランザクションで送り、宛先ごとの (応答コード, 応答行) を返す。
+
+        rcpt_to は 1 件の文字列でも複数件でもよい。全宛先が失敗した場合は LMTPError。
+        再利用した接続が壊れていた場合は 1 回だけ張り直して再送する。
+        """
+        rcpts = [rcpt_to] if isinstance(rcpt_to, str) else list(dict.fromkeys(rcpt_to))
+        if not rcpts:
+            return {}
+        count("outbound_send", len(rcpts))
+        with stage("outbound_send"):
+            return self._send(message_bytes, mail_from, rcpts)
+
+    def _send(self, message_bytes: bytes, mail_from: str, rcpts: List[str]) -> Dict[str, Tuple[int, str]]:
+        reused = self.sock is not None
+        self._ensure_session()
+        try:
+            results = self._transaction(message_bytes, mail_from, rcpts)
+        except (OSError, LMTPError) as e:
+            self.close()
+            # 応答コード付きの拒否（5xx 等）はサーバの判断なので再送しない
+            if not reused or self._body_sent or getattr(e, "code", None) is not None:
+                raise
+            self.connect()
+            results = self._transaction(message_bytes, mail_from, rcpts)
+        if not any(200 <= code < 300 for code, _ in results.values()):
+            code, line = next(iter(results.values()))
+            raise LMTPError(f"LMTP: delivery failed for all recipients. First reply: {line}", code)
+        return results
+
+    def __enter__(self) -> "LMTPClient":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.quit()
+
+
+class LMTPPool:
+    """同じ宛先への LMTPClient を最大 size 本まで使い回すプール。"""
+
+    def __init__(self, size: int = POOL_SIZE, **client_kwargs):
+        self.size = size
+        self.client_kwargs = client_kwargs
+        self._idle: "queue.LifoQueue[LMTPClient]" = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+
+    @contextmanager
+    def acquire(self):
+        """空いているクライアントを借りる（size 本使用中なら返却を待つ）"""
+        self._slots.acquire()
+        try:
+            try:
+                client = self._idle.get_nowait()
+            except queue.Empty:
+                client = LMTPClient(**self.client_kwargs)
+            try:
+                yield client
+            except BaseException:
+                client.close()
+                raise
+            self._idle.put(client)
+        finally:
+            self._slots.release()
+
+    def send(self, message_bytes: bytes, mail_from: str,
+             rcpt_to: Union[str, Iterable[str]]) -> Dict[str, Tuple[int, str]]:
+        with self.acquire() as client:
+            return client.send(message_bytes, mail_from, rcpt_to)
+
+    def close(self) -> None:
+        while True:
+            try:
+                self._idle.get_nowait().quit()
+            except queue.Empty:
+                break
+
+
+_POOLS: Dict[Tuple, LMTPPool] = {}
+_POOLS_LOCK = threading.Lock()
+
+
+def get_pool(socket_path: Optional[str] = None, host: Optional[str] = None,
+             port: Optional[int] = None, size: int = POOL_SIZE) -> LMTPPool:
+    """宛先ごとに共有されるプールを返す"""
+    key = (None, host, port) if host else (socket_path or LMTP_SOCKET, None, None)
+    with _POOLS_LOCK:
+        pool = _POOLS.get(key)
+        if pool is None:
+            pool = _POOLS[key] = LMTPPool(size=size, socket_path=socket_path, host=host, port=port)
+        return pool
@@ -1,53 +1,149 @@
 #!/usr/bin/env python3
-import asyncio, sys, subprocess, logging
+import asyncio, sys, os, re, subprocess, importlib.util
+from concurrent.futures import ThreadPoolExecutor
 from aiosmtpd.controller import Controller
-from aiosmtpd.handlers import AsyncMessage
 from aiosmtpd.lmtp import LMTP
-from email.message import EmailMessage
 
-LOG_PATH = "/var/log/activitypub-lmtp.log"
-HOST = "127.0.0.1"
-PORT = 2626
-HANDLER_CMD = [sys.executable, "/usr/local/bin/activitypub-lmtp.py"]  # RFC822 を stdin で渡す
+from activitypub_log import get_logger, log_path, shutdown as shutdown_logging
+from activitypub_metrics import METRICS_PORT, serve as serve_metrics, stage, watch_queue
+from activitypub_profile import PROFILER
+from activitypub_queue import QUEUE_DIR
 
-# File + console logging (goes to journalctl)
-logger = logging.getLogger("activitypub-lmtp")
-logger.setLevel(logging.INFO)
-fmt = logging.Formatter('[%(asctime)s] %(message)s')
-fh = logging.FileHandler(LOG_PATH)
-fh.setFormatter(fmt); fh.setLevel(logging.INFO)
-ch = logging.StreamHandler(sys.stderr)
-ch.setFormatter(fmt); ch.setLevel(logging.INFO)
-logger.addHandler(fh); logger.addHandler(ch)
+LOG_PATH = log_path("activitypub-lmtp.log")
+HOST = os.environ.get("ACTIVITYPUB_LMTP_HOST", "127.0.0.1")
+PORT = int(os.environ.get("ACTIVITYPUB_LMTP_PORT", "2626"))
+HANDLER_PATH = os.environ.get("ACTIVITYPUB_HANDLER_PATH", "/usr/local/bin/activitypub-lmtp.py")
+HANDLER_CMD = [sys.executable, HANDLER_PATH]  # RFC822 を stdin で渡す
+HANDLER_TIMEOUT = 60
 
-class PipeToHandler(AsyncMessage):
-    async def handle_message(self, message: EmailMessage):
-        data = message.as_bytes()
-        logger.info(f"LMTP received From:{message.get('From')} To:{message.get_all('To')}")
+# "inprocess": ハンドラをモジュールとして読み込み、ワーカープールで実行（既定）
+# "subprocess": 従来通りメッセージごとにハンドラプロセスを起動
+HANDLER_MODE = os.environ.get("ACTIVITYPUB_HANDLER_MODE", "inprocess")
+# 同時に処理するメッセージ数の上限（超えた分の LMTP セッションは空きを待つ）
+HANDLER_CONCURRENCY = int(os.environ.get("ACTIVITYPUB_HANDLER_CONCURRENCY", "4"))
+# これを超える DATA は受信時点で 552 を返す（ハンドラ側の上限と同じ環境変数）
+MAX_MESSAGE_BYTES = int(os.environ.get("ACTIVITYPUB_MAX_MESSAGE_BYTES", str(10 * 1024 * 1024)))
+# ハンドラが失敗・タイムアウトしたときの応答（MTA に再送させる）
+TEMPFAIL = "451 4.3.0 Temporary failure while processing message"
+_STATUS = re.compile(r"^[245]\d\d[ -]")
+
+# File + console logging (goes to journalctl)。書き込みは別スレッドで行いイベントループを止めない
+logger = get_logger("activitypub-lmtp", LOG_PATH, console=True)
+
+def load_handler_module(path=HANDLER_PATH):
+    """activitypub-lmtp.py をモジュールとして読み込む（ファイル名にハイフンを含むため import 文は使えない）"""
+    spec = importlib.util.spec_from_file_location("activitypub_lmtp_handler", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+class PipeToHandler:
+    def __init__(self, mode=HANDLER_MODE, concurrency=HANDLER_CONCURRENCY):
+        self.mode = mode
+        self.concurrency = max(1, concurrency)
+        self.module = None
+        self.executor = None
+        if self.mode == "inprocess":
+            try:
+                self.module = load_handler_module()
+                self.executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="handler")
+            except Exception as e:
+                logger.exception(f"in-process handler load failed, falling back to subprocess: {e}")
+                self.mode = "subprocess"
+        self._slots = None
+
+    @property
+    def slots(self):
+        # イベントループ上で生成する必要があるため遅延初期化
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.concurrency)
+        return self._slots
+
+    async def handle_DATA(self, server, session, envelope):
+        # MIME の解析はハンドラ側（BytesFeedParser）で行うため、受信した bytes をそのまま渡す
+        data = envelope.original_content or envelope.content
+        logger.info(f"LMTP received MAIL FROM:{envelope.mail_from} RCPT TO:{envelope.rcpt_tos} bytes={len(data)}")
+        with stage("lmtp_accept"):
+            status = await self.process(data)
+        # LMTP は受理した宛先ごとに 1 応答を返す（RFC 2033）。aiosmtpd は 1 行しか返さないため宛先数分に揃える
+        return "\r\n".join([status] * max(1, len(envelope.rcpt_tos)))
+
+    async def process(self, data: bytes) -> str:
+        """ハンドラを実行して LMTP の応答行を返す（例外・タイムアウト時は 451 で再送を促す）"""
+        await self.slots.acquire()
+        release = True
+        status = TEMPFAIL
         try:
-            p = subprocess.Popen(HANDLER_CMD, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            out, err = p.communicate(input=data, timeout=60)
-            if out:
-                for line in out.decode(errors="ignore").splitlines():
-                    logger.info(line)
-            if err:
-                for line in err.decode(errors="ignore").splitlines():
-                    logger.error(line)
-            logger.info(f"handler exit={p.returncode}")
+            if self.mode == "inprocess":
+                loop = asyncio.get_running_loop()
+                fut = loop.run_in_executor(self.executor, self.module.handle_message, data)
+                # タイムアウトしてもワーカースレッドは止まらないので、枠はスレッドが実際に終わったときに返す
+                fut.add_done_callback(lambda _: self.slots.release())
+                release = False
+                status = await self._run_inprocess(fut)
+            else:
+                status = await self._run_subprocess(data)
+        except asyncio.TimeoutError:
+            logger.error(f"handler timeout after {HANDLER_TIMEOUT}s")
         except Exception as e:
             logger.exception(f"handler error: {e}")
+        finally:
+            if release:
+                self.slots.release()
+        if not isinstance(status, str) or not _STATUS.match(status):
+            logger.error(f"handler returned no LMTP status: {status!r}")
+            return TEMPFAIL
+        return status
+
+    async def _run_inprocess(self, fut):
+        # shield: wait_for のキャンセルで fut が「完了」扱いになり枠が早く返るのを防ぐ
+        result = await asyncio.wait_for(asyncio.shield(fut), timeout=HANDLER_TIMEOUT)
+        logger.info(f"handler result={result}")
+        return result
+
+    async def _run_subprocess(self, data):
+        # Popen.communicate はイベントループを止めてしまうため asyncio のサブプロセスを使う
+        p = await asyncio.create_subprocess_exec(
+            *HANDLER_CMD, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        try:
+            out, err = await asyncio.wait_for(p.communicate(input=data), timeout=HANDLER_TIMEOUT)
+        except asyncio.TimeoutError:
+            p.kill()
+            await p.wait()
+            raise
+        status = None
+        if out:
+            for line in out.decode(errors="ignore").splitlines():
+                logger.info(line)
+                if _STATUS.match(line):
+                    status = line   # ハンドラは最後に応答行を出力する
+        if err:
+            for line in err.decode(errors="ignore").splitlines():
+                logger.error(line)
+        logger.info(f"handler exit={p.returncode}")
+        return status if p.returncode == 0 else TEMPFAIL
 
 # For older aiosmtpd: override factory() to create LMTP server
 class LMTPController(Controller):
     def factory(self):
-        return LMTP(self.handler, enable_SMTPUTF8=True, decode_data=False, ident="activitypub")
+        return LMTP(self.handler, enable_SMTPUTF8=True, decode_data=False, ident="activitypub",
+                    data_size_limit=MAX_MESSAGE_BYTES)
 
 async def main():
     handler = PipeToHandler()
+    # SIGUSR1: プロファイルの有効/無効を切り替え / SIGUSR2: レポートを書き出す（activitypub_profile）
+    PROFILER.install_signal_handlers()
+    # /metrics を別ポートで公開（ハンドラの各ステージは in-process モードのときだけこのプロセスで計測される）
+    watch_queue(QUEUE_DIR)
+    try:
+        if serve_metrics(METRICS_PORT):
+            logger.info(f"metrics on http://127.0.0.1:{METRICS_PORT}/metrics")
+    except OSError as e:
+        logger.error(f"metrics port {METRICS_PORT} unavailable: {e}")
     try:
         controller = LMTPController(handler, hostname=HOST, port=PORT, server_hostname="activitypub", decode_data=False)
         controller.start()
-        logger.info(f"listening on {HOST}:{PORT}")
+        logger.info(f"listening on {HOST}:{PORT} (handler mode={handler.mode}, concurrency={handler.concurrency})")
     except Exception as e:
         logger.exception(f"controller.start failed: {e}")
         await asyncio.sleep(5)
@@ -57,6 +153,10 @@ async def main():
             await asyncio.sleep(3600)
     finally:
         controller.stop()
+        if handler.module is not None and hasattr(handler.module, "flush_pending"):
+            handler.module.flush_pending()  # 時間窓の途中にある Accept を書き込む
+        if handler.executor:
+            handler.executor.shutdown(wait=False)
 
 if __name__ == "__main__":
     try:
@@ -67,3 +167,5 @@ if __name__ == "__main__":
     except Exception as e:
         logger.exception(f"fatal: {e}")
         raise
+    finally:
+        shutdown_logging()
@@ -0,0 +1,212 @@
+"""Shared, non-blocking logging for the ActivityPub scripts.
+
+Call sites only put records on an in-memory queue (``QueueHandler``); one
+listener thread per log file formats them and writes them out. Writes are not
+flushed line by line: the file is flushed every ``LOG_BATCH_SIZE`` records and
+whenever the queue runs empty, so a burst costs a few ``write(2)`` calls
+instead of one open/write/close per line. Files rotate by size.
+
+File output is one JSON object per line by default::
+
+    {"ts": "2024-05-01T12:00:00.123456", "level": "INFO", "logger": "activitypub-lmtp", "msg": "..."}
+
+Per-level sampling (``ACTIVITYPUB_LOG_SAMPLE="DEBUG=0.01,INFO=1"``) drops
+records before they are queued, so sampled-out lines cost almost nothing.
+"""
+from __future__ import annotations
+
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import threading
+from datetime import datetime
+from typing import Dict, Optional, Tuple
+
+LOG_DIR = os.environ.get("ACTIVITYPUB_LOG_DIR", "/var/log")
+LOG_LEVEL = os.environ.get("ACTIVITYPUB_LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.environ.get("ACTIVITYPUB_LOG_FORMAT", "json")   # "json" または "text"（従来の [時刻] メッセージ）
+LOG_MAX_BYTES = int(os.environ.get("ACTIVITYPUB_LOG_MAX_BYTES", str(10 * 1024 * 1024)))
+LOG_BACKUPS = int(os.environ.get("ACTIVITYPUB_LOG_BACKUPS", "5"))
+LOG_BATCH_SIZE = 256
+LOG_QUEUE_SIZE = 10000   # これを超えた分は捨てる（ログのためにリクエストを止めない）
+LOG_SAMPLE = os.environ.get("ACTIVITYPUB_LOG_SAMPLE", "")
+
+TEXT_FORMAT = "[%(asctime)s] %(message)s"
+
+
+def log_path(filename: str) -> str:
+    return os.path.join(LOG_DIR, filename)
+
+
+def parse_sample(spec: str) -> Dict[int, float]:
+    """"DEBUG=0.01,INFO=0.5" を {レベル番号: 残す割合} にする"""
+    rates: Dict[int, float] = {}
+    for item in filter(None, (x.strip() for x in spec.split(","))):
+        name, _, rate = item.partition("=")
+        level = logging.getLevelName(name.strip().upper())
+        if isinstance(level, int):
+            rates[level] = float(rate)
+    return rates
+
+
+class JsonFormatter(logging.Formatter):
+    """1 レコード 1 行の JSON。extra= で渡した値もそのまま含める"""
+
+    _RESERVED = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in self._RESERVED and not key.startswith("_"):
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """レベルごとに rates の割合だけ通す（指定のないレベルはすべて通す）"""
+
+    def __init__(self, rates: Dict[int, float]):
+        super().__init__()
+        self.rates = rates
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        rate = self.rates.get(record.levelno)
+        return rate is None or rate >= 1 or random.random() < rate
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """キューが満杯なら待たずに捨てる"""
+
+    dropped = 0
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class BatchingRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """1 行ごとに flush しない RotatingFileHandler。flush はリスナーがまとめて呼ぶ"""
+
+    def __init__(self, filename: str, maxBytes: int = LOG_MAX_BYTES, backupCount: int = LOG_BACKUPS,
+                 batch_size: int = LOG_BATCH_SIZE):
+        super().__init__(filename, maxBytes=maxBytes, backupCount=backupCount,
+                         encoding="utf-8", delay=True)
+        self.batch_size = batch_size
+        self._pending = 0
+
+    def emit(self, record: logging.LogRecord) -> None:
+        try:
+            msg = self.format(record) + self.terminator
+            if self.stream is None:
+                self.stream = self._open()
+            if self.maxBytes > 0 and self.stream.tell() + len(msg) >= self.maxBytes:
+                self.doRollover()
+                if self.stream is None:
+                    self.stream = self._open()
+            self.stream.write(msg)
+            self._pending += 1
+            if self._pending >= self.batch_size:
+                self.flush()
+        except Exception:
+            self.handleError(record)
+
+    def flush(self) -> None:
+        super().flush()
+        self._pending = 0
+
+
+class BatchingQueueListener(logging.handlers.QueueListener):
+    """キューが空になった（＝バーストが終わった）ところで各ハンドラを flush する"""
+
+    def dequeue(self, block: bool):
+        if block and self.queue.empty():
+            for handler in self.handlers:
+                handler.flush()
+        return self.queue.get(block)
+
+
+_SINKS: Dict[str, Tuple[logging.Handler, BatchingQueueListener]] = {}
+_SINKS_LOCK = threading.Lock()
+
+
+def _file_formatter() -> logging.Formatter:
+    return JsonFormatter() if LOG_FORMAT == "json" else logging.Formatter(TEXT_FORMAT)
+
+
+def _sink(path: str, console: bool) -> logging.Handler:
+    """path（と stderr）へ書くリスナーを 1 つ起動し、そこへ送る QueueHandler を返す。
+
+    ファイルごとに 1 つ（同じファイルを 2 つのハンドラでローテートしないため）。
+    console は最初に作ったときの指定が使われる。
+    """
+    key = os.path.abspath(path)
+    with _SINKS_LOCK:
+        if key not in _SINKS:
+            handlers = []
+            try:
+                open(path, "a").close()  # 書けないパスならここで気づく（delay=True のため）
+                file_handler = BatchingRotatingFileHandler(path)
+                file_handler.setFormatter(_file_formatter())
+                handlers.append(file_handler)
+            except OSError as e:
+                print(f"[WARN] log file {path} unavailable: {e}", file=sys.stderr)
+            if console or not handlers:
+                # journalctl 向けは従来どおりのテキスト
+                stream = logging.StreamHandler(sys.stderr)
+                stream.setFormatter(logging.Formatter(TEXT_FORMAT))
+                handlers.append(stream)
+            q: "queue.Queue[logging.LogRecord]" = queue.Queue(LOG_QUEUE_SIZE)
+            qh = DroppingQueueHandler(q)
+            rates = parse_sample(LOG_SAMPLE)
+            if rates:
+                qh.addFilter(SamplingFilter(rates))
+            listener = BatchingQueueListener(q, *handlers, respect_handler_level=True)
+            listener.start()
+            _SINKS[key] = (qh, listener)
+        return _SINKS[key][0]
+
+
+def get_logger(name: str, filename: Optional[str] = None, console: bool = False,
+               level: str = LOG_LEVEL) -> logging.Logger:
+    """filename（LOG_DIR 配下、または絶対パス）へ非同期に書くロガーを返す。
+
+    同じファイルを指すロガーは 1 つのリスナー（書き込みスレッド）を共有する。
+    """
+    logger = logging.getLogger(name)
+    if getattr(logger, "_activitypub_sink", None) is None:
+        path = filename if filename and os.path.isabs(filename) else log_path(filename or f"{name}.log")
+        handler = _sink(path, console)
+        logger.addHandler(handler)
+        logger.setLevel(level)
+        logger.propagate = False
+        logger._activitypub_sink = handler  # type: ignore[attr-defined]
+    return logger
+
+
+def shutdown() -> None:
+    """キューに残っているレコードを書き出してリスナーを止める"""
+    with _SINKS_LOCK:
+        sinks = list(_SINKS.values())
+        _SINKS.clear()
+    for _, listener in sinks:
+        listener.stop()
+        for handler in listener.handlers:
+            handler.flush()
+            handler.close()
+
+
+atexit.register(shutdown)
@@ -0,0 +1,287 @@
+"""Per-stage counters, latency histograms and gauges in Prometheus text format.
+
+Each pipeline stage is wrapped in :func:`stage`, which counts it, observes its
+duration and tracks how many are in flight::
+
+    activitypub_stage_seconds_bucket{stage="mime_parse",le="0.005"} 812
+    activitypub_stage_total{stage="store_commit",outcome="error"} 3
+    activitypub_in_flight{stage="lmtp_accept"} 4
+    activitypub_queue_depth{state="new"} 17
+
+Stages: ``lmtp_accept`` (DATA received -> LMTP reply), ``mime_parse``,
+``json_decode``, ``store_commit``, ``accept_generation`` and ``outbound_send``.
+
+Metrics are per process. web/app.py serves them on ``/metrics``; the LMTP
+server (and, with ``--metrics-port``, the queue worker) serve them on a small
+side port via :func:`serve`. Only the standard library is used.
+"""
+from __future__ import annotations
+
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+# LMTP サーバのメトリクス用ポート（0 なら公開しない）
+METRICS_HOST = os.environ.get("ACTIVITYPUB_METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.environ.get("ACTIVITYPUB_METRICS_PORT", "9626"))
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+Labels = Tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: Sequence[str], values: Labels, extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _number(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class _Metric:
+    type = "untyped"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> Labels:
+        return tuple(str(labels.get(n, "")) for n in self.labelnames)
+
+    def samples(self) -> Iterable[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        lines.extend(self.samples())
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, help, labelnames)
+        self._values: Dict[Labels, float] = {}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels: str) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self) -> Iterable[str]:
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            yield f"{self.name}{_labels(self.labelnames, key)} {_number(value)}"
+
+
+class Gauge(_Metric):
+    type = "gauge"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, help, labelnames)
+        self._values: Dict[Labels, float] = {}
+        self._functions: List[Callable[[], Dict[Labels, float]]] = []
+
+    def set(self, value: float, **labels: str) -> None:
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels: str) -> None:
+        self.inc(-amount, **labels)
+
+    def value(self, **labels: str) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def set_function(self, fn: Callable[[], Dict[Labels, float]]) -> None:
+        """スクレイプのたびに fn() を呼んで {ラベル値のタプル: 値} を出す"""
+        self._functions.append(fn)
+
+    def samples(self) -> Iterable[str]:
+        with self._lock:
+            values = dict(self._values)
+        for fn in self._functions:
+            try:
+                values.update(fn())
+            except Exception:
+                pass
+        for key, value in sorted(values.items()):
+            yield f"{self.name}{_labels(self.labelnames, key)} {_number(value)}"
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        self._values: Dict[Labels, List[float]] = {}   # [bucket counts..., sum, count]
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            row = self._values.get(key)
+            if row is None:
+                row = self._values[key] = [0.0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    row[i] += 1
+                    break
+            row[-2] += value
+            row[-1] += 1
+
+    @contextmanager
+    def time(self, **labels: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self) -> Iterable[str]:
+        with self._lock:
+            items = sorted((k, list(v)) for k, v in self._values.items())
+        for key, row in items:
+            cumulative = 0.0
+            for bound, count in zip(self.buckets, row):
+                cumulative += count
+                le = f'le="{_number(bound)}"'
+                yield f"{self.name}_bucket{_labels(self.labelnames, key, le)} {_number(cumulative)}"
+            yield f"{self.name}_sum{_labels(self.labelnames, key)} {_number(row[-2])}"
+            yield f"{self.name}_count{_labels(self.labelnames, key)} {_number(row[-1])}"
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+        self._lock = threading.Lock()
+
+    def get_or_create(self, cls, name: str, help: str, labelnames: Sequence[str] = (), **kwargs) -> _Metric:
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, help, labelnames, **kwargs)
+            elif not isinstance(metric, cls):
+                raise ValueError(f"metric {name} is already registered as {metric.type}")
+            return metric
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return "\n".join(m.render() for m in metrics) + "\n"
+
+
+REGISTRY = Registry()
+
+
+def counter(name: str, help: str, labelnames: Sequence[str] = ()) -> Counter:
+    return REGISTRY.get_or_create(Counter, name, help, labelnames)  # type: ignore[return-value]
+
+
+def gauge(name: str, help: str, labelnames: Sequence[str] = ()) -> Gauge:
+    return REGISTRY.get_or_create(Gauge, name, help, labelnames)  # type: ignore[return-value]
+
+
+def histogram(name: str, help: str, labelnames: Sequence[str] = (),
+              buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+    return REGISTRY.get_or_create(Histogram, name, help, labelnames, buckets=buckets)  # type: ignore[return-value]
+
+
+STAGE_SECONDS = histogram("activitypub_stage_seconds", "Time spent in each pipeline stage", ["stage"])
+STAGE_TOTAL = counter("activitypub_stage_total", "Pipeline stage executions by outcome", ["stage", "outcome"])
+IN_FLIGHT = gauge("activitypub_in_flight", "Pipeline stage executions currently running", ["stage"])
+ITEMS_TOTAL = counter("activitypub_items_total", "Items handled by a stage (records, activities, recipients)",
+                      ["stage"])
+
+
+@contextmanager
+def stage(name: str):
+    """ステージ 1 回分を計測する（件数・所要時間・実行中の数）。例外は outcome="error" で数えて再送出"""
+    IN_FLIGHT.inc(stage=name)
+    start = time.perf_counter()
+    outcome = "ok"
+    try:
+        yield
+    except BaseException:
+        outcome = "error"
+        raise
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - start, stage=name)
+        STAGE_TOTAL.inc(stage=name, outcome=outcome)
+        IN_FLIGHT.dec(stage=name)
+
+
+def count(name: str, amount: float = 1) -> None:
+    """ステージで扱った件数（1 回の追記のレコード数など）を足す"""
+    ITEMS_TOTAL.inc(amount, stage=name)
+
+
+def watch_queue(queue_dir: str) -> None:
+    """配送キューのスプール（new / cur / dead）のファイル数を activitypub_queue_depth として出す"""
+    depth = gauge("activitypub_queue_depth", "Jobs in the delivery queue spool by state", ["state"])
+
+    def scan() -> Dict[Labels, float]:
+        result = {}
+        for state in ("new", "cur", "dead"):
+            try:
+                result[(state,)] = len(os.listdir(os.path.join(queue_dir, state)))
+            except OSError:
+                result[(state,)] = 0
+        return result
+
+    depth.set_function(scan)
+
+
+def render() -> str:
+    return REGISTRY.render()
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self) -> None:
+        if self.path.split("?", 1)[0] not in ("/metrics", "/"):
+            self.send_error(404)
+            return
+        body = render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args) -> None:  # noqa: A002
+        pass   # スクレイプのたびにアクセスログを出さない
+
+
+def serve(port: int = METRICS_PORT, host: str = METRICS_HOST) -> Optional[ThreadingHTTPServer]:
+    """/metrics を返す HTTP サーバをデーモンスレッドで起動する（port=0 なら何もしない）"""
+    if not port:
+        return None
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
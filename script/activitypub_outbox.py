@@ -0,0 +1,151 @@
+"""Per-activity delivery state for the outbox.
+
+The outbox store itself stays a plain append-only list of activities. Delivery
+state lives next to it in a second append-only store (``outbox-delivery``), one
+record per transition::
+
+    {"seq": 12, "state": "pending", "attempts": 0, "mail_from": "...", "rcpt_to": ["..."], "at": "..."}
+    {"seq": 12, "state": "sent", "attempts": 1, "at": "..."}
+
+The latest record for a ``seq`` wins. Readers fold the log incrementally, so
+finding pending work never loads or rewrites the outbox itself; only the
+pending activities are fetched by sequence number.
+"""
+from __future__ import annotations
+
+import fcntl
+import os
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import activitypub_commit
+from activitypub_store import open_store
+
+PENDING = "pending"
+QUEUED = "queued"    # 配送キュー（activitypub_queue）に積まれ、ワーカーが送る
+SENT = "sent"
+FAILED = "failed"
+ARCHIVED_UNSENT = "archived before delivery"   # 送る前にアーカイブへ移された entry の error
+
+
+def _now() -> str:
+    return datetime.utcnow().isoformat() + "Z"
+
+
+class OutboxDelivery:
+    """outbox と配送状態ログをまとめて扱う。"""
+
+    def __init__(self, outbox_path: str):
+        self.outbox_path = str(outbox_path)
+        base = self.outbox_path[:-5] if self.outbox_path.endswith(".json") else self.outbox_path
+        self.outbox = open_store(self.outbox_path)
+        self.log = open_store(base + "-delivery.json")
+        self.send_lock_path = base + "-delivery.send.lock"
+        self._states: Dict[int, Dict[str, Any]] = {}
+        self._position = 0
+        self._mutex = threading.Lock()
+
+    def refresh(self) -> Dict[int, Dict[str, Any]]:
+        """前回以降に追記された状態レコードだけを読み込んで畳み込む"""
+        with self._mutex:
+            for pos, record in self.log.iter_from(self._position):
+                seq = record.get("seq")
+                if isinstance(seq, int):
+                    self._states[seq] = {**self._states.get(seq, {}), **record}
+                self._position = pos + 1
+            return self._states
+
+    def state(self, seq: int) -> Optional[Dict[str, Any]]:
+        return self.refresh().get(seq)
+
+    def enqueue(self, activity: Any, mail_from: str, rcpt_to) -> int:
+        """outbox に追記し、pending として記録して seq を返す"""
+        return self.enqueue_many([(activity, mail_from, rcpt_to)])[0]
+
+    def enqueue_many(self, items: Iterable[Tuple[Any, str, Any]]) -> List[int]:
+        items = list(items)
+        # 書き込みはコミットサービス（動いていれば）経由。outbox と状態ログは別々にコミットされる
+        seqs = activitypub_commit.append_many(self.outbox.path, [activity for activity, _, _ in items])
+        activitypub_commit.append_many(self.log.path, [
+            {"seq": seq, "state": PENDING, "attempts": 0, "mail_from": mail_from,
+             "rcpt_to": [rcpt_to] if isinstance(rcpt_to, str) else list(rcpt_to), "at": _now()}
+            for seq, (_, mail_from, rcpt_to) in zip(seqs, items)
+        ])
+        return seqs
+
+    def mark(self, seq: int, state: str, error: Optional[str] = None,
+             results: Optional[Dict[str, Any]] = None, attempt: bool = True,
+             rcpt_to: Optional[List[str]] = None) -> None:
+        """状態遷移を記録する。attempt=True（送信結果の記録）なら試行回数を 1 増やす。
+
+        rcpt_to を渡すと以降の送信先をその宛先に絞る（一部の宛先だけ再送する場合）。
+        """
+        self.mark_many([seq], state, error=error, results=results, attempt=attempt, rcpt_to=rcpt_to)
+
+    def mark_many(self, seqs: Iterable[int], state: str, error: Optional[str] = None,
+                  results: Optional[Dict[str, Any]] = None, attempt: bool = True,
+                  rcpt_to: Optional[List[str]] = None) -> None:
+        """複数の seq の状態遷移を 1 回の追記で記録する（まとめて送った activity 用）"""
+        states = self.refresh()
+        at = _now()
+        records = []
+        for seq in seqs:
+            attempts = states.get(seq, {}).get("attempts", 0) + (1 if attempt else 0)
+            record: Dict[str, Any] = {"seq": seq, "state": state, "attempts": attempts, "at": at}
+            if error:
+                record["error"] = error
+            if results:
+                record["results"] = results
+            if rcpt_to:
+                record["rcpt_to"] = list(rcpt_to)
+            records.append(record)
+        if records:
+            activitypub_commit.append_many(self.log.path, records)
+
+    def pending(self) -> List[Tuple[int, Dict[str, Any], Any]]:
+        """(seq, 状態, activity) を seq 順に返す。activity はインデックス経由で 1 件ずつ読む。
+
+        queued（配送キューのワーカーが担当）と、アーカイブへ移された seq（archived_unsent()）は含めない。
+        """
+        states = self.refresh()
+        first = self.outbox.first_seq()
+        return [(seq, dict(st), self.outbox.get(seq))
+                for seq, st in sorted(states.items()) if st.get("state") == PENDING and seq >= first]
+
+    def oldest_unsent(self) -> Optional[int]:
+        """まだ送り終えていない（pending / queued の）最も古い seq。なければ None"""
+        states = self.refresh()
+        return min((seq for seq, st in states.items() if st.get("state") in (PENDING, QUEUED)), default=None)
+
+    def archived_unsent(self) -> List[int]:
+        """送り終える前にアーカイブへ移されてしまった（pending / queued のままの）seq"""
+        states = self.refresh()
+        first = self.outbox.first_seq()
+        return sorted(seq for seq, st in states.items()
+                      if seq < first and st.get("state") in (PENDING, QUEUED))
+
+    @contextmanager
+    def send_lock(self):
+        """送信処理を複数プロセス間で直列化する（同じ activity の二重送信を防ぐ）"""
+        with open(self.send_lock_path, "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+_DELIVERIES: Dict[str, OutboxDelivery] = {}
+_DELIVERIES_LOCK = threading.Lock()
+
+
+def open_outbox(outbox_path) -> OutboxDelivery:
+    """outbox ごとに 1 つのインスタンスを返す（プロセス内で共有）"""
+    key = os.path.abspath(str(outbox_path))
+    with _DELIVERIES_LOCK:
+        delivery = _DELIVERIES.get(key)
+        if delivery is None:
+            delivery = _DELIVERIES[key] = OutboxDelivery(key)
+        return delivery
@@ -0,0 +1,230 @@
+"""Opt-in profiling of the message handling hot path.
+
+When enabled, one message in ``ACTIVITYPUB_PROFILE_SAMPLE`` (N) is run under
+``cProfile`` and, with ``ACTIVITYPUB_PROFILE_MEMORY=1``, under ``tracemalloc``
+as well. Profiles are aggregated in memory and written to the spool directory
+(``ACTIVITYPUB_PROFILE_DIR``) every ``PROFILE_DUMP_EVERY`` sampled messages,
+on ``SIGUSR2`` and at exit::
+
+    profile-<pid>-<time>.pstats   aggregated cProfile data (python -m pstats ...)
+    profile-<pid>-<time>.txt      top functions by cumulative time
+    memory-<pid>-<time>.txt       peak allocation per sampled message and the
+                                  allocation sites that grew most in the heaviest one
+
+Profiling can be switched on and off without a restart: ``SIGUSR1`` toggles it
+in the LMTP server (new handler subprocesses inherit the setting through the
+environment). When it is off, :meth:`Profiler.sample` returns a shared no-op
+context manager after a single attribute check.
+"""
+from __future__ import annotations
+
+import atexit
+import cProfile
+import io
+import os
+import pstats
+import random
+import signal
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Tuple
+
+from activitypub_log import LOG_DIR
+
+PROFILE_SAMPLE = int(os.environ.get("ACTIVITYPUB_PROFILE_SAMPLE", "0"))   # N 通に 1 通を計測（0 なら無効）
+PROFILE_MEMORY = os.environ.get("ACTIVITYPUB_PROFILE_MEMORY", "0") not in ("0", "false", "no", "")
+PROFILE_DIR = os.environ.get("ACTIVITYPUB_PROFILE_DIR", os.path.join(LOG_DIR, "activitypub-profile"))
+PROFILE_DUMP_EVERY = 100      # この数だけ計測したらレポートを書き出す
+PROFILE_TOGGLE_SAMPLE = 100   # SIGUSR1 で有効にしたときの N（環境変数で指定がない場合）
+PROFILE_TOP = 40              # レポートに載せる関数・割り当て箇所の数
+
+
+def _snapshot() -> tracemalloc.Snapshot:
+    return tracemalloc.take_snapshot().filter_traces([
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+    ])
+
+
+class _Null:
+    def __enter__(self):
+        return None
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL = _Null()
+
+
+class Profiler:
+    """1/N のメッセージを cProfile（と tracemalloc）で計測して集計する"""
+
+    def __init__(self, sample: int = PROFILE_SAMPLE, memory: bool = PROFILE_MEMORY,
+                 directory: str = PROFILE_DIR, dump_every: int = PROFILE_DUMP_EVERY):
+        self.sample_rate = max(0, sample)
+        self.memory = memory
+        self.directory = directory
+        self.dump_every = dump_every
+        # cProfile は同時に 1 つしか有効にできない（3.12 以降はプロセス全体で 1 つ）ので 1 通ずつ計測する
+        self._busy = threading.Lock()
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self) -> None:
+        self.stats: Optional[pstats.Stats] = None
+        self.sampled = 0
+        self.labels: Dict[str, int] = {}
+        self.peaks: List[Tuple[float, str, int]] = []      # (秒, ラベル, ピーク時の追加割り当てバイト数)
+        self.worst: Optional[Tuple[int, str, List[tracemalloc.StatisticDiff]]] = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.sample_rate > 0
+
+    def enable(self, sample: int) -> None:
+        self.sample_rate = max(0, sample)
+        if self.enabled and self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start(25)
+
+    def disable(self) -> None:
+        self.sample_rate = 0
+        self.dump()
+        # 計測中のメッセージが終わるのを待ってから止める（途中で止めるとスナップショットが取れない）
+        with self._busy:
+            if not self.enabled and tracemalloc.is_tracing():
+                tracemalloc.stop()
+
+    def sample(self, label: str = "message"):
+        """with profiler.sample("handle_message"): ... 無効時・非サンプル時は何もしない"""
+        if not self.sample_rate:
+            return _NULL
+        if self.sample_rate > 1 and random.random() * self.sample_rate >= 1:
+            return _NULL
+        if not self._busy.acquire(blocking=False):
+            return _NULL   # 別のメッセージを計測中
+        return self._profile(label)
+
+    @contextmanager
+    def _profile(self, label: str):
+        try:
+            memory = self.memory
+            if memory:
+                if not tracemalloc.is_tracing():
+                    tracemalloc.start(25)
+                before = _snapshot()
+                base, _ = tracemalloc.get_traced_memory()
+                tracemalloc.reset_peak()
+            profile = cProfile.Profile()
+            start = time.perf_counter()
+            profile.enable()
+            try:
+                yield
+            finally:
+                profile.disable()
+                elapsed = time.perf_counter() - start
+                # 念のため: 外から tracemalloc が止められていたらメモリの計測だけ諦める
+                memory = memory and tracemalloc.is_tracing()
+                peak = tracemalloc.get_traced_memory()[1] - base if memory else 0
+                growth = None
+                if memory and (self.worst is None or peak > self.worst[0]):
+                    # メッセージの前後の差分（このメッセージで増えた割り当て箇所）
+                    growth = _snapshot().compare_to(before, "lineno")[:PROFILE_TOP]
+                self._record(label, profile, elapsed, peak, growth)
+        finally:
+            self._busy.release()
+
+    def _record(self, label: str, profile: cProfile.Profile, elapsed: float, peak: int,
+                growth: Optional[List[tracemalloc.StatisticDiff]]) -> None:
+        with self._lock:
+            if self.stats is None:
+                self.stats = pstats.Stats(profile, stream=io.StringIO())
+            else:
+                self.stats.add(profile)
+            self.sampled += 1
+            self.labels[label] = self.labels.get(label, 0) + 1
+            if self.memory:
+                self.peaks.append((elapsed, label, peak))
+                if growth is not None:
+                    self.worst = (peak, label, growth)
+            due = self.sampled >= self.dump_every
+        if due:
+            self.dump()
+
+    def _write(self, path: str, data: bytes) -> None:
+        # 書きかけのファイルを読まれないよう一時ファイルから rename する
+        tmp = f"{path}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+    def dump(self) -> List[str]:
+        """集計をスプールに書き出してリセットし、書いたファイルのパスを返す"""
+        with self._lock:
+            stats, sampled, labels = self.stats, self.sampled, dict(self.labels)
+            peaks, worst = list(self.peaks), self.worst
+            self._reset()
+        if stats is None:
+            return []
+        os.makedirs(self.directory, exist_ok=True)
+        stem = f"{os.getpid()}-{time.strftime('%Y%m%dT%H%M%S')}-{time.time_ns() % 1000000:06d}"
+        written = []
+
+        path = os.path.join(self.directory, f"profile-{stem}.pstats")
+        stats.dump_stats(f"{path}.tmp")
+        os.replace(f"{path}.tmp", path)
+        written.append(path)
+
+        out = io.StringIO()
+        out.write(f"sampled messages: {sampled} (1 in {self.sample_rate or '-'}) {labels}\n\n")
+        stats.stream = out
+        stats.sort_stats("cumulative").print_stats(PROFILE_TOP)
+        path = os.path.join(self.directory, f"profile-{stem}.txt")
+        self._write(path, out.getvalue().encode("utf-8"))
+        written.append(path)
+
+        if peaks:
+            out = io.StringIO()
+            sizes = sorted(p for _, _, p in peaks)
+            out.write(f"sampled messages: {len(peaks)}\n")
+            out.write(f"peak allocation per message (bytes): min={sizes[0]} "
+                      f"median={sizes[len(sizes) // 2]} max={sizes[-1]}\n")
+            out.write(f"mean time per message: {sum(e for e, _, _ in peaks) / len(peaks) * 1000:.3f} ms\n")
+            if worst is not None:
+                peak, label, growth = worst
+                out.write(f"\nallocations added by the heaviest message ({label}, peak {peak} bytes):\n")
+                for stat in growth:
+                    out.write(f"{stat}\n")
+            path = os.path.join(self.directory, f"memory-{stem}.txt")
+            self._write(path, out.getvalue().encode("utf-8"))
+            written.append(path)
+        return written
+
+    def install_signal_handlers(self, toggle_sample: int = PROFILE_TOGGLE_SAMPLE) -> None:
+        """SIGUSR1 で有効/無効を切り替え、SIGUSR2 でレポートを書き出す（メインスレッドから呼ぶ）"""
+        default = self.sample_rate or toggle_sample
+
+        def toggle(signum, frame):
+            if self.enabled:
+                self.sample_rate = 0
+                threading.Thread(target=self.disable, name="profile-dump", daemon=True).start()
+            else:
+                self.enable(default)
+            # subprocess モードのハンドラは環境変数を引き継ぐ
+            os.environ["ACTIVITYPUB_PROFILE_SAMPLE"] = str(self.sample_rate)
+
+        def dump(signum, frame):
+            # シグナルハンドラ内で重い処理をしないよう別スレッドで書く
+            threading.Thread(target=self.dump, name="profile-dump", daemon=True).start()
+
+        signal.signal(signal.SIGUSR1, toggle)
+        signal.signal(signal.SIGUSR2, dump)
+
+
+PROFILER = Profiler()
+if PROFILER.enabled:
+    PROFILER.enable(PROFILER.sample_rate)
+atexit.register(PROFILER.dump)
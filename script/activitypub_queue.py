@@ -0,0 +1,366 @@
+"""Durable outbound delivery queue.
+
+Request handlers only enqueue; a worker (``activitypub-send.py --worker``)
+drains the queue with retries. The queue is a maildir-style spool, so every
+state change is a single atomic ``rename(2)`` and nothing is lost on a crash::
+
+    queue/
+        tmp/    job files being written (fsync'd, then renamed into new/)
+        new/    ready jobs, named <not-before-ms>-<uuid>.json so a sorted
+                listing yields them in due order
+        cur/    jobs claimed by a worker (claim = rename new/ -> cur/)
+        dead/   jobs that failed MAX_ATTEMPTS times
+
+A job only references the outbox entry (``seq``, or ``seqs`` for a batch that
+is sent as one message whose body is the list of activities) plus its envelope
+and transport; the activity itself stays in the outbox store. Failed jobs are
+re-spooled with exponential backoff and jitter. Claims left in ``cur/`` by a
+crashed worker are returned to ``new/`` after ``LEASE_SECONDS``.
+"""
+from __future__ import annotations
+
+import json
+import logging
+import os
+import random
+import threading
+import time
+import uuid
+from datetime import datetime
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple, Union
+
+from activitypub_store import DATA_DIR
+from activitypub_outbox import QUEUED, OutboxDelivery, open_outbox
+
+QUEUE_DIR = os.environ.get("ACTIVITYPUB_QUEUE_DIR", os.path.join(DATA_DIR, "queue"))
+MAX_ATTEMPTS = int(os.environ.get("ACTIVITYPUB_QUEUE_MAX_ATTEMPTS", "8"))
+BACKOFF_BASE = float(os.environ.get("ACTIVITYPUB_QUEUE_BACKOFF_BASE", "5"))    # 秒
+BACKOFF_MAX = float(os.environ.get("ACTIVITYPUB_QUEUE_BACKOFF_MAX", "3600"))   # 秒
+LMTP_SOCKET = os.environ.get("ACTIVITYPUB_LMTP_SOCKET", "/var/run/dovecot/lmtp")
+LMTP_FALLBACK = {"host": "127.0.0.1", "port": 2626}
+LEASE_SECONDS = 300   # これより古い cur/ のジョブはワーカーのクラッシュとみなして戻す
+POLL_INTERVAL = 1.0
+# BatchSubmitter: この秒数の間に追加された activity を 1 回の書き込み・1 通のメールにまとめる
+BATCH_WINDOW = float(os.environ.get("ACTIVITYPUB_BATCH_WINDOW", "0.1"))
+BATCH_MAX = int(os.environ.get("ACTIVITYPUB_BATCH_MAX", "1000"))   # これだけ溜まったら窓を待たずに書く
+
+logger = logging.getLogger("activitypub-queue")
+
+
+def default_transport() -> Dict[str, Any]:
+    """返信は Dovecot LMTP ソケットを優先。無ければ 127.0.0.1:2626"""
+    if os.path.exists(LMTP_SOCKET):
+        return {"socket": LMTP_SOCKET}
+    return dict(LMTP_FALLBACK)
+
+
+def job_seqs(job: Dict[str, Any]) -> List[int]:
+    """ジョブが対象とする outbox の seq（バッチなら複数）"""
+    return list(job.get("seqs") or [job["seq"]])
+
+
+def backoff_delay(attempts: int) -> float:
+    """attempts 回失敗した後の待ち時間（指数バックオフ + ±50% のジッター）"""
+    delay = min(BACKOFF_MAX, BACKOFF_BASE * (2 ** max(0, attempts - 1)))
+    return delay * random.uniform(0.5, 1.5)
+
+
+class DeliveryQueue:
+    """スプールディレクトリ上の永続キュー。複数プロセス・複数スレッドから同時に使える。"""
+
+    def __init__(self, directory: str = QUEUE_DIR, max_attempts: int = MAX_ATTEMPTS):
+        self.directory = directory
+        self.max_attempts = max_attempts
+        for sub in ("tmp", "new", "cur", "dead"):
+            os.makedirs(os.path.join(directory, sub), exist_ok=True)
+
+    def _path(self, sub: str, name: str = "") -> str:
+        return os.path.join(self.directory, sub, name)
+
+    def _spool(self, job: Dict[str, Any], sub: str = "new", not_before: Optional[float] = None) -> str:
+        """tmp/ に書いて fsync し、rename で公開する"""
+        due = int((not_before if not_before is not None else time.time()) * 1000)
+        name = f"{due:013d}-{uuid.uuid4().hex}.json"
+        tmp = self._path("tmp", name)
+        with open(tmp, "w") as f:
+            json.dump(job, f, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, self._path(sub, name))
+        return name
+
+    def enqueue(self, seq: Union[int, List[int]], mail_from: str, rcpt_to, outbox: str,
+                transport: Optional[Dict[str, Any]] = None) -> str:
+        """outbox の seq 番のエントリを配送待ちに積む。seq がリストなら 1 通にまとめて送るバッチ"""
+        job: Dict[str, Any] = {
+            "seq": seq[0] if isinstance(seq, list) else seq,
+            "outbox": str(outbox),
+            "mail_from": mail_from,
+            "rcpt_to": [rcpt_to] if isinstance(rcpt_to, str) else list(rcpt_to),
+            "transport": transport or {},
+            "attempts": 0,
+            "enqueued_at": datetime.utcnow().isoformat() + "Z",
+        }
+        if isinstance(seq, list):
+            job["seqs"] = seq
+        return self._spool(job)
+
+    def claim(self) -> Optional[Tuple[str, Dict[str, Any]]]:
+        """期限の来たジョブを 1 件確保する。なければ None"""
+        now_ms = int(time.time() * 1000)
+        for name in sorted(os.listdir(self._path("new"))):
+            if not name.endswith(".json"):
+                continue
+            if int(name.split("-", 1)[0]) > now_ms:
+                break  # 名前順＝期限順なので以降はすべて未来
+            try:
+                os.rename(self._path("new", name), self._path("cur", name))
+            except FileNotFoundError:
+                continue  # 他のワーカーが先に確保した
+            # 確保時刻をリースの起点にする
+            os.utime(self._path("cur", name))
+            with open(self._path("cur", name)) as f:
+                return name, json.load(f)
+        return None
+
+    def complete(self, name: str) -> None:
+        os.unlink(self._path("cur", name))
+
+    def retry(self, name: str, job: Dict[str, Any], error: str) -> bool:
+        """失敗を記録して再スプールする。上限に達したら dead/ へ移し False を返す"""
+        job = dict(job, attempts=job.get("attempts", 0) + 1, last_error=error,
+                   last_attempt_at=datetime.utcnow().isoformat() + "Z")
+        if job["attempts"] >= self.max_attempts:
+            self._spool(job, sub="dead")
+            os.unlink(self._path("cur", name))
+            return False
+        self._spool(job, not_before=time.time() + backoff_delay(job["attempts"]))
+        os.unlink(self._path("cur", name))
+        return True
+
+    def recover(self, lease_seconds: float = LEASE_SECONDS) -> int:
+        """クラッシュしたワーカーが cur/ に残したジョブを new/ に戻す"""
+        restored = 0
+        cutoff = time.time() - lease_seconds
+        for name in os.listdir(self._path("cur")):
+            path = self._path("cur", name)
+            try:
+                if os.stat(path).st_mtime < cutoff:
+                    os.rename(path, self._path("new", name))
+                    restored += 1
+            except FileNotFoundError:
+                continue
+        return restored
+
+    def requeue_dead(self) -> int:
+        """dead/ のジョブを試行回数をリセットして戻す"""
+        count = 0
+        for name in os.listdir(self._path("dead")):
+            with open(self._path("dead", name)) as f:
+                job = json.load(f)
+            self._spool(dict(job, attempts=0))
+            os.unlink(self._path("dead", name))
+            count += 1
+        return count
+
+    def dead(self) -> List[Dict[str, Any]]:
+        jobs = []
+        for name in sorted(os.listdir(self._path("dead"))):
+            with open(self._path("dead", name)) as f:
+                jobs.append(json.load(f))
+        return jobs
+
+    def stats(self) -> Dict[str, int]:
+        return {sub: len(os.listdir(self._path(sub))) for sub in ("new", "cur", "dead")}
+
+
+class QueueWorker:
+    """キューを並列に処理するワーカー。
+
+    send(job) は送信に成功すれば何か（結果）を返し、失敗なら例外を送出する。
+    on_sent / on_retry / on_dead は配送状態の記録に使うフック。
+    """
+
+    def __init__(self, queue: DeliveryQueue, send: Callable[[Dict[str, Any]], Any],
+                 parallelism: int = 4, poll_interval: float = POLL_INTERVAL,
+                 on_sent: Optional[Callable[[Dict[str, Any], Any], None]] = None,
+                 on_retry: Optional[Callable[[Dict[str, Any], str], None]] = None,
+                 on_dead: Optional[Callable[[Dict[str, Any], str], None]] = None):
+        self.queue = queue
+        self.send = send
+        self.parallelism = max(1, parallelism)
+        self.poll_interval = poll_interval
+        self.on_sent = on_sent
+        self.on_retry = on_retry
+        self.on_dead = on_dead
+        self._stop = threading.Event()
+
+    def run_once(self) -> bool:
+        """1 件処理する。処理するジョブがなければ False"""
+        claimed = self.queue.claim()
+        if claimed is None:
+            return False
+        name, job = claimed
+        try:
+            result = self.send(job)
+        except Exception as e:
+            error = str(e) or e.__class__.__name__
+            if self.queue.retry(name, job, error):
+                logger.warning(f"delivery retry seq={job.get('seq')} attempts={job.get('attempts', 0) + 1}: {error}")
+                if self.on_retry:
+                    self.on_retry(job, error)
+            else:
+                logger.error(f"delivery dead-lettered seq={job.get('seq')}: {error}")
+                if self.on_dead:
+                    self.on_dead(job, error)
+            return True
+        self.queue.complete(name)
+        logger.info(f"delivered seq={job.get('seq')}")
+        if self.on_sent:
+            self.on_sent(job, result)
+        return True
+
+    def _loop(self) -> None:
+        while not self._stop.is_set():
+            try:
+                busy = self.run_once()
+            except Exception as e:
+                logger.exception(f"worker error: {e}")
+                busy = False
+            if not busy:
+                self._stop.wait(self.poll_interval)
+
+    def run(self) -> None:
+        """parallelism 本のスレッドで処理を続ける（stop() まで戻らない）"""
+        restored = self.queue.recover()
+        if restored:
+            logger.info(f"recovered {restored} stale job(s)")
+        threads = [threading.Thread(target=self._loop, name=f"queue-worker-{i}", daemon=True)
+                   for i in range(self.parallelism)]
+        for t in threads:
+            t.start()
+        try:
+            while any(t.is_alive() for t in threads):
+                for t in threads:
+                    t.join(timeout=1.0)
+        except KeyboardInterrupt:
+            self.stop()
+
+    def stop(self) -> None:
+        self._stop.set()
+
+
+def submit(delivery: OutboxDelivery, queue: DeliveryQueue, activity: Any, mail_from: str,
+           rcpt_to, transport: Optional[Dict[str, Any]] = None) -> int:
+    """outbox に追記して配送キューに積み、seq を返す。
+
+    pending で記録してからジョブを書き、最後に queued にする。ジョブを書く前に落ちても
+    pending のまま残るので ``activitypub-send.py --flush`` で拾える。書いた後に落ちた場合は
+    ワーカーが送信ロックの中で queued にしてから送るので、--flush と二重に送ることはない。
+    """
+    return submit_many(delivery, queue, [(activity, mail_from, rcpt_to)], transport)[0]
+
+
+def submit_many(delivery: OutboxDelivery, queue: DeliveryQueue, items: Iterable[Tuple[Any, str, Any]],
+                transport: Optional[Dict[str, Any]] = None) -> List[int]:
+    """(activity, mail_from, rcpt_to) をまとめて outbox に追記し、seq のリストを返す。
+
+    outbox と配送状態ログへの書き込みはそれぞれ 1 回。同じ送信元・宛先の activity は
+    1 つのジョブ（= 1 通のメール、1 回の LMTP トランザクション）にまとめる。
+    """
+    items = list(items)
+    if not items:
+        return []
+    seqs = delivery.enqueue_many(items)
+    groups: Dict[Tuple[str, Tuple[str, ...]], List[int]] = {}
+    for seq, (_, mail_from, rcpt_to) in zip(seqs, items):
+        rcpts = (rcpt_to,) if isinstance(rcpt_to, str) else tuple(rcpt_to)
+        groups.setdefault((mail_from, rcpts), []).append(seq)
+    transport = transport or default_transport()
+    for (mail_from, rcpts), group in groups.items():
+        queue.enqueue(group if len(group) > 1 else group[0], mail_from, list(rcpts),
+                      outbox=delivery.outbox_path, transport=transport)
+    delivery.mark_many(seqs, QUEUED, attempt=False)
+    return seqs
+
+
+class BatchSubmitter:
+    """submit_many() を短い時間窓でまとめる。
+
+    add() した activity は window 秒後（または max_items 件に達した時点）に 1 回の
+    submit_many() で書き込まれる。window が 0 以下なら add() のたびに即座に書く。
+    窓の途中でプロセスが終了する場合に備え、終了前に flush() を呼ぶこと。
+    """
+
+    def __init__(self, outbox_path: str, queue: Optional[DeliveryQueue] = None,
+                 window: float = BATCH_WINDOW, max_items: int = BATCH_MAX,
+                 transport: Optional[Dict[str, Any]] = None,
+                 on_flush: Optional[Callable[[List[int]], None]] = None,
+                 on_error: Optional[Callable[[Exception, int], None]] = None):
+        self.outbox_path = str(outbox_path)
+        self.queue = queue
+        self.window = window
+        self.max_items = max(1, max_items)
+        self.transport = transport
+        self.on_flush = on_flush
+        self.on_error = on_error
+        self._items: List[Tuple[Any, str, Any]] = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._timer: Optional[threading.Timer] = None
+
+    def add(self, items: Iterable[Tuple[Any, str, Any]]) -> None:
+        with self._lock:
+            self._items.extend(items)
+            if not self._items:
+                return
+            immediate = self.window <= 0 or len(self._items) >= self.max_items
+            if not immediate and self._timer is None:
+                self._timer = threading.Timer(self.window, self._flush_quietly)
+                self._timer.daemon = True
+                self._timer.start()
+        if immediate:
+            self.flush()
+
+    def flush(self) -> List[int]:
+        """溜まっている activity を書き込み、seq のリストを返す"""
+        with self._flush_lock:
+            with self._lock:
+                items, self._items = self._items, []
+                if self._timer is not None:
+                    self._timer.cancel()
+                    self._timer = None
+            if not items:
+                return []
+            try:
+                seqs = submit_many(open_outbox(self.outbox_path), self.queue or open_queue(),
+                                   items, self.transport)
+            except Exception as e:
+                # on_error があれば (例外, 失われた件数) を渡す。なければ呼び出し元へ
+                if self.on_error is None:
+                    raise
+                self.on_error(e, len(items))
+                return []
+        if self.on_flush:
+            self.on_flush(seqs)
+        return seqs
+
+    def _flush_quietly(self) -> None:
+        """タイマースレッドから呼ばれる"""
+        try:
+            self.flush()
+        except Exception as e:
+            logger.exception(f"batch submit failed: {e}")
+
+
+_QUEUES: Dict[str, DeliveryQueue] = {}
+_QUEUES_LOCK = threading.Lock()
+
+
+def open_queue(directory: str = QUEUE_DIR) -> DeliveryQueue:
+    key = os.path.abspath(directory)
+    with _QUEUES_LOCK:
+        queue = _QUEUES.get(key)
+        if queue is None:
+            queue = _QUEUES[key] = DeliveryQueue(key)
+        return queue
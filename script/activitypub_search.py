@@ -0,0 +1,317 @@
+"""Incrementally maintained inverted index for filtering and searching the inbox.
+
+Filtering ``/api/inbox`` by type, actor, sender, recipient, time range or free
+text used to scan the store (or happen in the browser). The index keeps posting
+lists of sequence numbers, in store order::
+
+    type      -> [seq, ...]     activity type (every activity of a record)
+    actor     -> [seq, ...]     activity actor id
+    sender    -> [seq, ...]     envelope sender address ("from")
+    recipient -> [seq, ...]     envelope recipient addresses ("to")
+    token     -> [seq, ...]     words of the subject, body and activity / object
+                                content, name and summary (CJK text as bigrams)
+
+and the timestamp of every record. A query walks the shortest posting list from
+the requested end and checks the others by bisection, so "Creates from actor X
+in the last hour" costs the size of the smallest matching list, not the size of
+the store. Like :class:`activitypub_threads.ThreadIndex`, the index is built
+lazily on the first query and :meth:`SearchIndex.refresh` only reads records
+appended since the previous call.
+"""
+from __future__ import annotations
+
+import os
+import re
+import threading
+from bisect import bisect_left, bisect_right
+from datetime import datetime, timedelta
+from email.utils import parseaddr
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+from activitypub_store import open_store
+
+MAX_TOKENS_PER_RECORD = 1000   # 1 件から索引に入れる語の上限（巨大な本文で索引が膨らまないように）
+TEXT_FIELDS = ("content", "name", "summary")
+
+_WORD = re.compile(r"\w+")
+_TAG = re.compile(r"<[^>]+>")
+_DURATION = re.compile(r"^(\d+(?:\.\d+)?)([smhdw]?)$")
+_UNITS = {"": 1, "s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800}
+
+
+def tokenize(text: str) -> List[str]:
+    """小文字の語に分ける。ASCII 以外（日本語など）の連なりは 2 文字ずつ（bigram）にする"""
+    tokens = []
+    for word in _WORD.findall(text.lower()):
+        if word.isascii():
+            if len(word) > 1:
+                tokens.append(word)
+        elif len(word) == 1:
+            tokens.append(word)
+        else:
+            tokens.extend(word[i:i + 2] for i in range(len(word) - 1))
+    return tokens
+
+
+def address(value: Any) -> Optional[str]:
+    """"Name <user@host>" / "user@host" をどちらも小文字のアドレスにする"""
+    if not isinstance(value, str) or not value:
+        return None
+    return (parseaddr(value)[1] or value).strip().lower()
+
+
+def parse_duration(value: str) -> timedelta:
+    """"90"（秒）/ "15m" / "1h" / "7d" などを timedelta にする（不正な値は ValueError）"""
+    match = _DURATION.match(value.strip().lower())
+    if not match:
+        raise ValueError(f"invalid duration: {value}")
+    return timedelta(seconds=float(match.group(1)) * _UNITS[match.group(2)])
+
+
+def _str(value: Any) -> Optional[str]:
+    if isinstance(value, dict):
+        value = value.get("id")
+    return value if isinstance(value, str) and value else None
+
+
+def _activities(record: Any) -> Iterator[dict]:
+    activity = record.get("activity", record) if isinstance(record, dict) else record
+    for item in activity if isinstance(activity, list) else [activity]:
+        if isinstance(item, dict):
+            yield item
+
+
+def _texts(record: Any) -> Iterator[str]:
+    if isinstance(record, dict):
+        for key in ("subject", "body"):
+            if isinstance(record.get(key), str):
+                yield record[key]
+    for activity in _activities(record):
+        for obj in (activity, activity.get("object")):
+            if isinstance(obj, dict):
+                for key in TEXT_FIELDS:
+                    if isinstance(obj.get(key), str):
+                        yield _TAG.sub(" ", obj[key])
+
+
+def record_terms(record: Any) -> Dict[str, Set[str]]:
+    """レコードから索引に入れる語を種類ごとに取り出す"""
+    terms: Dict[str, Set[str]] = {"type": set(), "actor": set(), "sender": set(), "recipient": set(), "token": set()}
+    for activity in _activities(record):
+        if isinstance(activity.get("type"), str):
+            terms["type"].add(activity["type"])
+        actor = _str(activity.get("actor"))
+        if actor:
+            terms["actor"].add(actor)
+    if isinstance(record, dict):
+        sender = address(record.get("from"))
+        if sender:
+            terms["sender"].add(sender)
+        to = record.get("to")
+        for value in to if isinstance(to, list) else [to]:
+            recipient = address(value)
+            if recipient:
+                terms["recipient"].add(recipient)
+    tokens = terms["token"]
+    for text in _texts(record):
+        for token in tokenize(text):
+            if len(tokens) >= MAX_TOKENS_PER_RECORD:
+                break
+            tokens.add(token)
+    return terms
+
+
+def _timestamp(record: Any) -> str:
+    if not isinstance(record, dict):
+        return ""
+    value = record.get("timestamp")
+    if not isinstance(value, str):
+        activity = next(_activities(record), {})
+        value = activity.get("timestamp") or activity.get("published")
+    return value[:26] if isinstance(value, str) else ""
+
+
+def _contains(seqs: List[int], seq: int) -> bool:
+    i = bisect_left(seqs, seq)
+    return i < len(seqs) and seqs[i] == seq
+
+
+class SearchIndex:
+    """type / actor / sender / recipient / 語 → seq 一覧と、seq ごとの時刻を持つ索引。"""
+
+    FIELDS = ("type", "actor", "sender", "recipient", "token")
+
+    def __init__(self, store):
+        self.store = store
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self) -> None:
+        self.position = 0
+        self.first = 0                # これより前の seq はアーカイブへ移され、索引から外した
+        self._version_prefix = self._prefix()
+        self.postings: Dict[str, Dict[str, List[int]]] = {field: {} for field in self.FIELDS}
+        self.seqs: List[int] = []     # 索引済みの seq（昇順）
+        self.times: List[str] = []    # seqs と同じ並びの timestamp
+        self.ordered = True           # times が昇順か（inbox は受信順なので通常は昇順）
+
+    def _prefix(self) -> str:
+        # version() の先頭は世代（JSONL はディレクトリの inode）。rewrite で変わったら作り直す
+        return self.store.version().split("-", 1)[0]
+
+    def add(self, seq: int, record: Any) -> None:
+        for field, values in record_terms(record).items():
+            postings = self.postings[field]
+            for value in values:
+                postings.setdefault(value, []).append(seq)
+        ts = _timestamp(record)
+        if self.times and ts < self.times[-1]:
+            self.ordered = False
+        self.seqs.append(seq)
+        self.times.append(ts)
+
+    def refresh(self) -> "SearchIndex":
+        """前回以降に追記されたレコードだけを索引に加える"""
+        with self._lock:
+            end = len(self.store)
+            if end < self.position or self._prefix() != self._version_prefix:
+                self._reset()
+            first = self.store.first_seq()
+            if first > self.first:
+                self._discard(first)
+            for seq, record in self.store.iter_from(self.position, end):
+                self.add(seq, record)
+            self.position = max(self.position, end)
+        return self
+
+    def _discard(self, first: int) -> None:
+        """アーカイブへ移された（first より前の）seq を索引から外す（limit 件に満たない結果を防ぐ）"""
+        for postings in self.postings.values():
+            for value in list(postings):
+                seqs = postings[value]
+                i = bisect_left(seqs, first)
+                if i == len(seqs):
+                    del postings[value]
+                elif i:
+                    del seqs[:i]
+        i = bisect_left(self.seqs, first)
+        del self.seqs[:i], self.times[:i]
+        self.first = first
+
+    def _time_of(self, seq: int) -> str:
+        return self.times[bisect_left(self.seqs, seq)]
+
+    def _time_bounds(self, since: Optional[str], until: Optional[str]) -> Tuple[int, int]:
+        """times が昇順のとき、時刻の範囲を seqs の添字の範囲 [lo, hi) にする"""
+        lo = bisect_left(self.times, since) if since else 0
+        hi = bisect_left(self.times, until) if until else len(self.times)
+        return lo, hi
+
+    def search(self, type: Optional[str] = None, actor: Optional[str] = None,
+               sender: Optional[str] = None, recipient: Optional[str] = None,
+               q: Optional[str] = None, since: Optional[str] = None, until: Optional[str] = None,
+               newest_first: bool = False, limit: Optional[int] = None,
+               after: Optional[int] = None, before: Optional[int] = None) -> List[int]:
+        """条件にすべて合う seq を返す。q は空白区切りの語の AND、since / until は ISO 時刻（until は含まない）"""
+        self.refresh()
+        terms: List[Tuple[str, str]] = [(f, v) for f, v in (("type", type), ("actor", actor),
+                                                            ("sender", address(sender)),
+                                                            ("recipient", address(recipient))) if v]
+        tokens = list(dict.fromkeys(tokenize(q or "")))
+        if q and not tokens:
+            return []   # 索引に入らない語（1 文字の英数字など）だけの検索。他の条件があっても q は無視しない
+        terms += [("token", t) for t in tokens]
+        with self._lock:
+            lists = []
+            for field, value in terms:
+                seqs = self.postings[field].get(value)
+                if not seqs:
+                    return []
+                lists.append(seqs)
+            lists.sort(key=len)
+
+            time_filter = bool(since or until)
+            if time_filter and self.ordered:
+                # 時刻の範囲を seq の範囲に置き換える
+                lo, hi = self._time_bounds(since, until)
+                if lo >= hi:
+                    return []
+                after = max(after if after is not None else -1, self.seqs[lo] - 1)
+                before = min(before if before is not None else self.seqs[-1] + 1, self.seqs[hi - 1] + 1)
+                time_filter = False
+
+            base = lists[0] if lists else self.seqs
+            others = lists[1:]
+            start = bisect_right(base, after) if after is not None else 0
+            stop = bisect_left(base, before) if before is not None else len(base)
+            candidates: Iterable[int] = (base[i] for i in (range(stop - 1, start - 1, -1) if newest_first
+                                                           else range(start, stop)))
+            result: List[int] = []
+            for seq in candidates:
+                if others and not all(_contains(seqs, seq) for seqs in others):
+                    continue
+                if time_filter:
+                    ts = self._time_of(seq)
+                    if (since and ts < since) or (until and ts >= until):
+                        continue
+                result.append(seq)
+                if limit is not None and len(result) >= limit:
+                    break
+            return result
+
+    def query(self, **filters: Any) -> List[Tuple[int, Any]]:
+        """search() と同じ引数で (seq, record) を返す（アーカイブへ移されたものは除く）"""
+        rows = []
+        for seq in self.search(**filters):
+            try:
+                rows.append((seq, self.store.get(seq)))
+            except IndexError:
+                pass
+        return rows
+
+
+def matches(record: Any, type: Optional[str] = None, actor: Optional[str] = None,
+            sender: Optional[str] = None, recipient: Optional[str] = None,
+            q: Optional[str] = None, since: Optional[str] = None, until: Optional[str] = None) -> bool:
+    """索引を使わずに 1 件が条件に合うかを判定する（アーカイブの検索用）"""
+    terms = record_terms(record)
+    for field, value in (("type", type), ("actor", actor), ("sender", address(sender)),
+                         ("recipient", address(recipient))):
+        if value and value not in terms[field]:
+            return False
+    if q:
+        tokens = tokenize(q)
+        if not tokens or not terms["token"].issuperset(tokens):
+            return False
+    ts = _timestamp(record)
+    return not ((since and ts < since) or (until and ts >= until))
+
+
+def time_range(start: Optional[str] = None, end: Optional[str] = None,
+               within: Optional[str] = None, now: Optional[datetime] = None) -> Tuple[Optional[str], Optional[str]]:
+    """API の start / end（ISO 時刻）と within（"1h" など、現在からさかのぼる期間）を (since, until) にする"""
+    since = start or None
+    if within:
+        cutoff = ((now or datetime.now()) - parse_duration(within)).isoformat()
+        since = max(since, cutoff) if since else cutoff
+    for value in (since, end):
+        if value:
+            try:
+                datetime.fromisoformat(value.replace("Z", "+00:00"))
+            except ValueError:
+                raise ValueError(f"invalid timestamp: {value}")
+    return since, end or None
+
+
+_INDEXES: Dict[str, SearchIndex] = {}
+_INDEXES_LOCK = threading.Lock()
+
+
+def open_search_index(path) -> SearchIndex:
+    """ストアごとに 1 つの索引を返す（プロセス内で共有）"""
+    key = os.path.abspath(str(path))
+    with _INDEXES_LOCK:
+        index = _INDEXES.get(key)
+        if index is None:
+            index = _INDEXES[key] = SearchIndex(open_store(key))
+        return index
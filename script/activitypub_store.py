@@ -0,0 +1,679 @@
+"""Append-only storage for ActivityPub collections (inbox / outbox / messages).
+
+Each collection that used to live in a single JSON array (``inbox.json``) is
+stored as a directory of JSONL segments with a sidecar offset index::
+
+    inbox.json              legacy array, migrated once and renamed to inbox.json.migrated
+    inbox.lock              flock(2) target serialising writers across processes
+    inbox.d/
+        000000000000.jsonl  one JSON record per line
+        000000000000.idx    start offset of every record (8-byte little-endian)
+        000000004711.jsonl  next segment; the file name is its first sequence number
+        ...
+
+Appends are O(1): one line is written to the active segment and its offset is
+appended to the index. Records are addressed by a global sequence number
+(0-based, in append order), which the index turns into a single seek.
+
+Old segments can be moved out of the live directory into compressed archives
+(see ``activitypub_archive.py``); sequence numbers are never reused, so the live
+store simply starts at :meth:`JsonlStore.first_seq` afterwards.
+
+With ``ACTIVITYPUB_STORE_BACKEND=sqlite`` the same collections are kept in a
+single SQLite database (``activitypub.sqlite3``, WAL mode) with indexes on the
+activity ``type``, ``actor``, ``timestamp`` and ``id``. Both backends expose
+the same interface through :func:`open_store`.
+"""
+from __future__ import annotations
+
+import fcntl
+import json
+import os
+import shutil
+import sqlite3
+import struct
+import threading
+from bisect import bisect_right
+from contextlib import contextmanager
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+DATA_DIR = os.environ.get("ACTIVITYPUB_DATA_DIR", "/var/www/activitypub")
+SEGMENT_MAX_BYTES = int(os.environ.get("ACTIVITYPUB_SEGMENT_MAX_BYTES", str(64 * 1024 * 1024)))
+# "jsonl"（既定）または "sqlite"
+STORE_BACKEND = os.environ.get("ACTIVITYPUB_STORE_BACKEND", "jsonl")
+SQLITE_FILENAME = "activitypub.sqlite3"
+
+_OFFSET = struct.Struct("<Q")
+_SEGMENT_DIGITS = 12
+
+
+def _encode(record: Any) -> bytes:
+    return (json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n").encode("utf-8")
+
+
+def _legacy_items(path: str) -> List[Any]:
+    """旧形式の JSON 配列ファイルを読み込む（壊れている・空の場合は空リスト）"""
+    try:
+        with open(path, "r") as f:
+            data = json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return []
+    if isinstance(data, list):
+        return data
+    if isinstance(data, dict):
+        for key in ("orderedItems", "items"):
+            if isinstance(data.get(key), list):
+                return data[key]
+        return [data]
+    return []
+
+
+def record_fields(record: Any) -> Dict[str, Optional[str]]:
+    """レコードから索引用の項目（timestamp / type / actor / id）を取り出す。
+
+    inbox のレコードは {"timestamp", "from", "to", "subject", "activity"} 形式、
+    outbox / messages はアクティビティそのもの（または要約）なので両方に対応する。
+    """
+    if not isinstance(record, dict):
+        return {"timestamp": None, "type": None, "actor": None, "id": None}
+    activity = record.get("activity", record)
+    if isinstance(activity, list):
+        activity = next((a for a in activity if isinstance(a, dict)), {})
+    if not isinstance(activity, dict):
+        activity = {}
+    actor = activity.get("actor")
+    if isinstance(actor, dict):
+        actor = actor.get("id")
+    timestamp = record.get("timestamp") or activity.get("timestamp") or activity.get("published")
+    return {
+        "timestamp": timestamp if isinstance(timestamp, str) else None,
+        "type": activity.get("type") if isinstance(activity.get("type"), str) else None,
+        "actor": actor if isinstance(actor, str) else None,
+        "id": activity.get("id") if isinstance(activity.get("id"), str) else None,
+    }
+
+
+def _matches(record: Any, type: Optional[str], actor: Optional[str],
+             since: Optional[str], until: Optional[str]) -> bool:
+    fields = record_fields(record)
+    if type is not None and fields["type"] != type:
+        return False
+    if actor is not None and fields["actor"] != actor:
+        return False
+    ts = fields["timestamp"] or ""
+    if since is not None and ts < since:
+        return False
+    if until is not None and ts >= until:
+        return False
+    return True
+
+
+class _Segment:
+    __slots__ = ("start", "data_path", "index_path")
+
+    def __init__(self, directory: str, start: int):
+        self.start = start
+        name = f"{start:0{_SEGMENT_DIGITS}d}"
+        self.data_path = os.path.join(directory, name + ".jsonl")
+        self.index_path = os.path.join(directory, name + ".idx")
+
+    def count(self) -> int:
+        try:
+            return os.path.getsize(self.index_path) // _OFFSET.size
+        except FileNotFoundError:
+            return 0
+
+    def offset(self, local: int) -> int:
+        with open(self.index_path, "rb") as f:
+            f.seek(local * _OFFSET.size)
+            return _OFFSET.unpack(f.read(_OFFSET.size))[0]
+
+
+class JsonlStore:
+    """JSONL セグメント + オフセットインデックスによる追記型コレクション。"""
+
+    def __init__(self, path: str, segment_bytes: int = SEGMENT_MAX_BYTES):
+        self.path = str(path)
+        base = self.path[:-5] if self.path.endswith(".json") else self.path
+        self.directory = base + ".d"
+        self.lock_path = base + ".lock"
+        self.segment_bytes = segment_bytes
+        self._mutex = threading.RLock()
+        self._recovered = False
+        if not os.path.isdir(self.directory) or os.path.exists(self.path):
+            self.migrate()
+
+    # --- locking / layout -------------------------------------------------
+
+    @contextmanager
+    def _locked(self):
+        with self._mutex:
+            os.makedirs(os.path.dirname(self.lock_path) or ".", exist_ok=True)
+            with open(self.lock_path, "a") as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _segments(self) -> List[_Segment]:
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        starts = sorted(int(n[:-4]) for n in names if n.endswith(".idx") and n[:-4].isdigit())
+        return [_Segment(self.directory, s) for s in starts]
+
+    def _locate(self, seq: int) -> Tuple[_Segment, int]:
+        segments = self._segments()
+        pos = bisect_right([s.start for s in segments], seq) - 1
+        if pos < 0 or seq < 0:
+            raise IndexError(seq)
+        segment = segments[pos]
+        local = seq - segment.start
+        if local >= segment.count():
+            raise IndexError(seq)
+        return segment, local
+
+    def _recover(self, segment: _Segment) -> None:
+        """クラッシュ等で中断された追記を修復する（ロック保持中に呼ぶ）。
+
+        インデックス末尾の半端なエントリを切り詰め、インデックスに載っていない
+        完全な行は索引に追加し、改行で終わらない最終行は捨てる。
+        """
+        if not os.path.exists(segment.data_path):
+            open(segment.data_path, "ab").close()
+        with open(segment.index_path, "ab") as idx:
+            size = idx.tell()
+            if size % _OFFSET.size:
+                idx.truncate(size - size % _OFFSET.size)
+        count = segment.count()
+        with open(segment.data_path, "rb+") as data:
+            if count:
+                data.seek(segment.offset(count - 1))
+                data.readline()
+            pos = data.tell()
+            missing = []
+            for line in iter(data.readline, b""):
+                if not line.endswith(b"\n"):
+                    break
+                missing.append(pos)
+                pos += len(line)
+            data.truncate(pos)
+        if missing:
+            with open(segment.index_path, "ab") as idx:
+                idx.write(b"".join(_OFFSET.pack(o) for o in missing))
+
+    # --- public API -------------------------------------------------------
+
+    def migrate(self) -> None:
+        """旧形式の JSON 配列（inbox.json 等）をセグメントへ一度だけ移行する。"""
+        with self._locked():
+            if not os.path.isdir(self.directory):
+                tmp = self.directory + ".tmp"
+                shutil.rmtree(tmp, ignore_errors=True)
+                os.makedirs(tmp)
+                segment = _Segment(tmp, 0)
+                offsets = []
+                with open(segment.data_path, "wb") as data:
+                    for item in _legacy_items(self.path) if os.path.exists(self.path) else []:
+                        offsets.append(data.tell())
+                        data.write(_encode(item))
+                with open(segment.index_path, "wb") as idx:
+                    idx.write(b"".join(_OFFSET.pack(o) for o in offsets))
+                os.rename(tmp, self.directory)
+            if os.path.exists(self.path):
+                os.replace(self.path, self.path + ".migrated")
+
+    def __len__(self) -> int:
+        segments = self._segments()
+        if not segments:
+            return 0
+        return segments[-1].start + segments[-1].count()
+
+    def append(self, record: Any, fsync: bool = False) -> int:
+        """1 レコードを追記してシーケンス番号を返す"""
+        return self.append_many([record], fsync=fsync)[0]
+
+    def append_many(self, records: Iterable[Any], fsync: bool = False) -> List[int]:
+        """複数レコードを 1 回の書き込みでまとめて追記する。
+
+        fsync=True なら戻る前にデータとインデックスをディスクに書き切る（グループコミット用）。
+        """
+        payloads = [_encode(r) for r in records]
+        if not payloads:
+            return []
+        with self._locked():
+            segments = self._segments()
+            created = not segments
+            if not segments:
+                os.makedirs(self.directory, exist_ok=True)
+                segments = [_Segment(self.directory, 0)]
+            segment = segments[-1]
+            if not self._recovered:
+                self._recover(segment)
+                self._recovered = True
+            count = segment.count()
+            size = os.path.getsize(segment.data_path) if os.path.exists(segment.data_path) else 0
+            if count and size >= self.segment_bytes:
+                segment = _Segment(self.directory, segment.start + count)
+                count, size = 0, 0
+                created = True
+            first = segment.start + count
+            offsets = []
+            for payload in payloads:
+                offsets.append(size)
+                size += len(payload)
+            # データ行を書き終えてからインデックスを伸ばす（読み手はインデックス件数までしか読まない）
+            with open(segment.data_path, "ab") as data:
+                data.write(b"".join(payloads))
+                if fsync:
+                    data.flush()
+                    os.fsync(data.fileno())
+            with open(segment.index_path, "ab") as idx:
+                idx.write(b"".join(_OFFSET.pack(o) for o in offsets))
+                if fsync:
+                    idx.flush()
+                    os.fsync(idx.fileno())
+            if fsync and created:
+                # 新しいセグメントファイルのディレクトリエントリも永続化する
+                dir_fd = os.open(self.directory, os.O_RDONLY)
+                try:
+                    os.fsync(dir_fd)
+                finally:
+                    os.close(dir_fd)
+        return list(range(first, first + len(payloads)))
+
+    def get(self, seq: int) -> Any:
+        """シーケンス番号でレコードを取得する（インデックス経由で 1 シーク）"""
+        segment, local = self._locate(seq)
+        try:
+            with open(segment.data_path, "rb") as data:
+                data.seek(segment.offset(local))
+                return json.loads(data.readline())
+        except FileNotFoundError:
+            raise IndexError(seq)   # 読んでいる間にアーカイブへ移された
+
+    def iter_from(self, start: int = 0, stop: Optional[int] = None) -> Iterator[Tuple[int, Any]]:
+        """start 以降のレコードを (seq, record) として順に返す"""
+        end = len(self) if stop is None else min(stop, len(self))
+        for segment in self._segments():
+            count = segment.count()
+            lo = max(start, segment.start)
+            hi = min(end, segment.start + count)
+            if lo >= hi:
+                continue
+            try:
+                data = open(segment.data_path, "rb")
+                data.seek(segment.offset(lo - segment.start))
+            except FileNotFoundError:
+                continue   # 一覧を取った後でアーカイブへ移された
+            with data:
+                for seq in range(lo, hi):
+                    yield seq, json.loads(data.readline())
+
+    def iter_records(self) -> Iterator[Any]:
+        for _, record in self.iter_from(0):
+            yield record
+
+    def load_all(self) -> List[Any]:
+        return list(self.iter_records())
+
+    # --- retention --------------------------------------------------------
+
+    def first_seq(self) -> int:
+        """ライブストアに残っている最初の seq（それより前はアーカイブ済み）"""
+        segments = self._segments()
+        return segments[0].start if segments else 0
+
+    def chunks(self) -> List[Tuple[int, int]]:
+        """アーカイブできる単位（封じられたセグメント）の [start, end) 一覧。追記中のセグメントは含まない"""
+        segments = self._segments()
+        return [(s.start, s.start + s.count()) for s in segments[:-1]]
+
+    def chunk_bytes(self, start: int) -> int:
+        try:
+            return os.path.getsize(_Segment(self.directory, start).data_path)
+        except FileNotFoundError:
+            return 0
+
+    def live_bytes(self) -> int:
+        return sum(self.chunk_bytes(s.start) for s in self._segments())
+
+    def rotate(self) -> bool:
+        """追記中のセグメントを閉じ、次の追記から新しいセグメントにする（空なら何もしない）"""
+        with self._locked():
+            segments = self._segments()
+            if not segments or not segments[-1].count():
+                return False
+            last = segments[-1]
+            nxt = _Segment(self.directory, last.start + last.count())
+            open(nxt.data_path, "ab").close()
+            open(nxt.index_path, "ab").close()
+            return True
+
+    def discard_before(self, seq: int) -> int:
+        """seq より前のセグメントをライブストアから消して件数を返す（追記中のセグメントは消さない）"""
+        removed = 0
+        with self._locked():
+            segments = self._segments()
+            for segment in segments[:-1]:
+                end = segment.start + segment.count()
+                if end > seq:
+                    break
+                # インデックスを先に消す（_segments はインデックスの有無で判断する）
+                os.unlink(segment.index_path)
+                try:
+                    os.unlink(segment.data_path)
+                except FileNotFoundError:
+                    pass
+                removed += end - segment.start
+        return removed
+
+    def rewrite(self, records: Iterable[Any]) -> None:
+        """コレクション全体を置き換える（旧 save_json 互換。O(n) なので通常は append を使う）"""
+        with self._locked():
+            tmp = self.directory + ".tmp"
+            shutil.rmtree(tmp, ignore_errors=True)
+            os.makedirs(tmp)
+            segment = _Segment(tmp, 0)
+            offsets = []
+            with open(segment.data_path, "wb") as data:
+                for record in records:
+                    offsets.append(data.tell())
+                    data.write(_encode(record))
+            with open(segment.index_path, "wb") as idx:
+                idx.write(b"".join(_OFFSET.pack(o) for o in offsets))
+            old = self.directory + ".old"
+            shutil.rmtree(old, ignore_errors=True)
+            if os.path.isdir(self.directory):
+                os.rename(self.directory, old)
+            os.rename(tmp, self.directory)
+            shutil.rmtree(old, ignore_errors=True)
+            self._recovered = True
+
+    def version(self) -> str:
+        """内容が変わると変化するトークン（rewrite でディレクトリが差し替わると inode が変わる）。
+
+        アーカイブで先頭のセグメントが消えても inode と件数は変わらないので、first_seq も含める。
+        """
+        try:
+            inode = os.stat(self.directory).st_ino
+        except FileNotFoundError:
+            inode = 0
+        return f"{inode:x}-{len(self)}-{self.first_seq()}"
+
+    def query(self, type: Optional[str] = None, actor: Optional[str] = None,
+              since: Optional[str] = None, until: Optional[str] = None,
+              order: str = "seq", newest_first: bool = False,
+              limit: Optional[int] = None, after: Optional[int] = None,
+              before: Optional[int] = None) -> List[Tuple[int, Any]]:
+        """条件に合う (seq, record) を返す。
+
+        after / before は seq の範囲（どちらも含まない）。絞り込み条件がなく seq 順なら
+        必要な範囲だけをインデックスで読み、それ以外は全件走査になる。
+        """
+        lo = 0 if after is None else after + 1
+        hi = len(self) if before is None else min(before, len(self))
+        if order == "seq" and type is None and actor is None and since is None and until is None:
+            if limit is not None:
+                if newest_first:
+                    lo = max(lo, hi - limit)
+                else:
+                    hi = min(hi, lo + limit)
+            rows = list(self.iter_from(lo, hi))
+            if newest_first:
+                rows.reverse()
+            return rows
+        rows = [(seq, r) for seq, r in self.iter_from(lo, hi) if _matches(r, type, actor, since, until)]
+        if order == "timestamp":
+            rows.sort(key=lambda row: (record_fields(row[1])["timestamp"] or "", row[0]))
+        if newest_first:
+            rows.reverse()
+        return rows[:limit] if limit is not None else rows
+
+    def mtime(self) -> float:
+        """最終更新時刻（Last-Modified 用）"""
+        segments = self._segments()
+        paths = [self.directory] + ([segments[-1].index_path] if segments else [])
+        return max((os.stat(p).st_mtime for p in paths if os.path.exists(p)), default=0.0)
+
+    def find_by_id(self, activity_id: str) -> Optional[Tuple[int, Any]]:
+        for seq, record in self.iter_from(0):
+            if record_fields(record)["id"] == activity_id:
+                return seq, record
+        return None
+
+
+class SqliteStore:
+    """SQLite（WAL）によるコレクション。JsonlStore と同じインターフェースを持つ。
+
+    seq は JSONL と同じく 0 始まり（rowid - 1）。複数プロセスからの同時書き込みは
+    SQLite のロックと busy_timeout に任せる。
+    """
+
+    def __init__(self, path: str, db_path: Optional[str] = None):
+        self.path = str(path)
+        name = os.path.basename(self.path)
+        self.table = (name[:-5] if name.endswith(".json") else name).replace("-", "_")
+        self.db_path = db_path or os.path.join(os.path.dirname(self.path), SQLITE_FILENAME)
+        self._local = threading.local()
+        self._init_schema()
+        self.migrate()
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            os.makedirs(os.path.dirname(self.db_path) or ".", exist_ok=True)
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA busy_timeout=30000")
+            self._local.conn = conn
+        return conn
+
+    def _init_schema(self) -> None:
+        t = self.table
+        conn = self._conn()
+        conn.executescript(f"""
+            CREATE TABLE IF NOT EXISTS "{t}" (
+                seq INTEGER PRIMARY KEY,
+                timestamp TEXT,
+                type TEXT,
+                actor TEXT,
+                activity_id TEXT,
+                data TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS "{t}_type" ON "{t}"(type);
+            CREATE INDEX IF NOT EXISTS "{t}_actor" ON "{t}"(actor);
+            CREATE INDEX IF NOT EXISTS "{t}_timestamp" ON "{t}"(timestamp);
+            CREATE INDEX IF NOT EXISTS "{t}_activity_id" ON "{t}"(activity_id);
+            CREATE TABLE IF NOT EXISTS store_meta (key TEXT PRIMARY KEY, value TEXT);
+        """)
+
+    def _rows(self, records: Iterable[Any]) -> List[Tuple]:
+        rows = []
+        for record in records:
+            f = record_fields(record)
+            rows.append((f["timestamp"], f["type"], f["actor"], f["id"],
+                         json.dumps(record, ensure_ascii=False, separators=(",", ":"))))
+        return rows
+
+    def _insert(self, conn: sqlite3.Connection, rows: List[Tuple]) -> None:
+        conn.executemany(
+            f'INSERT INTO "{self.table}" (timestamp, type, actor, activity_id, data) VALUES (?, ?, ?, ?, ?)',
+            rows)
+
+    def migrate(self) -> None:
+        """既存の JSONL ストア / JSON 配列から一度だけ取り込む"""
+        conn = self._conn()
+        key = f"migrated:{self.table}"
+        if conn.execute("SELECT 1 FROM store_meta WHERE key = ?", (key,)).fetchone():
+            return
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if not conn.execute("SELECT 1 FROM store_meta WHERE key = ?", (key,)).fetchone():
+                base = self.path[:-5] if self.path.endswith(".json") else self.path
+                if os.path.isdir(base + ".d") or os.path.exists(self.path):
+                    self._insert(conn, self._rows(JsonlStore(self.path).iter_records()))
+                conn.execute("INSERT INTO store_meta (key, value) VALUES (?, '1')", (key,))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def __len__(self) -> int:
+        row = self._conn().execute(f'SELECT MAX(seq) FROM "{self.table}"').fetchone()
+        return row[0] or 0
+
+    def append(self, record: Any, fsync: bool = False) -> int:
+        return self.append_many([record], fsync=fsync)[0]
+
+    def append_many(self, records: Iterable[Any], fsync: bool = False) -> List[int]:
+        rows = self._rows(records)
+        if not rows:
+            return []
+        conn = self._conn()
+        if fsync:
+            # WAL + synchronous=NORMAL のコミットは電源断で失われうるので、この回だけ FULL にする
+            conn.execute("PRAGMA synchronous=FULL")
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                first = len(self)
+                self._insert(conn, rows)
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        finally:
+            if fsync:
+                conn.execute("PRAGMA synchronous=NORMAL")
+        return list(range(first, first + len(rows)))
+
+    def get(self, seq: int) -> Any:
+        row = self._conn().execute(
+            f'SELECT data FROM "{self.table}" WHERE seq = ?', (seq + 1,)).fetchone()
+        if row is None:
+            raise IndexError(seq)
+        return json.loads(row[0])
+
+    def iter_from(self, start: int = 0, stop: Optional[int] = None) -> Iterator[Tuple[int, Any]]:
+        sql = f'SELECT seq, data FROM "{self.table}" WHERE seq > ?'
+        params: List[Any] = [start]
+        if stop is not None:
+            sql += " AND seq <= ?"
+            params.append(stop)
+        for seq, data in self._conn().execute(sql + " ORDER BY seq", params):
+            yield seq - 1, json.loads(data)
+
+    def load_all(self) -> List[Any]:
+        return [record for _, record in self.iter_from(0)]
+
+    def first_seq(self) -> int:
+        row = self._conn().execute(f'SELECT MIN(seq) FROM "{self.table}"').fetchone()
+        return (row[0] - 1) if row[0] else len(self)
+
+    def chunks(self, size: int = 10000) -> List[Tuple[int, int]]:
+        """[start, end) を size 件ずつ。最新の 1 件を含む範囲は含めない（MAX(seq) = len を保つため）"""
+        end = len(self) - 1
+        return [(lo, min(lo + size, end)) for lo in range(self.first_seq(), end, size)]
+
+    def chunk_bytes(self, start: int) -> int:
+        return 0
+
+    def live_bytes(self) -> int:
+        return 0
+
+    def rotate(self) -> bool:
+        return False
+
+    def discard_before(self, seq: int) -> int:
+        seq = min(seq, len(self) - 1)
+        cur = self._conn().execute(f'DELETE FROM "{self.table}" WHERE seq <= ?', (seq,))
+        return cur.rowcount
+
+    def rewrite(self, records: Iterable[Any]) -> None:
+        rows = self._rows(records)
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(f'DELETE FROM "{self.table}"')
+            self._insert(conn, rows)
+            conn.execute(
+                "INSERT INTO store_meta (key, value) VALUES (?, '1') "
+                "ON CONFLICT(key) DO UPDATE SET value = CAST(value AS INTEGER) + 1",
+                (f"generation:{self.table}",))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def version(self) -> str:
+        conn = self._conn()
+        row = conn.execute("SELECT value FROM store_meta WHERE key = ?",
+                           (f"generation:{self.table}",)).fetchone()
+        generation = row[0] if row else "0"
+        count = conn.execute(f'SELECT COUNT(*) FROM "{self.table}"').fetchone()[0]
+        return f"{generation}-{len(self)}-{count}"
+
+    def query(self, type: Optional[str] = None, actor: Optional[str] = None,
+              since: Optional[str] = None, until: Optional[str] = None,
+              order: str = "seq", newest_first: bool = False,
+              limit: Optional[int] = None, after: Optional[int] = None,
+              before: Optional[int] = None) -> List[Tuple[int, Any]]:
+        """インデックス（type / actor / timestamp）を使って絞り込む"""
+        where, params = [], []
+        for column, value, op in (("type", type, "="), ("actor", actor, "="),
+                                  ("timestamp", since, ">="), ("timestamp", until, "<"),
+                                  ("seq", None if after is None else after + 1, ">"),
+                                  ("seq", None if before is None else before + 1, "<")):
+            if value is not None:
+                where.append(f"{column} {op} ?")
+                params.append(value)
+        sql = f'SELECT seq, data FROM "{self.table}"'
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        direction = "DESC" if newest_first else "ASC"
+        if order == "timestamp":
+            sql += f" ORDER BY timestamp {direction}, seq {direction}"
+        else:
+            sql += f" ORDER BY seq {direction}"
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(limit)
+        return [(seq - 1, json.loads(data)) for seq, data in self._conn().execute(sql, params)]
+
+    def find_by_id(self, activity_id: str) -> Optional[Tuple[int, Any]]:
+        row = self._conn().execute(
+            f'SELECT seq, data FROM "{self.table}" WHERE activity_id = ? ORDER BY seq LIMIT 1',
+            (activity_id,)).fetchone()
+        return (row[0] - 1, json.loads(row[1])) if row else None
+
+    def mtime(self) -> float:
+        paths = (self.db_path, self.db_path + "-wal")
+        return max((os.stat(p).st_mtime for p in paths if os.path.exists(p)), default=0.0)
+
+
+_STORES: Dict[str, Any] = {}
+_STORES_LOCK = threading.Lock()
+
+
+def open_store(path, backend: Optional[str] = None):
+    """パスごとに 1 つのストアインスタンスを返す（プロセス内で共有）。
+
+    backend を省略すると ACTIVITYPUB_STORE_BACKEND（jsonl / sqlite）に従う。
+    """
+    backend = backend or STORE_BACKEND
+    key = os.path.abspath(str(path))
+    with _STORES_LOCK:
+        store = _STORES.get((backend, key))
+        if store is None:
+            if backend == "sqlite":
+                store = SqliteStore(key)
+            elif backend == "jsonl":
+                store = JsonlStore(key)
+            else:
+                raise ValueError(f"unknown store backend: {backend}")
+            _STORES[(backend, key)] = store
+        return store
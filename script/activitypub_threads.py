@@ -0,0 +1,147 @@
+"""Incrementally maintained conversation index over an activity store.
+
+Rebuilding a conversation used to mean scanning the whole inbox. The index
+keeps two maps from thread keys to sequence numbers::
+
+    context   -> [seq, seq, ...]    messages of a conversation, in store order
+    inReplyTo -> [seq, seq, ...]    direct replies to a message
+
+Thread keys come from ``ThreadContext`` (an Envelope's ``thread`` object) or,
+for plain ActivityPub activities, from ``context`` / ``conversation`` and
+``inReplyTo`` on the activity or its object. Like ``OutboxDelivery.refresh``,
+:meth:`ThreadIndex.refresh` only reads records appended since the last call, so
+a lookup costs the size of the thread plus the new records, not the size of the
+store.
+"""
+from __future__ import annotations
+
+import os
+import threading
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from activitypub_store import open_store
+
+ThreadKeys = Tuple[List[str], Optional[str], Optional[str]]   # (message ids, context, inReplyTo)
+
+
+def _str(value: Any) -> Optional[str]:
+    if isinstance(value, dict):
+        value = value.get("id")
+    return value if isinstance(value, str) and value else None
+
+
+def _activities(record: Any) -> Iterator[dict]:
+    """inbox のレコード（{"activity": ...}）またはアクティビティそのものから dict を取り出す"""
+    activity = record.get("activity", record) if isinstance(record, dict) else record
+    for item in activity if isinstance(activity, list) else [activity]:
+        if isinstance(item, dict):
+            yield item
+
+
+def thread_keys(activity: dict) -> ThreadKeys:
+    """1 件のアクティビティ（または Envelope の dict）から (ID 一覧, context, inReplyTo) を取り出す"""
+    ids = [i for i in (_str(activity.get("id")),) if i]
+    thread = activity.get("thread")
+    if isinstance(thread, dict):
+        # Envelope（ThreadContext.to_dict の形）
+        return ids, _str(thread.get("context")), _str(thread.get("inReplyTo"))
+    obj = activity.get("object")
+    obj = obj if isinstance(obj, dict) else {}
+    object_id = _str(obj.get("id"))
+    if object_id and object_id not in ids:
+        # Create などは返信が object（Note）の ID を指す
+        ids.append(object_id)
+    context = (_str(activity.get("context")) or _str(activity.get("conversation"))
+               or _str(obj.get("context")) or _str(obj.get("conversation")))
+    in_reply_to = _str(activity.get("inReplyTo")) or _str(obj.get("inReplyTo"))
+    return ids, context, in_reply_to
+
+
+class ThreadIndex:
+    """context → seq 一覧、inReplyTo → 返信の seq 一覧、メッセージ ID → seq を持つ索引。"""
+
+    def __init__(self, store):
+        self.store = store
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self) -> None:
+        self.position = 0
+        self._version_prefix = self._prefix()
+        self.contexts: Dict[str, List[int]] = {}
+        self.replies: Dict[str, List[int]] = {}
+        self.messages: Dict[str, int] = {}
+
+    def _prefix(self) -> str:
+        # version() の先頭は世代（JSONL はディレクトリの inode）。rewrite で変わったら作り直す
+        return self.store.version().split("-", 1)[0]
+
+    @staticmethod
+    def _add(mapping: Dict[str, List[int]], key: Optional[str], seq: int) -> None:
+        if key is None:
+            return
+        seqs = mapping.setdefault(key, [])
+        if not seqs or seqs[-1] != seq:   # 1 レコードに同じスレッドの activity が複数あっても 1 回
+            seqs.append(seq)
+
+    def add(self, seq: int, record: Any) -> None:
+        for activity in _activities(record):
+            ids, context, in_reply_to = thread_keys(activity)
+            for message_id in ids:
+                self.messages.setdefault(message_id, seq)
+            self._add(self.contexts, context, seq)
+            self._add(self.replies, in_reply_to, seq)
+
+    def refresh(self) -> "ThreadIndex":
+        """前回以降に追記されたレコードだけを索引に加える"""
+        with self._lock:
+            end = len(self.store)
+            if end < self.position or self._prefix() != self._version_prefix:
+                self._reset()
+            for seq, record in self.store.iter_from(self.position, end):
+                self.add(seq, record)
+            self.position = max(self.position, end)
+        return self
+
+    def _rows(self, seqs: List[int]) -> List[Tuple[int, Any]]:
+        rows = []
+        for seq in seqs:
+            try:
+                rows.append((seq, self.store.get(seq)))
+            except IndexError:
+                pass   # 保持期間を過ぎてアーカイブへ移された
+        return rows
+
+    def thread(self, context: str) -> List[Tuple[int, Any]]:
+        """context に属するレコードを (seq, record) の seq 順で返す"""
+        self.refresh()
+        return self._rows(list(self.contexts.get(context, ())))
+
+    def replies_to(self, message_id: str) -> List[Tuple[int, Any]]:
+        """message_id への直接の返信を (seq, record) の seq 順で返す"""
+        self.refresh()
+        return self._rows(list(self.replies.get(message_id, ())))
+
+    def message(self, message_id: str) -> Optional[Tuple[int, Any]]:
+        self.refresh()
+        seq = self.messages.get(message_id)
+        if seq is None:
+            return None
+        try:
+            return seq, self.store.get(seq)
+        except IndexError:
+            return None   # 保持期間を過ぎてアーカイブへ移された
+
+
+_INDEXES: Dict[str, ThreadIndex] = {}
+_INDEXES_LOCK = threading.Lock()
+
+
+def open_thread_index(path) -> ThreadIndex:
+    """ストアごとに 1 つの索引を返す（プロセス内で共有）"""
+    key = os.path.abspath(str(path))
+    with _INDEXES_LOCK:
+        index = _INDEXES.get(key)
+        if index is None:
+            index = _INDEXES[key] = ThreadIndex(open_store(key))
+        return index
@@ -0,0 +1,112 @@
+"""Cached newest-first views over an activity store.
+
+The index page shows the newest ``PAGE_SIZE`` inbox records by timestamp. Store
+order (``seq``) is arrival order, which is close to timestamp order but not
+identical: handlers stamp a record before handing it to the commit service, so
+concurrent deliveries can land slightly out of order. :class:`SortedView` keeps
+the newest ``size`` records ordered by ``(timestamp, seq)`` with bisect
+insertion and, like :class:`activitypub_threads.ThreadIndex`, only reads
+records appended since the previous refresh. The first build reads the last
+``VIEW_SEED`` records rather than the whole store.
+
+:meth:`SortedView.memoize` caches a value derived from the view (the rendered
+index page) until the store version changes, so repeated page loads with no new
+mail cost one ``version()`` call.
+"""
+from __future__ import annotations
+
+import os
+import threading
+from bisect import insort
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from activitypub_store import open_store, record_fields
+
+VIEW_SEED = int(os.environ.get("ACTIVITYPUB_VIEW_SEED", "1000"))   # 初回に読む末尾の件数（到着順と時刻順のずれの許容幅）
+
+
+class SortedView:
+    """timestamp の新しい順に上位 size 件を持つビュー（追記分だけで更新）"""
+
+    def __init__(self, store, size: int, seed: int = VIEW_SEED):
+        self.store = store
+        self.size = size
+        self.seed = max(seed, size)
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self) -> None:
+        self.version: Optional[str] = None
+        self._version_prefix = self._prefix()
+        end = len(self.store)
+        self.position = max(self.store.first_seq(), end - self.seed)
+        self.keys: List[Tuple[str, int]] = []    # (timestamp, seq) の昇順。末尾が最新
+        self.records: Dict[int, Any] = {}
+        self._memo: Dict[str, Tuple[str, Any]] = {}
+
+    def _prefix(self) -> str:
+        # version() の先頭は世代（JSONL はディレクトリの inode）。rewrite で変わったら作り直す
+        return self.store.version().split("-", 1)[0]
+
+    def add(self, seq: int, record: Any) -> None:
+        key = (record_fields(record)["timestamp"] or "", seq)
+        if len(self.keys) >= self.size and key <= self.keys[0]:
+            return   # 表示範囲より古い
+        insort(self.keys, key)
+        self.records[seq] = record
+        if len(self.keys) > self.size:
+            _, dropped = self.keys.pop(0)
+            del self.records[dropped]
+
+    def _discard(self, first: int) -> None:
+        """アーカイブへ移された（first より前の）レコードを外す"""
+        if self.keys and min(seq for _, seq in self.keys) < first:
+            self.keys = [key for key in self.keys if key[1] >= first]
+            self.records = {seq: self.records[seq] for _, seq in self.keys}
+
+    def refresh(self) -> str:
+        """前回以降に追記されたレコードだけを取り込み、現在の store.version() を返す"""
+        with self._lock:
+            version = self.store.version()
+            if version == self.version:
+                return version
+            end = len(self.store)
+            if end < self.position or self._prefix() != self._version_prefix:
+                self._reset()
+            self._discard(self.store.first_seq())
+            for seq, record in self.store.iter_from(self.position, end):
+                self.add(seq, record)
+            self.position = max(self.position, end)
+            self.version = version
+            return version
+
+    def newest(self, limit: Optional[int] = None) -> List[Tuple[int, Any]]:
+        """(seq, record) を timestamp の新しい順に返す"""
+        self.refresh()
+        with self._lock:
+            keys = self.keys[::-1] if limit is None else self.keys[:-limit - 1:-1]
+            return [(seq, self.records[seq]) for _, seq in keys]
+
+    def memoize(self, name: str, build: Callable[["SortedView"], Any]) -> Any:
+        """build(view) の結果を、ストアに新しいデータが来るまで使い回す"""
+        version = self.refresh()
+        cached = self._memo.get(name)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        value = build(self)
+        self._memo[name] = (version, value)
+        return value
+
+
+_VIEWS: Dict[Tuple[str, int], SortedView] = {}
+_VIEWS_LOCK = threading.Lock()
+
+
+def open_view(path, size: int) -> SortedView:
+    """ストアと件数ごとに 1 つのビューを返す（プロセス内で共有）"""
+    key = (os.path.abspath(str(path)), size)
+    with _VIEWS_LOCK:
+        view = _VIEWS.get(key)
+        if view is None:
+            view = _VIEWS[key] = SortedView(open_store(key[0]), size)
+        return view
@@ -0,0 +1,254 @@
+"""Batch JSONL codec for :class:`ai_message_envelope.Envelope`.
+
+``Envelope.to_json`` / ``from_json`` go through ``to_dict`` / ``from_dict`` for
+every envelope and decode the payload eagerly. This module moves many
+envelopes at once to and from JSONL (files or byte buffers):
+
+- Encoding writes each line directly from the envelope fields; no per-envelope
+  dict is built. The payload is always the last key::
+
+      {"version":"v0.1","id":"urn:uuid:...","createdAt":"...","sender":"...",
+       "recipients":[...],"payloadType":"json","thread":{},"payload":{...}}
+
+- Decoding parses only the header part of such a line and keeps the payload
+  as raw JSON bytes in a :class:`LazyEnvelope`. The payload is decoded the first
+  time ``.payload`` is read; an envelope whose payload is never touched is
+  re-encoded by copying those bytes. Lines in any other key order (for example
+  from ``Envelope.to_json``) fall back to a full parse.
+- ``orjson`` is used automatically when it is installed.
+"""
+from __future__ import annotations
+
+import json
+import re
+from json.encoder import encode_basestring
+from typing import IO, Any, Iterable, Iterator, List, Optional, Union
+from uuid import uuid4
+
+from ai_message_envelope import (
+    Envelope,
+    ThreadContext,
+    _iso_timestamp,
+    _normalise_recipients,
+    _validate_agent_id,
+)
+
+try:  # optional fast path
+    import orjson
+except ImportError:  # pragma: no cover - depends on the environment
+    orjson = None
+
+JSON_BACKEND = "orjson" if orjson is not None else "json"
+
+_PAYLOAD_MARKER = b',"payload":'
+# Keys written before the payload by encode(); only lines with exactly these take the lazy path.
+_HEADER_KEYS = frozenset({"version", "id", "createdAt", "sender", "recipients", "payloadType", "thread"})
+_PAYLOAD_SLOT = Envelope.__dict__["payload"]
+# Strings (skipped as a whole, so brackets inside them do not count) and brackets.
+_STRING = re.compile(rb'"(?:[^"\\]|\\.)*"')
+_TOKEN = re.compile(rb'"(?:[^"\\]|\\.)*"|[\[\]{}]')
+_CLOSERS = {ord("{"): ord("}"), ord("["): ord("]")}
+
+
+if orjson is not None:
+    _loads = orjson.loads
+
+    def _dumps(value: Any) -> bytes:
+        return orjson.dumps(value)
+else:
+    _loads = json.loads
+    _encoder = json.JSONEncoder(ensure_ascii=False, separators=(",", ":"))
+
+    def _dumps(value: Any) -> bytes:
+        return _encoder.encode(value).encode("utf-8")
+
+
+def _str(value: str) -> bytes:
+    return encode_basestring(value).encode("utf-8")
+
+
+def _coerce_json_payload(payload: Any) -> Any:
+    # Same coercion as Envelope.__post_init__: a JSON string payload becomes an object.
+    if isinstance(payload, str):
+        try:
+            return json.loads(payload)
+        except json.JSONDecodeError:
+            pass
+    return payload
+
+
+class LazyEnvelope(Envelope):
+    """An Envelope whose payload stays undecoded JSON until first accessed."""
+
+    __slots__ = ("_raw_payload",)
+
+    @property  # type: ignore[override]
+    def payload(self) -> Any:
+        raw = self._raw_payload
+        if raw is not None:
+            value = _loads(raw)
+            if self.payload_type == "json":
+                value = _coerce_json_payload(value)
+            _PAYLOAD_SLOT.__set__(self, value)
+            self._raw_payload = None
+        return _PAYLOAD_SLOT.__get__(self, type(self))
+
+    @payload.setter
+    def payload(self, value: Any) -> None:
+        self._raw_payload = None
+        _PAYLOAD_SLOT.__set__(self, value)
+
+    @property
+    def payload_loaded(self) -> bool:
+        return self._raw_payload is None
+
+    def __eq__(self, other: object) -> bool:
+        if isinstance(other, Envelope):
+            return self.to_dict() == other.to_dict()
+        return NotImplemented
+
+
+def _thread_bytes(thread: ThreadContext) -> bytes:
+    if not thread.context and not thread.in_reply_to:
+        return b"{}"
+    parts = []
+    if thread.context:
+        parts.append(b'"context":' + _str(thread.context))
+    if thread.in_reply_to:
+        parts.append(b'"inReplyTo":' + _str(thread.in_reply_to))
+    return b"{" + b",".join(parts) + b"}"
+
+
+def encode(envelope: Envelope) -> bytes:
+    """Encode one envelope as a single JSON line (without the trailing newline)."""
+    raw = getattr(envelope, "_raw_payload", None)
+    payload = raw if raw is not None else _dumps(envelope.payload)
+    return b"".join((
+        b'{"version":', _str(envelope.version),
+        b',"id":', _str(envelope.envelope_id),
+        b',"createdAt":', _str(envelope.created_at),
+        b',"sender":', _str(envelope.sender),
+        b',"recipients":[', b",".join(_str(r) for r in envelope.recipients), b"]",
+        b',"payloadType":', _str(envelope.payload_type),
+        b',"thread":', _thread_bytes(envelope.thread),
+        _PAYLOAD_MARKER, payload,
+        b"}",
+    ))
+
+
+def encode_many(envelopes: Iterable[Envelope]) -> bytes:
+    """Encode envelopes as a JSONL buffer."""
+    return b"".join(encode(e) + b"\n" for e in envelopes)
+
+
+def _build(header: dict, raw_payload: Optional[bytes], payload: Any, validate: bool) -> Envelope:
+    env = LazyEnvelope.__new__(LazyEnvelope)
+    payload_type = header.get("payloadType", "json")
+    if payload_type not in {"json", "text"}:
+        raise ValueError("payload_type must be 'json' or 'text'")
+    sender = header["sender"]
+    recipients = header.get("recipients", [])
+    if validate:
+        sender = _validate_agent_id(sender)
+        recipients = _normalise_recipients(recipients)
+    env.sender = sender
+    env.recipients = recipients
+    env.payload_type = payload_type
+    env.thread = ThreadContext.from_dict(header.get("thread"))
+    env.version = header.get("version", "v0.1")
+    # Defaults are only computed when the key is missing (unlike dict.get's eager default).
+    env.envelope_id = header["id"] if "id" in header else f"urn:uuid:{uuid4()}"
+    env.created_at = header["createdAt"] if "createdAt" in header else _iso_timestamp()
+    if raw_payload is not None:
+        env._raw_payload = raw_payload
+    else:
+        env._raw_payload = None
+        _PAYLOAD_SLOT.__set__(env, _coerce_json_payload(payload) if payload_type == "json" else payload)
+    return env
+
+
+def _is_single_value(raw: bytes) -> bool:
+    """Cheap structural check that ``raw`` is one object, array or string and nothing after it.
+
+    Only brackets and string boundaries are scanned; the payload itself is not decoded.
+    Other values (numbers, literals) report False and take the full parse.
+    """
+    if raw[:1] == b'"':
+        return _STRING.fullmatch(raw) is not None
+    if raw[:1] not in (b"{", b"["):
+        return False
+    stack: List[int] = []
+    for match in _TOKEN.finditer(raw):
+        char = raw[match.start()]
+        if char in _CLOSERS:
+            stack.append(_CLOSERS[char])
+        elif char != ord('"'):
+            if not stack or stack.pop() != char:
+                return False
+            if not stack:
+                return match.end() == len(raw)
+    return False
+
+
+def decode(line: Union[bytes, str], validate: bool = True) -> Envelope:
+    """Decode one JSON line into an Envelope (a :class:`LazyEnvelope` when possible).
+
+    ``validate=False`` skips the agent-ID checks for input this process wrote itself.
+    """
+    if isinstance(line, str):
+        line = line.encode("utf-8")
+    line = line.strip()
+    cut = line.find(_PAYLOAD_MARKER)
+    if cut > 0 and line.endswith(b"}"):
+        try:
+            header = _loads(line[:cut] + b"}")
+        except ValueError:
+            header = None
+        raw = line[cut + len(_PAYLOAD_MARKER):-1]
+        # A payload that is not exactly one value (e.g. followed by more keys) takes the full parse,
+        # so malformed lines are rejected here rather than on first access or re-encoded verbatim.
+        if isinstance(header, dict) and header.keys() == _HEADER_KEYS and _is_single_value(raw):
+            return _build(header, raw, None, validate)
+    data = _loads(line)
+    return _build(data, None, data.get("payload"), validate)
+
+
+def iter_decode(buffer: Union[bytes, Iterable[bytes]], validate: bool = True) -> Iterator[Envelope]:
+    """Decode a JSONL buffer (or an iterable of lines, e.g. an open binary file)."""
+    lines = buffer.splitlines() if isinstance(buffer, (bytes, bytearray)) else buffer
+    for line in lines:
+        if line.strip():
+            yield decode(line, validate)
+
+
+def decode_many(buffer: Union[bytes, Iterable[bytes]], validate: bool = True) -> List[Envelope]:
+    return list(iter_decode(buffer, validate))
+
+
+def write_jsonl(target: Union[str, IO[bytes]], envelopes: Iterable[Envelope],
+                chunk_size: int = 1024) -> int:
+    """Append envelopes to a JSONL file (path or binary file object); returns the count."""
+    if isinstance(target, str):
+        with open(target, "ab") as f:
+            return write_jsonl(f, envelopes, chunk_size)
+    count = 0
+    chunk: List[bytes] = []
+    for envelope in envelopes:
+        chunk.append(encode(envelope) + b"\n")
+        if len(chunk) >= chunk_size:
+            target.write(b"".join(chunk))
+            count += len(chunk)
+            chunk = []
+    if chunk:
+        target.write(b"".join(chunk))
+        count += len(chunk)
+    return count
+
+
+def read_jsonl(source: Union[str, IO[bytes]], validate: bool = True) -> Iterator[Envelope]:
+    """Stream envelopes from a JSONL file (path or binary file object)."""
+    if isinstance(source, str):
+        with open(source, "rb") as f:
+            yield from iter_decode(f, validate)
+    else:
+        yield from iter_decode(source, validate)
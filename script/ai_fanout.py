@@ -0,0 +1,207 @@
+"""Per-node fan-out delivery for :class:`ai_message_envelope.Envelope`.
+
+An envelope may address thousands of ``https://domain/@name`` recipients.
+Opening one connection per recipient does not scale, so delivery is planned
+per destination node (the domain of the agent ID):
+
+- :class:`FanoutPlanner` collects queued envelopes, merges envelopes queued more
+  than once (same ``envelope_id``) and deduplicates their recipients, then groups
+  the recipients of each envelope by node.
+- Each (envelope, node) pair becomes one :class:`NodeTransaction`: a single
+  multi-recipient LMTP/SMTP transaction (split only above
+  ``MAX_RECIPIENTS_PER_TRANSACTION``).
+- :class:`FanoutEngine` runs the transactions on a thread pool with a
+  per-node connection pool, which doubles as the per-node concurrency cap, and
+  reports a :class:`RecipientResult` for every recipient.
+
+A message to 10,000 recipients spread over 50 nodes is therefore sent as about
+50 transactions instead of 10,000 connections.
+
+Agent IDs map to mailbox addresses as ``https://domain/@name`` -> ``name@domain``.
+"""
+from __future__ import annotations
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from email.message import EmailMessage
+from email.utils import formatdate, make_msgid
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+from activitypub_lmtp_client import LMTPPool
+from ai_message_envelope import AgentId, Envelope, _validate_agent_id
+
+NODE_CONCURRENCY = 2                  # concurrent transactions per node
+FANOUT_WORKERS = 16                   # transactions in flight across all nodes
+MAX_RECIPIENTS_PER_TRANSACTION = 1000
+ENVELOPE_CONTENT_TYPE = "application/json; charset=utf-8"
+
+Endpoint = Dict[str, Any]             # {"socket": ...} or {"host": ..., "port": ...}
+
+
+def agent_node(agent_id: AgentId) -> str:
+    """Return the destination node (lower-cased domain) of an agent ID."""
+    return urlsplit(_validate_agent_id(agent_id)).netloc.lower()
+
+
+def agent_address(agent_id: AgentId) -> str:
+    """Return the mailbox address for an agent ID (``https://d/@name`` -> ``name@d``)."""
+    parts = urlsplit(_validate_agent_id(agent_id))
+    return f"{parts.path[2:]}@{parts.netloc.lower()}"
+
+
+def build_message(envelope: Envelope, recipients: List[AgentId]) -> bytes:
+    """Render an envelope as the mail sent in one node transaction."""
+    msg = EmailMessage()
+    msg["From"] = agent_address(envelope.sender)
+    msg["To"] = ", ".join(agent_address(r) for r in recipients)
+    msg["Subject"] = f"AI Envelope {envelope.envelope_id}"
+    msg["Date"] = formatdate(localtime=True)
+    msg["Message-Id"] = make_msgid()
+    msg.set_content(envelope.to_json(), charset="utf-8")
+    msg.replace_header("Content-Type", ENVELOPE_CONTENT_TYPE)
+    return msg.as_bytes()
+
+
+@dataclass
+class NodeTransaction:
+    """One envelope delivered to a group of recipients on the same node."""
+
+    node: str
+    envelope: Envelope
+    recipients: List[AgentId]
+
+
+@dataclass
+class RecipientResult:
+    """Outcome for one recipient; ``code`` is None when no reply was received."""
+
+    recipient: AgentId
+    node: str
+    code: Optional[int]
+    reply: str
+
+    @property
+    def ok(self) -> bool:
+        return self.code is not None and 200 <= self.code < 300
+
+
+class FanoutPlanner:
+    """Queue envelopes and turn them into per-node transactions."""
+
+    def __init__(self, max_recipients: int = MAX_RECIPIENTS_PER_TRANSACTION):
+        self.max_recipients = max(1, max_recipients)
+        self._queued: "OrderedDict[str, Tuple[Envelope, Dict[AgentId, None]]]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._queued)
+
+    def add(self, envelope: Envelope) -> None:
+        """Queue an envelope; queuing the same ``envelope_id`` again merges recipients."""
+        entry = self._queued.get(envelope.envelope_id)
+        if entry is None:
+            self._queued[envelope.envelope_id] = (envelope, dict.fromkeys(envelope.recipients))
+        else:
+            entry[1].update(dict.fromkeys(envelope.recipients))
+
+    def add_many(self, envelopes: Iterable[Envelope]) -> None:
+        for envelope in envelopes:
+            self.add(envelope)
+
+    def plan(self) -> List[NodeTransaction]:
+        """Drain the queue and return its transactions, interleaved across nodes.
+
+        Interleaving keeps a node with many transactions from occupying every
+        worker while it waits on its own concurrency cap.
+        """
+        by_node: "OrderedDict[str, List[NodeTransaction]]" = OrderedDict()
+        for envelope, recipients in self._queued.values():
+            groups: "OrderedDict[str, List[AgentId]]" = OrderedDict()
+            for recipient in recipients:
+                groups.setdefault(agent_node(recipient), []).append(recipient)
+            for node, members in groups.items():
+                for start in range(0, len(members), self.max_recipients):
+                    by_node.setdefault(node, []).append(
+                        NodeTransaction(node, envelope, members[start:start + self.max_recipients]))
+        self._queued.clear()
+        transactions: List[NodeTransaction] = []
+        queues = list(by_node.values())
+        for i in range(max((len(q) for q in queues), default=0)):
+            transactions.extend(q[i] for q in queues if i < len(q))
+        return transactions
+
+
+class FanoutEngine:
+    """Run node transactions with a connection pool (and concurrency cap) per node.
+
+    ``resolve`` maps a node to an endpoint; by default every node is handed to
+    the local LMTP server, which routes by recipient domain.
+    """
+
+    def __init__(self, resolve: Optional[Callable[[str], Endpoint]] = None,
+                 node_concurrency: int = NODE_CONCURRENCY, workers: int = FANOUT_WORKERS,
+                 message_builder: Callable[[Envelope, List[AgentId]], bytes] = build_message):
+        self.resolve = resolve or (lambda node: {})
+        self.node_concurrency = max(1, node_concurrency)
+        self.workers = max(1, workers)
+        self.message_builder = message_builder
+        self._pools: Dict[str, LMTPPool] = {}
+
+    def _pool(self, node: str) -> LMTPPool:
+        pool = self._pools.get(node)
+        if pool is None:
+            endpoint = self.resolve(node) or {}
+            pool = self._pools[node] = LMTPPool(
+                size=self.node_concurrency, socket_path=endpoint.get("socket"),
+                host=endpoint.get("host"), port=endpoint.get("port"))
+        return pool
+
+    def send(self, transaction: NodeTransaction) -> List[RecipientResult]:
+        """Send one transaction and map the LMTP replies back to agent IDs."""
+        envelope = transaction.envelope
+        # IDs that differ only in domain case share an address: RCPT it once, but give
+        # every recipient its own result.
+        addresses = [agent_address(r) for r in transaction.recipients]
+        try:
+            replies = self._pool(transaction.node).send(
+                self.message_builder(envelope, transaction.recipients),
+                agent_address(envelope.sender), list(dict.fromkeys(addresses)))
+        except Exception as e:
+            code = getattr(e, "code", None)
+            return [RecipientResult(r, transaction.node, code, str(e)) for r in transaction.recipients]
+        results = []
+        for recipient, address in zip(transaction.recipients, addresses):
+            code, reply = replies.get(address, (None, "no reply"))
+            results.append(RecipientResult(recipient, transaction.node, code, reply))
+        return results
+
+    def deliver(self, transactions: Iterable[NodeTransaction]) -> Dict[str, List[RecipientResult]]:
+        """Send all transactions; returns ``{envelope_id: [RecipientResult, ...]}``."""
+        transactions = list(transactions)
+        for transaction in transactions:
+            self._pool(transaction.node)   # create pools up front, outside the worker threads
+        results: Dict[str, List[RecipientResult]] = {}
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="fanout") as executor:
+            for transaction, outcome in zip(transactions, executor.map(self.send, transactions)):
+                results.setdefault(transaction.envelope.envelope_id, []).extend(outcome)
+        return results
+
+    def close(self) -> None:
+        for pool in self._pools.values():
+            pool.close()
+        self._pools.clear()
+
+
+def fanout(envelopes: Iterable[Envelope], engine: Optional[FanoutEngine] = None
+           ) -> Dict[str, List[RecipientResult]]:
+    """Plan and deliver envelopes in one call."""
+    planner = FanoutPlanner()
+    planner.add_many(envelopes)
+    own = engine is None
+    engine = engine or FanoutEngine()
+    try:
+        return engine.deliver(planner.plan())
+    finally:
+        if own:
+            engine.close()
@@ -9,9 +9,13 @@ from __future__ import annotations
 
 import json
 import re
+import sys
+import threading
+from array import array
+from collections import OrderedDict
 from dataclasses import dataclass, field
 from datetime import datetime, timezone
-from typing import Any, Dict, Iterable, List, Optional, Union
+from typing import Any, Dict, Iterable, List, Optional, Tuple, Union
 from uuid import uuid4
 
 AgentId = str
@@ -19,25 +23,89 @@ Payload = Union[str, Dict[str, Any]]
 
 
 AGENT_ID_PATTERN = re.compile(r"^https?://[^\s/@]+/@[^\s/@]+$")
+AGENT_REGISTRY_SIZE = 100_000
+
+
+class AgentRegistry:
+    """Bounded LRU registry of validated agent IDs.
+
+    Each ID is checked against ``AGENT_ID_PATTERN`` once, stored as an interned
+    string and given a compact integer handle. Handles are never reused, so a
+    handle whose ID has been evicted simply stops resolving.
+    """
+
+    def __init__(self, maxsize: int = AGENT_REGISTRY_SIZE):
+        self.maxsize = max(1, maxsize)
+        self._handles: "OrderedDict[str, int]" = OrderedDict()
+        self._ids: Dict[int, str] = {}
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._handles)
+
+    def _add(self, agent_id: AgentId) -> Tuple[int, AgentId]:
+        # Caller holds the lock and has already missed the cache.
+        if not isinstance(agent_id, str) or not AGENT_ID_PATTERN.match(agent_id):
+            raise ValueError(
+                "Agent ID must be an ActivityPub-style handle such as https://domain/@name"
+            )
+        agent_id = sys.intern(agent_id)
+        handle = self._next
+        self._next += 1
+        self._handles[agent_id] = handle
+        self._ids[handle] = agent_id
+        if len(self._handles) > self.maxsize:
+            _, evicted = self._handles.popitem(last=False)
+            del self._ids[evicted]
+        return handle, agent_id
+
+    def intern(self, agent_id: AgentId) -> Tuple[int, AgentId]:
+        """Validate (once) and return ``(handle, interned_id)``; raises ValueError."""
+        with self._lock:
+            handle = self._handles.get(agent_id)
+            if handle is None:
+                return self._add(agent_id)
+            self._handles.move_to_end(agent_id)
+            return handle, self._ids[handle]
+
+    def intern_many(self, agent_ids: Iterable[AgentId]) -> Tuple[List[int], List[AgentId]]:
+        """Like :meth:`intern` for a whole list, taking the lock once."""
+        handles: List[int] = []
+        interned: List[AgentId] = []
+        get = self._handles.get
+        touch = self._handles.move_to_end
+        ids = self._ids
+        with self._lock:
+            for agent_id in agent_ids:
+                handle = get(agent_id)
+                if handle is None:
+                    handle, agent_id = self._add(agent_id)
+                else:
+                    touch(agent_id)
+                    agent_id = ids[handle]
+                handles.append(handle)
+                interned.append(agent_id)
+        return handles, interned
+
+    def lookup(self, handle: int) -> AgentId:
+        """Return the ID for a handle; KeyError if it was evicted."""
+        return self._ids[handle]
+
+
+AGENT_REGISTRY = AgentRegistry()
 
 
 def _validate_agent_id(agent_id: AgentId) -> AgentId:
-    if not AGENT_ID_PATTERN.match(agent_id):
-        raise ValueError(
-            "Agent ID must be an ActivityPub-style handle such as https://domain/@name"
-        )
-    return agent_id
+    return AGENT_REGISTRY.intern(agent_id)[1]
 
 
 def _normalise_recipients(recipients: Iterable[AgentId]) -> List[AgentId]:
-    unique = []
-    seen = set()
-    for recipient in recipients:
-        validated = _validate_agent_id(recipient)
-        if validated not in seen:
-            seen.add(validated)
-            unique.append(validated)
-    return unique
+    _, interned = AGENT_REGISTRY.intern_many(recipients)
+    # Deduplicate on the interned strings, not the handles: once a list outgrows
+    # the registry, an ID can be evicted and re-issued a new handle mid-call.
+    # Interned strings carry a cached hash, so the set stays cheap.
+    return list(dict.fromkeys(interned))
 
 
 def _iso_timestamp(ts: Optional[datetime] = None) -> str:
@@ -99,6 +167,10 @@ class Envelope:
             except json.JSONDecodeError:
                 pass
 
+    def recipient_handles(self) -> "array[int]":
+        """Recipients as a compact array of registry handles (see :class:`AgentRegistry`)."""
+        return array("Q", AGENT_REGISTRY.intern_many(self.recipients)[0])
+
     def to_dict(self) -> Dict[str, Any]:
         return {
             "version": self.version,
@@ -1,33 +1,238 @@
-from flask import Flask, render_template, jsonify, request, redirect, url_for
+from flask import Flask, Response, render_template, jsonify, request, redirect, url_for, stream_with_context
+import base64
+import hashlib
+import importlib.util
 import json
-import subprocess
 import os
-from datetime import datetime
+import re
+import sys
+from datetime import datetime, timezone
 from pathlib import Path
 
+# activitypub_store などの共有モジュールは scripts ディレクトリ（コンテナでは /usr/local/bin）にある
+SCRIPT_DIR = os.environ.get("ACTIVITYPUB_SCRIPT_DIR", "/usr/local/bin")
+if not os.path.isdir(SCRIPT_DIR):
+    SCRIPT_DIR = str(Path(__file__).resolve().parent.parent / "script")
+sys.path.insert(0, SCRIPT_DIR)
+
+import activitypub_commit
+import activitypub_metrics
+from activitypub_archive import open_archive
+from activitypub_store import DATA_DIR, open_store
+from activitypub_feed import ChangeFeed
+from activitypub_outbox import QUEUED, SENT, open_outbox
+from activitypub_queue import LMTP_FALLBACK, LMTP_SOCKET, QUEUE_DIR
+from activitypub_search import matches, open_search_index, time_range
+from activitypub_threads import open_thread_index
+from activitypub_views import open_view
+
+def load_script(name):
+    """scripts ディレクトリの CLI をモジュールとして読み込む（ファイル名にハイフンを含むため import 文は使えない）"""
+    spec = importlib.util.spec_from_file_location(name[:-3].replace("-", "_"), os.path.join(SCRIPT_DIR, name))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+# 送信はプロセスを起動せず activitypub-send.py の send_activity() を直接呼ぶ
+sender = load_script("activitypub-send.py")
+
 app = Flask(__name__)
+activitypub_metrics.watch_queue(QUEUE_DIR)
+
+INBOX_PATH = Path(DATA_DIR) / "inbox.json"
+OUTBOX_PATH = Path(DATA_DIR) / "outbox.json"
+
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+STREAM_KEEPALIVE = 15  # 秒。プロキシに切断されないようコメント行を送る間隔
+# "queue": 配送キューに積んで 202 を返す（既定） / "lmtp": リクエスト内で送信して結果を返す
+SEND_TRANSPORT = os.environ.get("ACTIVITYPUB_SEND_TRANSPORT", "queue")
+
+_inbox_feed = None
 
-INBOX_PATH = Path("/var/www/activitypub/inbox.json")
-OUTBOX_PATH = Path("/var/www/activitypub/outbox.json")
+def inbox_feed():
+    """inbox の変更フィード（プロセス内で 1 つ。全 SSE クライアントで共有）"""
+    global _inbox_feed
+    if _inbox_feed is None:
+        _inbox_feed = ChangeFeed(open_store(INBOX_PATH))
+    return _inbox_feed
 
 def load_json(path):
-    if path.exists():
-        try:
-            with open(path, "r") as f:
-                return json.load(f)
-        except json.JSONDecodeError:
-            return []
-    return []
+    try:
+        return open_store(path).load_all()
+    except (OSError, ValueError):
+        return []
 
 def save_json(path, data):
-    with open(path, "w") as f:
-        json.dump(data, f, indent=2, ensure_ascii=False)
+    # 全件置き換え（O(n)）。1 件追加なら append_json を使う
+    open_store(path).rewrite(data)
+
+def append_json(path, record):
+    return activitypub_commit.append(path, record)
+
+def outbox_delivery():
+    """outbox と配送状態（pending / queued / sent / failed）"""
+    return open_outbox(OUTBOX_PATH)
+
+def send_activity(activity, mail_from, rcpt_to, endpoint=None):
+    """outbox に追記して送る（SEND_TRANSPORT に従いキュー経由または即時）"""
+    return sender.send_activity(activity, mail_from, rcpt_to, transport=SEND_TRANSPORT,
+                                endpoint=endpoint, outbox=OUTBOX_PATH)
+
+def send_response(result, activity, rcpt_to):
+    state = result.get("state")
+    body = {
+        "status": "ok" if state in (QUEUED, SENT) else "error",
+        "queued": state == QUEUED,
+        "seq": result["seq"],
+        "sent_to": rcpt_to,
+        "activity": activity,
+    }
+    if result.get("error"):
+        body["error"] = result["error"]
+    if result.get("results"):
+        body["results"] = result["results"]
+    code = 202 if state == QUEUED else 200 if state == SENT else 502
+    return jsonify(body), code
+
+def encode_cursor(seq):
+    """seq を不透明なカーソル文字列にする"""
+    return base64.urlsafe_b64encode(str(seq).encode()).decode().rstrip("=")
+
+def decode_cursor(value):
+    """encode_cursor の逆変換（不正な値は ValueError）"""
+    try:
+        return int(base64.urlsafe_b64decode(value + "=" * (-len(value) % 4)).decode())
+    except Exception:
+        raise ValueError(f"invalid cursor: {value}")
+
+def with_seq(rows):
+    """(seq, record) を UI が差分更新に使う _seq 付きの dict にする"""
+    return [dict(r, _seq=seq) if isinstance(r, dict) else {"_seq": seq, "value": r} for seq, r in rows]
+
+def normalize_thread_key(value):
+    """パスに埋め込んだ URL（https://...）はプロキシ等で // が / に潰されることがあるので戻す"""
+    return re.sub(r"^(https?:)/(?!/)", r"\1//", value)
+
+def annotate_delivery(items):
+    """outbox の各項目に配送状態（_delivery）を付ける"""
+    states = outbox_delivery().refresh()
+    for item in items:
+        st = states.get(item["_seq"])
+        if st:
+            item["_delivery"] = {k: st[k] for k in ("state", "attempts", "at", "error") if k in st}
+    return items
+
+def paginated_response(path, annotate=None, extra_version="", search=False):
+    """カーソル方式のページング（新しい順）+ ETag / Last-Modified による条件付き GET。
+
+    - limit: 1ページの件数（既定 PAGE_SIZE）
+    - cursor: 前ページの next_cursor。これより古いものを返す
+    - since: 前回の latest。これより新しいものだけを返す（ポーリング用）
+    - type / actor: ストアの索引で絞り込む
+    - start / end: ISO 時刻の範囲（end は含まない）、within: 現在からさかのぼる期間（"1h", "7d" など）
+    - from / to / q: 送信者・宛先アドレス、本文などの語（空白区切りで AND）。search=True のときだけ
+      （type / actor / 時刻の条件とあわせて activitypub_search.py のメモリ上の索引で答える）
+    - history=1: ライブストア（直近の保持期間）を読み切ったら圧縮アーカイブの古いものも返す
+
+    annotate は返す項目に付加情報を足す関数、extra_version はその情報の版（ETag に含める）。
+    """
+    store = open_store(path)
+    try:
+        limit = min(max(int(request.args.get("limit", PAGE_SIZE)), 1), MAX_PAGE_SIZE)
+        cursor = decode_cursor(request.args["cursor"]) if "cursor" in request.args else None
+        since = decode_cursor(request.args["since"]) if "since" in request.args else None
+        time_since, time_until = time_range(request.args.get("start"), request.args.get("end"),
+                                            request.args.get("within"))
+    except ValueError as e:
+        return jsonify({"status": "error", "error": str(e)}), 400
+    history = request.args.get("history") in ("1", "true", "yes")
+    archive = open_archive(path) if history else None
+    if archive is not None:
+        extra_version += f"-a{archive.version()}"
+    # 絞り込みの条件と解決後の時刻の範囲も ETag に含める（within は時間とともに範囲が動く）
+    query = json.dumps([sorted(request.args.items(multi=True)), time_since, time_until])
+    digest = hashlib.blake2b(query.encode(), digest_size=8).hexdigest()
+    etag = f"{path.stem}-{store.version()}{extra_version}-{digest}"
+    last_modified = datetime.fromtimestamp(int(store.mtime()), timezone.utc)
+    if request.if_none_match:
+        not_modified = request.if_none_match.contains(etag)
+    else:
+        # Last-Modified はストアの更新しか表さないので、within（範囲が動く）のときは使わない
+        not_modified = (not request.args.get("within") and request.if_modified_since is not None
+                        and last_modified <= request.if_modified_since)
+    if not_modified:
+        resp = app.response_class(status=304)
+    else:
+        filters = {"type": request.args.get("type") or None, "actor": request.args.get("actor") or None,
+                   "since": time_since, "until": time_until}
+        source, match = store, None
+        if search:
+            terms = {"sender": request.args.get("from") or None, "recipient": request.args.get("to") or None,
+                     "q": request.args.get("q") or None}
+            if any(filters.values()) or any(terms.values()):
+                # ストアを走査せずに索引から seq を引く
+                source = open_search_index(path)
+                filters.update(terms)
+                match = lambda record: matches(record, **filters)
+
+        if since is not None:
+            # 古い順に limit 件取り、表示用に新しい順へ並べ直す。残りは次のポーリングで取る
+            rows = source.query(**filters, after=since, limit=limit + 1)
+            has_more = len(rows) > limit
+            rows = rows[:limit]
+            latest = rows[-1][0] if rows else since
+            rows.reverse()
+            next_cursor = None
+        else:
+            rows = source.query(**filters, before=cursor, newest_first=True, limit=limit + 1)
+            if archive is not None and len(rows) <= limit:
+                # ライブストアより前（seq < first_seq）はアーカイブから読む
+                first = store.first_seq()
+                rows += archive.query(**{k: filters[k] for k in ("type", "actor", "since", "until")},
+                                      before=first if cursor is None else min(cursor, first),
+                                      newest_first=True, limit=limit + 1 - len(rows), match=match)
+            has_more = len(rows) > limit
+            rows = rows[:limit]
+            latest = len(store) - 1
+            next_cursor = encode_cursor(rows[-1][0]) if has_more else None
+
+        items = with_seq(rows)
+        if annotate:
+            items = annotate(items)
+        resp = jsonify({
+            "items": items,
+            "next_cursor": next_cursor,
+            "latest": encode_cursor(latest),
+            "has_more": has_more,
+        })
+    resp.set_etag(etag)
+    resp.last_modified = last_modified
+    resp.headers["Cache-Control"] = "no-cache"
+    return resp
 
 @app.route("/")
 def index():
-    """受信メッセージ一覧ページ"""
-    messages = sorted(load_json(INBOX_PATH), key=lambda m: m.get("timestamp", ""), reverse=True)
-    return render_template("inbox.html", messages=messages)
+    """受信メッセージ一覧ページ（最新 PAGE_SIZE 件。続きは /api/inbox のカーソルで取得）"""
+    # 描画結果は inbox に新しいデータが来るまで使い回す
+    return open_view(INBOX_PATH, PAGE_SIZE + 1).memoize("index", render_index)
+
+def render_index(view):
+    """timestamp の新しい順に並べたビューから 1 ページ目を描画する"""
+    rows = view.newest()
+    page = rows[:PAGE_SIZE]
+    next_cursor = None
+    if len(rows) > PAGE_SIZE:
+        # カーソルは seq 基準（次のページはカーソルより前の seq）。時刻順と seq 順がずれていても
+        # 表示しなかった seq を落とさないよう、表示していない最大の seq の次をカーソルにする
+        # （表示済みのものが次のページに重なっても、画面側が data-seq で除く）
+        shown = {seq for seq, _ in page}
+        cursor = len(view.store)
+        while cursor - 1 in shown:
+            cursor -= 1
+        next_cursor = encode_cursor(cursor)
+    return render_template("inbox.html", messages=with_seq(page),
+                           latest=encode_cursor(len(view.store) - 1), next_cursor=next_cursor)
 
 @app.route("/reply", methods=["POST"])
 def reply():
@@ -48,40 +253,14 @@ def reply():
         "timestamp": datetime.utcnow().isoformat()
     }
 
-    outbox = load_json(OUTBOX_PATH)
-    if not isinstance(outbox, list):
-        outbox = []
-    outbox.append(activity)
-    save_json(OUTBOX_PATH, outbox)
+    # LMTP経由で返信送信（既定では配送キューのワーカーが送る）
+    result = send_activity(activity, mail_from, rcpt_to, endpoint={"socket": LMTP_SOCKET})
 
-    print(f"[{activity['timestamp']}] Generated Accept reply for {actor}")
-
-    # LMTP経由で返信送信
-    try:
-        script_path = "/usr/local/bin/activitypub-send.py"
-        socket_path = "/var/run/dovecot/lmtp"  # LMTPソケットを指定
-
-        base_cmd = [
-            script_path,
-            "--from", mail_from,
-            "--to", rcpt_to,
-            "--socket", socket_path,
-            "--outbox", str(OUTBOX_PATH),
-        ]
-
-        # 実行権限がない場合は python3 経由で実行
-        cmd = base_cmd if os.access(script_path, os.X_OK) else ["python3"] + base_cmd
-
-        result = subprocess.run(cmd, check=False, capture_output=True, text=True)
-        if result.returncode != 0:
-            print(f"activitypub-send.py failed ({result.returncode}): {result.stderr}")
-        else:
-            print(result.stdout)
-    except Exception as e:
-        print(f"Failed to invoke activitypub-send.py: {e}")
+    print(f"[{activity['timestamp']}] Accept reply for {actor}: {result['state']} (outbox seq={result['seq']})")
 
     return redirect(url_for("index"))
 
+
 @app.route("/api/reply", methods=["POST"])
 def api_reply():
     """Followに対してAcceptを返信（JSON API, リダイレクトなし）"""
@@ -102,58 +281,69 @@ def api_reply():
         "timestamp": datetime.utcnow().isoformat()
     }
 
-    outbox = load_json(OUTBOX_PATH)
-    if not isinstance(outbox, list):
-        outbox = []
-    outbox.append(activity)
-    save_json(OUTBOX_PATH, outbox)
+    result = send_activity(activity, mail_from, rcpt_to)
+    return send_response(result, activity, rcpt_to)
 
-    try:
-        script_path = "/usr/local/bin/activitypub-send.py"
-        socket_path = "/var/run/dovecot/lmtp"
-
-        base_cmd = [
-            script_path,
-            "--from", mail_from,
-            "--to", rcpt_to,
-            "--outbox", str(OUTBOX_PATH),
-        ]
-
-        if os.path.exists(socket_path):
-            send_cmd = base_cmd + ["--socket", socket_path]
-        else:
-            send_cmd = base_cmd + ["--host", "127.0.0.1", "--port", "2626"]
-
-        cmd = send_cmd if os.access(script_path, os.X_OK) else ["python3"] + send_cmd
-        result = subprocess.run(cmd, check=False, capture_output=True, text=True)
-
-        if result.returncode == 0:
-            return jsonify({
-                "status": "ok",
-                "sent_to": rcpt_to,
-                "activity": activity,
-                "stdout": result.stdout,
-            })
-        else:
-            return jsonify({
-                "status": "error",
-                "returncode": result.returncode,
-                "stdout": result.stdout,
-                "stderr": result.stderr,
-            }), 500
-    except Exception as e:
-        return jsonify({"status": "error", "exception": str(e)}), 500
 
 @app.route("/api/inbox")
 def api_inbox():
-    """JSON形式でInboxを返す"""
-    return jsonify(load_json(INBOX_PATH))
+    """JSON形式でInboxを返す（カーソルページング・条件付き GET 対応）"""
+    return paginated_response(INBOX_PATH, search=True)
+
+@app.route("/api/inbox/stream")
+def api_inbox_stream():
+    """新着 Inbox を Server-Sent Events で配信する。
+
+    再接続時はブラウザが送る Last-Event-ID（または ?since=）以降の分から再開する。
+    """
+    last = request.headers.get("Last-Event-ID") or request.args.get("since")
+    try:
+        after = decode_cursor(last) if last else None
+    except ValueError as e:
+        return jsonify({"status": "error", "error": str(e)}), 400
+    feed = inbox_feed()
+    sub = feed.subscribe(after)
+
+    def generate():
+        try:
+            yield "retry: 3000\n\n"
+            while not sub.closed:
+                batch = sub.get(timeout=STREAM_KEEPALIVE)
+                if batch is None:
+                    yield ": keep-alive\n\n"
+                    continue
+                for item in with_seq(batch):
+                    data = json.dumps(item, ensure_ascii=False)
+                    yield f"id: {encode_cursor(item['_seq'])}\nevent: activity\ndata: {data}\n\n"
+        finally:
+            feed.unsubscribe(sub)
+
+    return Response(stream_with_context(generate()), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.route("/metrics")
+def metrics():
+    """このプロセスのステージ別メトリクス（Prometheus テキスト形式）"""
+    return Response(activitypub_metrics.render(), content_type=activitypub_metrics.CONTENT_TYPE)
+
+@app.route("/api/threads/<path:context>")
+def api_thread(context):
+    """context（会話）に属する Inbox のメッセージを古い順に返す"""
+    rows = open_thread_index(INBOX_PATH).thread(normalize_thread_key(context))
+    return jsonify({"context": context, "items": with_seq(rows), "count": len(rows)})
+
+@app.route("/api/messages/<path:message_id>/replies")
+def api_message_replies(message_id):
+    """message_id（activity / object / Envelope の ID）への直接の返信を古い順に返す"""
+    rows = open_thread_index(INBOX_PATH).replies_to(normalize_thread_key(message_id))
+    return jsonify({"id": message_id, "items": with_seq(rows), "count": len(rows)})
 
 @app.route("/api/outbox", methods=["GET", "POST"])
 def api_outbox():
     """JSON形式でOutboxを返す"""
     if request.method == "GET":
-        return jsonify(load_json(OUTBOX_PATH))
+        return paginated_response(OUTBOX_PATH, annotate=annotate_delivery,
+                                  extra_version="-" + outbox_delivery().log.version())
 
     data = request.json or {}
     actor = data.get("actor", "https://ipcnode.local/users/follow")
@@ -170,43 +360,9 @@ def api_outbox():
         "timestamp": datetime.utcnow().isoformat()
     }
 
-    outbox = load_json(OUTBOX_PATH)
-    outbox.append(activity)
-    save_json(OUTBOX_PATH, outbox)
+    result = send_activity(activity, mail_from, rcpt_to)
+    return send_response(result, activity, rcpt_to)
 
-    try:
-        script_path = "/usr/local/bin/activitypub-send.py"
-        socket_path = "/var/run/dovecot/lmtp"
-        base_cmd = [
-            script_path,
-            "--from", mail_from,
-            "--to", rcpt_to,
-            "--outbox", str(OUTBOX_PATH),
-        ]
-        if os.path.exists(socket_path):
-            send_cmd = base_cmd + ["--socket", socket_path]
-        else:
-            send_cmd = base_cmd + ["--host", "127.0.0.1", "--port", "2626"]
-
-        cmd = send_cmd if os.access(script_path, os.X_OK) else ["python3"] + send_cmd
-        result = subprocess.run(cmd, check=False, capture_output=True, text=True)
-
-        if result.returncode == 0:
-            return jsonify({
-                "status": "ok",
-                "sent_to": rcpt_to,
-                "activity": activity,
-                "stdout": result.stdout,
-            })
-        else:
-            return jsonify({
-                "status": "error",
-                "returncode": result.returncode,
-                "stdout": result.stdout,
-                "stderr": result.stderr,
-            }), 500
-    except Exception as e:
-        return jsonify({"status": "error", "exception": str(e)}), 500
 
 @app.route("/api/outbox_post", methods=["POST"])
 def api_outbox_post():
@@ -230,49 +386,10 @@ def api_outbox_post():
         "timestamp": datetime.utcnow().isoformat()
     }
 
-    # --- outbox.json に追加保存 ---
-    outbox = load_json(OUTBOX_PATH)
-    outbox.append(activity)
-    save_json(OUTBOX_PATH, outbox)
-
-    # --- 常に独自LMTPハンドラ(127.0.0.1:2626)経由で送信 ---
-    try:
-        script_path = "/usr/local/bin/activitypub-send.py"
-        cmd = [
-            script_path,
-            "--from", mail_from,
-            "--to", rcpt_to,
-            "--host", "127.0.0.1",
-            "--port", "2626",
-            "--outbox", str(OUTBOX_PATH),
-        ]
-
-        # 実行権限がない場合は python3 経由
-        if not os.access(script_path, os.X_OK):
-            cmd = ["python3"] + cmd
-
-        result = subprocess.run(cmd, check=False, capture_output=True, text=True)
-
-        if result.returncode == 0:
-            print(f"[{datetime.now().isoformat()}] Sent {activity_type} via LMTP 2626 → {rcpt_to}")
-            return jsonify({
-                "status": "ok",
-                "sent_to": rcpt_to,
-                "activity": activity,
-                "stdout": result.stdout,
-            })
-        else:
-            print(f"[ERROR] activitypub-send.py exited {result.returncode}")
-            print(result.stderr)
-            return jsonify({
-                "status": "error",
-                "returncode": result.returncode,
-                "stdout": result.stdout,
-                "stderr": result.stderr,
-            }), 500
-    except Exception as e:
-        print(f"[ERROR] Exception while sending LMTP message: {e}")
-        return jsonify({"status": "error", "exception": str(e)}), 500
+    # --- outbox に追記し、独自LMTPハンドラ(127.0.0.1:2626)宛てで送る ---
+    result = send_activity(activity, mail_from, rcpt_to, endpoint=dict(LMTP_FALLBACK))
+    print(f"[{datetime.now().isoformat()}] {activity_type} via LMTP 2626 → {rcpt_to}: {result['state']} (outbox seq={result['seq']})")
+    return send_response(result, activity, rcpt_to)
 
 
 if __name__ == "__main__":